@@ -1,19 +1,24 @@
 # This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-
-
-
+import copy
 import os  # noqa
+import random
 import warnings
-import inspect
+from contextlib import ExitStack
+from hashlib import md5
+from time import sleep, time
 
 from flask import Flask
 from flask.config import ConfigAttribute
-from flask.globals import _request_ctx_stack, current_app
-from flask.helpers import locked_cached_property
-from jinja2 import MemcachedBytecodeCache
+from flask.ctx import has_request_context
+from flask.globals import _request_ctx_stack, current_app, session
+from flask.helpers import locked_cached_property, stream_with_context
+from jinja2 import MemcachedBytecodeCache, FileSystemBytecodeCache, \
+    TemplateError
 from werkzeug.exceptions import abort
+from werkzeug.http import quote_etag
 from werkzeug.utils import import_string
+from werkzeug.contrib.cache import NullCache
 import flask.ext.login
 from flask.ext.login import LoginManager
 from flask.ext.babel import Babel
@@ -32,8 +37,14 @@ from .templating import nereid_default_template_ctx_processor, \
 from .helpers import url_for, root_transaction_if_required
 from .ctx import RequestContext
 from .csrf import NereidCsrfProtect
-from .signals import transaction_start, transaction_stop, transaction_commit
-from .routing import Rule
+from .signals import transaction_start, transaction_stop, \
+    transaction_commit, transaction_retry, transaction_retry_exhausted
+from .routing import Rule, RouteRegistry, UrlMapStore
+from .backend import ReplicaRouter, TransactionStream, sync_cache, \
+    pending_cache_resets, write_cache_resets, clear_cache_resets
+from .page_cache import PageCache
+from .cache_backends import TwoTierCache
+from .cache_utils import set_tag_cache
 from .globals import current_locale, current_website
 
 
@@ -76,12 +87,18 @@ class Nereid(Flask):
     #: The attribute holds a connection to the database backend.
     _database = None
 
+    #: The route registry of the pool. Use :attr:`route_registry`
+    _route_registry = None
+
     #: Configuration file for Tryton. The path to the configuration file
     #: can be specified and will be loaded when the application is
     #: initialised
     tryton_configfile = ConfigAttribute('TRYTON_CONFIG')
 
-    #: The location where the translations of the template are stored
+    #: The location where the translations of the template are stored.
+    #: The translations compiled into GNU .mo catalogues in this folder (see
+    #: the `nereid-compile-translations` command) are served from memory
+    #: instead of the database.
     translations_path = ConfigAttribute('TRANSLATIONS_PATH')
 
     #: The name of the database to connect to on initialisation
@@ -120,11 +137,54 @@ class Nereid(Flask):
     #:  FileSystemCache - werkzeug.contrib.cache.FileSystemCache
     cache_type = ConfigAttribute('CACHE_TYPE')
 
+    #: The type of the shared cache behind the local tier when the
+    #: `CACHE_TYPE` is `nereid.cache_backends.TwoTierCache`. It accepts the
+    #: same values as :attr:`cache_type`.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    cache_shared_type = ConfigAttribute('CACHE_SHARED_TYPE')
+
+    #: The maximum number of keys in the local tier of a two tier cache
+    #:
+    #: .. versionadded:: 5.0.0.1
+    cache_local_threshold = ConfigAttribute('CACHE_LOCAL_THRESHOLD')
+
+    #: The number of seconds a key stays in the local tier of a two tier
+    #: cache
+    #:
+    #: .. versionadded:: 5.0.0.1
+    cache_local_timeout = ConfigAttribute('CACHE_LOCAL_TIMEOUT')
+
+    #: The number of seconds between two checks for writes by other
+    #: processes in a two tier cache
+    #:
+    #: .. versionadded:: 5.0.0.1
+    cache_check_interval = ConfigAttribute('CACHE_CHECK_INTERVAL')
+
+    #: The prefixes of the keys which are not kept in the local tier of a
+    #: two tier cache. By default the sessions of the
+    #: :class:`~nereid.sessions.MemcachedSessionStore`.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    cache_local_exclude = ConfigAttribute('CACHE_LOCAL_EXCLUDE')
+
     #: If a custom cache backend unknown to Nereid is used, then
     #: the arguments that are needed for the initialisation
     #: of the cache could be passed here as a `dict`
     cache_init_kwargs = ConfigAttribute('CACHE_INIT_KWARGS')
 
+    #: The class of the session store used by the session interface, like
+    #: `nereid.sessions.RedisSessionStore`. If None, the session store of
+    #: the :attr:`session_interface` is not changed.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    session_store_type = ConfigAttribute('SESSION_STORE_TYPE')
+
+    #: The keyword arguments used to initialise the session store
+    #:
+    #: .. versionadded:: 5.0.0.1
+    session_store_init_kwargs = ConfigAttribute('SESSION_STORE_INIT_KWARGS')
+
     #: Load the template eagerly. This would render the template
     #: immediately and still return a LazyRenderer. This is useful
     #: in debugging issues that may be hard to debug with lazy rendering
@@ -154,6 +214,148 @@ class Nereid(Flask):
         'TOKEN_VALIDITY_DURATION'
     )
 
+    #: Dispatch every request in a single transaction. By default the
+    #: dispatcher opens a root transaction to synchronise the Tryton cache
+    #: and a readonly transaction to resolve the website and locale before
+    #: the transaction in which the view is called. When this is set to
+    #: True, the cache synchronisation and the website/locale resolution
+    #: happen inside the transaction of the view, on its connection, so
+    #: that every request checks out a single connection.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    single_transaction_dispatch = ConfigAttribute(
+        'SINGLE_TRANSACTION_DISPATCH'
+    )
+
+    #: The class of the connection pool used to start the transactions of
+    #: the dispatcher. See :class:`~nereid.backend.ConnectionPool`.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_pool_class = ConfigAttribute('DATABASE_POOL_CLASS')
+
+    #: The minimum number of connections kept open in the pool of the
+    #: backend
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_pool_min_size = ConfigAttribute('DATABASE_POOL_MIN_SIZE')
+
+    #: The maximum number of transactions the dispatcher runs at once. None
+    #: leaves the limit to the backend.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_pool_max_size = ConfigAttribute('DATABASE_POOL_MAX_SIZE')
+
+    #: The number of seconds to wait for a free connection when the pool is
+    #: exhausted. None waits forever.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_pool_timeout = ConfigAttribute('DATABASE_POOL_TIMEOUT')
+
+    #: The number of connections opened when the application is initialised
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_pool_prewarm = ConfigAttribute('DATABASE_POOL_PREWARM')
+
+    #: Check the health of the connection before dispatching a request
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_pool_health_check = ConfigAttribute(
+        'DATABASE_POOL_HEALTH_CHECK'
+    )
+
+    #: The uris of the servers of the replicas of the database on which
+    #: readonly transactions are started, for example
+    #: `postgresql://replica1:5432`. The database of the same name is used
+    #: on every server. See :class:`~nereid.backend.ReplicaRouter`.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_replicas = ConfigAttribute('DATABASE_REPLICAS')
+
+    #: The strategy used to select a replica: `round-robin` or
+    #: `least-connections`
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_replica_strategy = ConfigAttribute('DATABASE_REPLICA_STRATEGY')
+
+    #: The number of seconds for which a replica which failed is not used
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_replica_cooldown = ConfigAttribute('DATABASE_REPLICA_COOLDOWN')
+
+    #: The number of seconds after a write during which the readonly
+    #: transactions of the same session still use the primary database, so
+    #: that the session reads its own writes despite the replication lag.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_replica_sticky_window = ConfigAttribute(
+        'DATABASE_REPLICA_STICKY_WINDOW'
+    )
+
+    #: The delay in seconds before the first retry of a transaction which
+    #: failed with an operational error. The delay doubles on every retry,
+    #: up to :attr:`database_retry_backoff_max`, and a random jitter is
+    #: applied so that concurrent requests do not retry at the same moment.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_retry_backoff = ConfigAttribute('DATABASE_RETRY_BACKOFF')
+
+    #: The maximum delay in seconds before a retry
+    #:
+    #: .. versionadded:: 5.0.0.1
+    database_retry_backoff_max = ConfigAttribute(
+        'DATABASE_RETRY_BACKOFF_MAX'
+    )
+
+    #: Set the ETag of the responses of rendered templates to a hash of
+    #: their body, so that unchanged pages are answered with a 304. Views can
+    #: also set the `etag` of the :class:`~nereid.templating.LazyRenderer`
+    #: they return, which avoids the rendering on a match.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    etag_rendered_templates = ConfigAttribute('ETAG_RENDERED_TEMPLATES')
+
+    #: A directory in which the bytecode of compiled templates is stored.
+    #: The directory is shared by the workers of the host and kept across
+    #: restarts, so that templates are compiled once and not by every worker
+    #: on first use. If it is not set the cache of the application is used as
+    #: bytecode cache unless it is a `NullCache`. See
+    #: :meth:`compile_templates`.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    template_bytecode_cache_dir = ConfigAttribute(
+        'TEMPLATE_BYTECODE_CACHE_DIR'
+    )
+
+    #: Compile all the templates into the bytecode cache when the
+    #: application is initialised.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    template_precompile = ConfigAttribute('TEMPLATE_PRECOMPILE')
+
+    #: The number of template events buffered in every chunk of a streamed
+    #: template. See :meth:`make_streamed_response`.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    template_stream_buffer_size = ConfigAttribute(
+        'TEMPLATE_STREAM_BUFFER_SIZE'
+    )
+
+    #: The fields of the records of the `current_website` and
+    #: `current_locale` proxies read when they are first used within a
+    #: transaction, as dotted paths. See
+    #: :func:`~nereid.globals.get_current_stats`.
+    #:
+    #: .. versionadded:: 5.0.0.1
+    current_website_prefetch = ConfigAttribute('CURRENT_WEBSITE_PREFETCH')
+    current_locale_prefetch = ConfigAttribute('CURRENT_LOCALE_PREFETCH')
+
+    #: The connection pool loaded by :meth:`load_connection_pool`
+    connection_pool = None
+
+    #: The router of readonly transactions to the replicas, if
+    #: :attr:`database_replicas` are configured
+    replica_router = None
+
     def __init__(self, **config):
         """
         The import_name is forced into `Nereid`
@@ -171,10 +373,56 @@ class Nereid(Flask):
             'CACHE_THRESHOLD': 500,
             'CACHE_INIT_KWARGS': {},
             'CACHE_KEY_PREFIX': '',
+            'CACHE_SHARED_TYPE': 'werkzeug.contrib.cache.NullCache',
+            'CACHE_LOCAL_THRESHOLD': 500,
+            'CACHE_LOCAL_TIMEOUT': 5,
+            'CACHE_CHECK_INTERVAL': 1,
+            'CACHE_LOCAL_EXCLUDE': ['nereid-session:'],
+
+            'SESSION_STORE_TYPE': None,
+            'SESSION_STORE_INIT_KWARGS': {},
 
             'EAGER_TEMPLATE_RENDER': False,
+            'SINGLE_TRANSACTION_DISPATCH': False,
+
+            'DATABASE_POOL_CLASS': 'nereid.backend.ConnectionPool',
+            'DATABASE_POOL_MIN_SIZE': 0,
+            'DATABASE_POOL_MAX_SIZE': None,
+            'DATABASE_POOL_TIMEOUT': None,
+            'DATABASE_POOL_PREWARM': 0,
+            'DATABASE_POOL_HEALTH_CHECK': False,
+
+            'DATABASE_REPLICAS': [],
+            'DATABASE_REPLICA_STRATEGY': 'round-robin',
+            'DATABASE_REPLICA_COOLDOWN': 30,
+            'DATABASE_REPLICA_STICKY_WINDOW': 5,
+
+            'DATABASE_RETRY_BACKOFF': 0.05,
+            'DATABASE_RETRY_BACKOFF_MAX': 2,
+
+            'ETAG_RENDERED_TEMPLATES': False,
+
+            'TEMPLATE_BYTECODE_CACHE_DIR': None,
+            'TEMPLATE_PRECOMPILE': False,
+            'TEMPLATE_STREAM_BUFFER_SIZE': 5,
+
+            'TRANSLATIONS_PATH': None,
+
+            'CURRENT_WEBSITE_PREFETCH': (
+                'company.currency', 'default_locale', 'locales',
+            ),
+            'CURRENT_LOCALE_PREFETCH': ('language', 'currency'),
         })
 
+        #: The process local store of the compiled URL maps of the websites.
+        #: See :meth:`~nereid.routing.UrlMapStore.stats` for the number of
+        #: times the maps were rebuilt.
+        self.url_map_store = UrlMapStore()
+
+        #: The cache of the responses of the routes with the `cache_page`
+        #: option. See :class:`~nereid.page_cache.PageCache`.
+        self.page_cache = PageCache(self)
+
     def initialise(self):
         """
         The application needs initialisation to load the database
@@ -189,6 +437,9 @@ class Nereid(Flask):
         #: Load the cache
         self.load_cache()
 
+        #: Load the session store
+        self.load_session_store()
+
         #: Initialise the CSRF handling
         self.csrf_protection = NereidCsrfProtect()
         self.csrf_protection.init_app(self)
@@ -197,6 +448,7 @@ class Nereid(Flask):
 
         # Backend initialisation
         self.load_backend()
+        self.load_connection_pool()
 
         #: Initialise the login handler
         login_manager = LoginManager()
@@ -216,6 +468,13 @@ class Nereid(Flask):
 
         self.login_manager = login_manager
 
+        # flask-login looks for a remember flag in the session after every
+        # request, which would fetch lazy sessions that were never used.
+        self.after_request_funcs[None].remove(
+            login_manager._update_remember_cookie
+        )
+        self.after_request(self._update_remember_cookie)
+
         # Monkey patch the url_for method from flask-login to use
         # the nereid specific url_for
         flask.ext.login.url_for = url_for
@@ -236,66 +495,70 @@ class Nereid(Flask):
         # Initialize Babel
         Babel(self)
 
+        if self.template_precompile:
+            self.compile_templates()
+
         # Finally set the initialised attribute
         self.initialised = True
 
-    def get_urls(self):
+    def _update_remember_cookie(self, response):
         """
-        Return the URL rules for routes formed by decorating methods with the
-        :func:`~nereid.helpers.route` decorator.
+        Update the remember cookie of flask-login, unless the session of the
+        request was never loaded in which case it cannot have changed.
+        """
+        if not getattr(session, 'is_loaded', True):
+            return response
+        return self.login_manager._update_remember_cookie(response)
 
-        This method goes through all the models and their methods in the pool
-        of the loaded database and looks for the `_url_rules` attribute in
-        them. If there are URLs defined, it is added to the url map.
+    @property
+    def route_registry(self):
         """
-        rules = []
-        models = Pool._pool[self.database_name]['model']
+        The :class:`~nereid.routing.RouteRegistry` of the routes, context
+        processors and template filters of the loaded pool.
 
-        for model_name, model in models.items():
-            for f_name, f in inspect.getmembers(
-                    model,
-                    predicate=lambda m: inspect.ismethod(m) or inspect.isfunction(m)  # noqa
-                ):
+        The registry is built once for every pool and rebuilt only if the
+        pool is initialised again.
+        """
+        models = Pool._pool[self.database_name]['model']
+        registry = self._route_registry
+        if registry is None or registry.models is not models:
+            registry = self._route_registry = RouteRegistry(
+                models, self.url_rule_class
+            )
+        return registry
 
-                if not hasattr(f, '_url_rules'):
-                    continue
+    def add_url_rule(self, *args, **kwargs):
+        """
+        Add a rule to the URL map of the application. The URL maps of the
+        websites, which include the rules of the application, are built
+        again. See :meth:`~nereid.routing.RouteRegistry.changed`.
+        """
+        super(Nereid, self).add_url_rule(*args, **kwargs)
+        if self._route_registry is not None:
+            self._route_registry.changed()
 
-                for rule in f._url_rules:
-                    rule_obj = self.url_rule_class(
-                        rule[0],
-                        endpoint='.'.join([model_name, f_name]),
-                        **rule[1]
-                    )
-                    rules.append(rule_obj)
-                    if rule_obj.is_csrf_exempt:
-                        self.csrf_protection._exempt_views.add(
-                            rule_obj.endpoint
-                        )
+    def get_urls(self):
+        """
+        Return the URL rules for routes formed by decorating methods with the
+        :func:`~nereid.helpers.route` decorator.
 
-        return rules
+        The rules are copied from the :attr:`route_registry` of the loaded
+        database and the rules which are exempted from CSRF are registered
+        with the CSRF protection.
+        """
+        registry = self.route_registry
+        self.csrf_protection._exempt_views.update(registry.csrf_exempt)
+        return registry.get_rules()
 
-    @root_transaction_if_required
     def get_context_processors(self):
         """
         Returns the method object which wraps context processor methods
         formed by decorating methods with the
         :func:`~nereid.helpers.context_processor` decorator.
 
-        This method goes through all the models and their methods in the pool
-        of the loaded database and looks for the `_context_processor` attribute
-        in them and adds to context_processor dict.
+        The context processors are looked up in the :attr:`route_registry`.
         """
-        context_processors = {}
-        models = Pool._pool[self.database_name]['model']
-
-        for model_name, model in models.items():
-            for f_name, f in inspect.getmembers(
-                    model, predicate=inspect.ismethod):
-
-                if hasattr(f, '_context_processor'):
-                    ctx_proc_as_func = getattr(Pool().get(model_name), f_name)
-                    context_processors[ctx_proc_as_func.__name__] = \
-                        ctx_proc_as_func
+        context_processors = dict(self.route_registry.context_processors)
 
         def get_ctx():
             """Returns dictionary having method name in keys and method object
@@ -305,24 +568,12 @@ class Nereid(Flask):
 
         return get_ctx
 
-    @root_transaction_if_required
     def get_template_filters(self):
         """
         Returns a list of name, function pairs for template filters registered
         in the models using :func:`~nereid.helpers.template_filter` decorator.
         """
-        models = Pool._pool[self.database_name]['model']
-        filters = []
-
-        for model_name, model in models.items():
-            for f_name, f in inspect.getmembers(
-                    model, predicate=inspect.ismethod):
-
-                if hasattr(f, '_template_filter'):
-                    filter = getattr(Pool().get(model_name), f_name)
-                    filters.append((filter.__name__, filter))
-
-        return filters
+        return list(self.route_registry.template_filters)
 
     def load_cache(self):
         """
@@ -330,27 +581,67 @@ class Nereid(Flask):
         """
         BackendClass = import_string(self.cache_type)
 
-        if self.cache_type == 'werkzeug.contrib.cache.NullCache':
-            self.cache = BackendClass(self.cache_default_timeout)
-        elif self.cache_type == 'werkzeug.contrib.cache.SimpleCache':
+        if issubclass(BackendClass, TwoTierCache):
             self.cache = BackendClass(
+                self.make_cache(self.cache_shared_type),
+                default_timeout=self.cache_default_timeout,
+                local_threshold=self.cache_local_threshold,
+                local_timeout=self.cache_local_timeout,
+                check_interval=self.cache_check_interval,
+                exclude=self.cache_local_exclude,
+            )
+        else:
+            self.cache = self.make_cache(self.cache_type)
+
+        # Writes of models made outside of a request invalidate their cache
+        # tags in the cache of the application
+        set_tag_cache(self.cache)
+
+    def make_cache(self, cache_type):
+        """
+        Returns a cache of the given type initialised from the configuration
+        of the application
+
+        .. versionadded:: 5.0.0.1
+        """
+        BackendClass = import_string(cache_type)
+
+        if cache_type == 'werkzeug.contrib.cache.NullCache':
+            return BackendClass(self.cache_default_timeout)
+        elif cache_type == 'werkzeug.contrib.cache.SimpleCache':
+            return BackendClass(
                 self.cache_threshold, self.cache_default_timeout)
-        elif self.cache_type == 'werkzeug.contrib.cache.MemcachedCache':
-            self.cache = BackendClass(
+        elif cache_type == 'werkzeug.contrib.cache.MemcachedCache':
+            return BackendClass(
                 self.cache_memcached_servers,
                 self.cache_default_timeout,
                 self.cache_key_prefix)
-        elif self.cache_type == 'werkzeug.contrib.cache.GAEMemcachedCache':
-            self.cache = BackendClass(
+        elif cache_type == 'werkzeug.contrib.cache.GAEMemcachedCache':
+            return BackendClass(
                 self.cache_default_timeout,
                 self.cache_key_prefix)
-        elif self.cache_type == 'werkzeug.contrib.cache.FileSystemCache':
-            self.cache = BackendClass(
+        elif cache_type == 'werkzeug.contrib.cache.FileSystemCache':
+            return BackendClass(
                 self.cache_dir,
                 self.cache_threshold,
                 self.cache_default_timeout)
         else:
-            self.cache = BackendClass(**self.cache_init_kwargs)
+            return BackendClass(**self.cache_init_kwargs)
+
+    def load_session_store(self):
+        """
+        Load the session store from :attr:`session_store_type`. The
+        application gets its own copy of :attr:`session_interface`, with
+        the same options, which uses the store.
+        """
+        if self.session_store_type is None:
+            return
+        StoreClass = import_string(self.session_store_type)
+        session_interface = copy.copy(self.session_interface)
+        session_interface.session_store = StoreClass(
+            **self.session_store_init_kwargs
+        )
+        self.session_interface = session_interface
 
     def load_backend(self):
         """
@@ -369,6 +660,92 @@ class Nereid(Flask):
         self._pool = Pool(self.database_name)
         self._pool.init()
 
+        # Build the route registry of the pool once
+        self.route_registry
+
+    def load_connection_pool(self):
+        """
+        Load the connection pool from :attr:`database_pool_class` and
+        pre-warm the connections. If replicas are configured, a pool is
+        loaded for the server of every replica.
+        """
+        PoolClass = import_string(self.database_pool_class)
+
+        def make_pool(uri=None):
+            kwargs = {}
+            if uri is not None:
+                kwargs['uri'] = uri
+            connection_pool = PoolClass(
+                self.database_name,
+                min_size=self.database_pool_min_size,
+                max_size=self.database_pool_max_size,
+                timeout=self.database_pool_timeout,
+                health_check=self.database_pool_health_check,
+                **kwargs
+            )
+            connection_pool.configure()
+            connection_pool.warm_up(self.database_pool_prewarm)
+            return connection_pool
+
+        self.connection_pool = make_pool()
+
+        if self.database_replicas:
+            replicas = [make_pool(uri) for uri in self.database_replicas]
+            self.replica_router = ReplicaRouter(
+                self.connection_pool, replicas,
+                strategy=self.database_replica_strategy,
+                cooldown=self.database_replica_cooldown,
+            )
+
+    def start_transaction(self, user, readonly=False, context=None,
+                          nocache=False):
+        """
+        Start a transaction on the database of the application, through the
+        :attr:`connection_pool` if one is loaded. Readonly transactions are
+        started on a replica if :attr:`replica_router` is set. The return
+        value is used as a context manager.
+
+        :param nocache: Do not synchronise the Tryton caches on a new
+                        connection when the transaction starts and stops.
+                        See :func:`~nereid.backend.sync_cache`.
+
+        .. versionadded:: 5.0.0.1
+        """
+        if self.replica_router is not None:
+            return self.replica_router.transaction(
+                user, readonly=readonly, context=context,
+                primary=readonly and self.session_needs_primary(),
+                nocache=nocache,
+            )
+        if self.connection_pool is None:
+            return Transaction().start(
+                self.database_name, user, readonly=readonly, context=context,
+                _nocache=nocache
+            )
+        return self.connection_pool.transaction(
+            user, readonly=readonly, context=context, nocache=nocache
+        )
+
+    def session_needs_primary(self):
+        """
+        Return True if the session of the current request wrote to the
+        primary database within the :attr:`database_replica_sticky_window`.
+        """
+        if not has_request_context():
+            return False
+        return session.get('_primary_until', 0) > time()
+
+    def stick_session_to_primary(self):
+        """
+        Use the primary database for the readonly transactions of the
+        session of the current request for the sticky window.
+        """
+        if self.replica_router is None or \
+                not self.database_replica_sticky_window:
+            return
+        session['_primary_until'] = \
+            time() + self.database_replica_sticky_window
+
     @property
     def pool(self):
         """
@@ -386,23 +763,29 @@ class Nereid(Flask):
     def request_context(self, environ):
         return RequestContext(self, environ)
 
-    @root_transaction_if_required
     def create_url_adapter(self, request):
         """Creates a URL adapter for the given request.  The URL adapter
         is created at a point where the request context is not yet set up
         so the request is passed explicitly.
 
+        .. versionchanged:: 5.0.0.1
+
+            No transaction is started for the URL adapter of the application
+            context, which has no request.
         """
         if request is not None:
+            return self._create_url_adapter(request)
 
-            Website = Pool().get('nereid.website')
+    @root_transaction_if_required
+    def _create_url_adapter(self, request):
+        Website = Pool().get('nereid.website')
 
-            website = Website.get_from_host(request.host)
-            rv = website.get_url_adapter(self).bind_to_environ(
-                request.environ,
-                server_name=self.config['SERVER_NAME']
-            )
-            return rv
+        website = Website.get_from_host(request.host)
+        rv = website.get_url_adapter(self).bind_to_environ(
+            request.environ,
+            server_name=self.config['SERVER_NAME']
+        )
+        return rv
 
     def dispatch_request(self):
         """
@@ -423,50 +806,215 @@ class Nereid(Flask):
            and req.method == 'OPTIONS':
             return self.make_default_options_response()
 
-        with Transaction().start(self.database_name, 0):
-            Cache.clean(self.database_name)
-            Cache.resets(self.database_name)
+        # Serve the page from the cache before starting any transaction
+        rv = self.page_cache.get(req)
+        if rv is not None:
+            return rv
+
+        try:
+            single_transaction = self.single_transaction_dispatch
+            if not single_transaction:
+                with self.start_transaction(0):
+                    Cache.clean(self.database_name)
+                    Cache.resets(self.database_name)
+
+                with self.start_transaction(0, readonly=True):
+                    user, website_context, language = \
+                        self._get_dispatch_context()
+
+                # pop locale if specified in the view_args
+                req.view_args.pop('locale', None)
+            else:
+                # The view transaction is started as root and switched to the
+                # application user once the website is known.
+                user, website_context = 0, None
+
+            active_id = req.view_args.pop('active_id', None)
+
+            retries = rule.retry
+            if retries is None:
+                retries = int(config.get('database', 'retry'))
+
+            for attempt in range(retries + 1):
+                if attempt:
+                    # Wait outside of the transaction before retrying
+                    delay = self.get_retry_delay(attempt)
+                    transaction_retry.send(self, attempt=attempt, delay=delay)
+                    sleep(delay)
+
+                streamed = False
+                with ExitStack() as stack:
+                    if single_transaction:
+                        # Called once the transaction of the view is stopped
+                        stack.callback(self.flush_cache_resets)
+                    # In single transaction mode the caches are synchronised on
+                    # the connection of the view
+                    txn = stack.enter_context(self.start_transaction(
+                        user,
+                        context=website_context,
+                        readonly=rule.is_readonly,
+                        nocache=single_transaction
+                    ))
+                    cache_resets = set()
+                    try:
+                        transaction_start.send(
+                            self, **self.get_transaction_signal_kwargs(txn)
+                        )
+                        if single_transaction:
+                            sync_cache(txn)
+                            rv = self._dispatch_in_transaction(
+                                txn, req, active_id=active_id
+                            )
+                        else:
+                            rv = self._dispatch_request(
+                                req, language=language, active_id=active_id
+                            )
+                        stream = getattr(rv, 'transaction_stream', None)
+                        if stream is not None:
+                            # The stream commits and stops the transaction once
+                            # the body is sent
+                            stream.attach(txn, stack.pop_all())
+                            streamed = True
+                            if not rule.is_readonly:
+                                self.stick_session_to_primary()
+                            return rv
+                        if single_transaction:
+                            cache_resets = write_cache_resets(txn)
+                        txn.commit()
+                        clear_cache_resets(self.database_name, cache_resets)
+                        transaction_commit.send(self)
+                        if not rule.is_readonly:
+                            self.stick_session_to_primary()
+                    except DatabaseOperationalError:
+                        # Strict transaction handling may cause this.
+                        # Rollback and Retry the whole transaction if within
+                        # max retries, or raise exception and quit.
+                        txn.rollback()
+                        if attempt < retries:
+                            continue
+                        transaction_retry_exhausted.send(
+                            self, attempts=attempt + 1
+                        )
+                        raise
+                    except Exception:
+                        # Rollback and raise any other exception
+                        txn.rollback()
+                        raise
+                    else:
+                        if self.page_cache.get_options(rule) is not None:
+                            rv = self.make_response(rv)
+                            self.page_cache.set(req, rv)
+                        return rv
+                    finally:
+                        if not streamed:
+                            transaction_stop.send(
+                                self,
+                                **self.get_transaction_signal_kwargs(txn)
+                            )
+        finally:
+            # Release the lock taken to render the page again even if the
+            # view failed
+            self.page_cache.release(req)
+
+    def get_transaction_signal_kwargs(self, transaction):
+        """
+        Return the keyword arguments sent with the
+        :data:`~nereid.signals.transaction_start` and
+        :data:`~nereid.signals.transaction_stop` signals of the transaction
+        of a view:
+
+        * `wait_time`: The number of seconds the transaction waited for a
+          connection from the pool
+        * `pool_stats`: A snapshot of the statistics of the
+          :attr:`connection_pool` (see
+          :meth:`~nereid.backend.ConnectionPool.stats`), or of every pool of
+          the :attr:`replica_router` by name
+
+        Both are None if no connection pool is loaded.
+
+        .. versionadded:: 5.0.0.1
+        """
+        if self.replica_router is not None:
+            pool_stats = self.replica_router.stats()
+        elif self.connection_pool is not None:
+            pool_stats = self.connection_pool.stats()
+        else:
+            pool_stats = None
+        return {
+            'wait_time': getattr(transaction, 'pool_wait_time', None),
+            'pool_stats': pool_stats,
+        }
+
+    def flush_cache_resets(self):
+        """
+        Write the Tryton caches reset by the worker which are not written to
+        `ir_cache` yet, as by a readonly or failed transaction of a view in
+        single transaction mode, in a short transaction of their own like
+        the default dispatch does. Otherwise the other workers would keep
+        the stale caches until a later write request of this worker.
 
-        with Transaction().start(self.database_name, 0, readonly=True):
-            user = current_website.application_user.id
-            website_context = current_website.get_context()
-            website_context.update({
-                'company': current_website.company.id,
-            })
-            language = current_locale.language.code
+        .. versionadded:: 5.0.0.1
+        """
+        if not pending_cache_resets(self.database_name):
+            return
+        with self.start_transaction(0, nocache=True) as txn:
+            cache_resets = write_cache_resets(txn)
+            txn.commit()
+        clear_cache_resets(self.database_name, cache_resets)
+
+    def get_retry_delay(self, attempt):
+        """
+        Return the number of seconds to wait before the given retry attempt.
 
-        # pop locale if specified in the view_args
+        The delay grows exponentially from :attr:`database_retry_backoff`
+        and is capped at :attr:`database_retry_backoff_max`. A random value
+        between zero and that delay is returned (full jitter).
+
+        .. versionadded:: 5.0.0.1
+        """
+        if not self.database_retry_backoff:
+            return 0
+        delay = min(
+            self.database_retry_backoff_max,
+            self.database_retry_backoff * 2 ** (attempt - 1)
+        )
+        return random.uniform(0, delay)
+
+    def _get_dispatch_context(self):
+        """
+        Returns a tuple of the user, the transaction context and the language
+        with which the view of the current request should be called.
+        """
+        snapshot = current_website.get_snapshot()
+        website_context = current_website.get_context()
+        website_context.update({
+            'company': snapshot['company'],
+        })
+        return (
+            snapshot['application_user'],
+            website_context,
+            current_website.get_locale_language(current_locale),
+        )
+
+    def _dispatch_in_transaction(self, txn, req, active_id):
+        """
+        Resolve the website and locale within the given root transaction, in
+        which the cache was synchronised (see
+        :func:`~nereid.backend.sync_cache`), then switch to the application
+        user and the website context to dispatch the request.
+
+        This is used when :attr:`single_transaction_dispatch` is set.
+        """
+        user, website_context, language = self._get_dispatch_context()
+
+        # pop locale if specified in the view_args. This can only be done
+        # after the locale is resolved and is a no-op on retries.
         req.view_args.pop('locale', None)
-        active_id = req.view_args.pop('active_id', None)
 
-        for count in range(int(config.get('database', 'retry')), -1, -1):
-            with Transaction().start(
-                    self.database_name, user,
-                    context=website_context,
-                    readonly=rule.is_readonly) as txn:
-                try:
-                    transaction_start.send(self)
-                    rv = self._dispatch_request(
-                        req, language=language, active_id=active_id
-                    )
-                    txn.commit()
-                    transaction_commit.send(self)
-                except DatabaseOperationalError:
-                    # Strict transaction handling may cause this.
-                    # Rollback and Retry the whole transaction if within
-                    # max retries, or raise exception and quit.
-                    txn.rollback()
-                    if count:
-                        continue
-                    raise
-                except Exception:
-                    # Rollback and raise any other exception
-                    txn.rollback()
-                    raise
-                else:
-                    return rv
-                finally:
-                    transaction_stop.send(self)
+        with txn.set_user(user), txn.set_context(website_context):
+            return self._dispatch_request(
+                req, language=language, active_id=active_id
+            )
 
     def _dispatch_request(self, req, language, active_id):
         """
@@ -479,37 +1027,141 @@ class Nereid(Flask):
                 meth = self.view_functions[req.url_rule.endpoint]
                 result = meth(**req.view_args)
             else:
-                _model, method = req.url_rule.endpoint.rsplit('.', 1)
-                model = Pool().get(_model)
-                meth = getattr(model, method)
-
-                if hasattr(meth, '__self__') or isinstance(
-                    inspect.getattr_static(model, method), staticmethod
-                ):
+                model, meth, instance_method = \
+                    self.route_registry.get_endpoint(req.url_rule.endpoint)
+                if not instance_method:
                     # static or class method
                     result = meth(**req.view_args)
                 else:
                     # instance method, extract active_id from the url
                     # arguments and pass the model instance as first argument
-                    i = model(active_id)
-                    try:
-                        i.rec_name
-                    except UserError:
-                        # The record may not exist anymore which results in
-                        # a read error
+                    if req.url_rule.check_exists and \
+                            not self.records_exist(model, [active_id]):
+                        # The record may not exist anymore
                         current_app.logger.debug(
-                            "Record %s doesn't exist anymore." % i
+                            "Record %s,%s doesn't exist anymore." % (
+                                model.__name__, active_id
+                            )
                         )
                         abort(404)
-                    result = meth(i, **req.view_args)
+                    result = meth(model(active_id), **req.view_args)
 
             if isinstance(result, LazyRenderer):
-                result = (
-                    str(result), result.status, result.headers
-                )
+                result = self.make_lazy_response(req, result)
 
             return result
 
+    def make_lazy_response(self, req, renderer):
+        """
+        Return the response of a :class:`~nereid.templating.LazyRenderer`
+        returned by a view.
+
+        If the view set the `etag` of the renderer, a request with a matching
+        `If-None-Match` header is answered with a 304 without rendering the
+        template. Otherwise, if :attr:`etag_rendered_templates` is set, the
+        ETag is a hash of the rendered body.
+
+        .. versionadded:: 5.0.0.1
+        """
+        conditional = renderer.status == 200 and \
+            req.method in ('GET', 'HEAD')
+        stream = renderer.stream or req.url_rule.stream
+        etag, body = renderer.etag, None
+        if etag is None and stream:
+            return self.make_streamed_response(renderer)
+        if etag is None:
+            body = str(renderer)
+            if conditional and self.etag_rendered_templates:
+                etag = md5(body.encode('utf-8')).hexdigest()
+
+        headers = dict(renderer.headers)
+        if conditional and etag is not None:
+            headers['ETag'] = quote_etag(etag)
+            if req.if_none_match.contains_weak(etag):
+                return self.response_class(status=304, headers=headers)
+
+        if stream:
+            return self.make_streamed_response(renderer, headers)
+        if body is None:
+            body = str(renderer)
+        return (body, renderer.status, headers)
+
+    def make_streamed_response(self, renderer, headers=None):
+        """
+        Return a response streaming the template of the renderer to the
+        client as it is rendered, in chunks of
+        :attr:`template_stream_buffer_size` template events.
+
+        The transaction of the request is kept open until the template is
+        fully rendered and then committed, or rolled back if the rendering
+        fails or the client disconnects. The request is not retried if the
+        transaction fails once the stream started.
+
+        The session is saved with the headers, before the template is
+        rendered, so the changes made to it while rendering (like popped
+        flash messages or a new CSRF token) are saved once the template is
+        rendered. If the session interface could not save them then, as with
+        sessions kept in a cookie, the template is rendered before the
+        response is returned instead.
+
+        .. versionadded:: 5.0.0.1
+        """
+        if headers is None:
+            headers = renderer.headers
+
+        prepare = getattr(
+            self.session_interface, 'prepare_streamed_session', None
+        )
+        req = _request_ctx_stack.top.request
+        if prepare is None or not prepare(self, session, req):
+            return (str(renderer), renderer.status, headers)
+
+        def generate():
+            # The session was saved with the headers
+            session.modified = False
+            for chunk in renderer.generate(self.template_stream_buffer_size):
+                yield chunk
+            if session.modified:
+                self.session_interface.save_session(
+                    self, session, self.response_class()
+                )
+
+        stream = TransactionStream(self, generate)
+        rv = self.response_class(
+            stream_with_context(stream), status=renderer.status,
+            headers=headers,
+        )
+        rv.transaction_stream = stream
+        return rv
+
+    def process_response(self, response):
+        """
+        Closes the stream of a streamed response, which holds the
+        transaction of the request, if processing the response fails.
+        """
+        try:
+            return super(Nereid, self).process_response(response)
+        except BaseException:
+            stream = getattr(response, 'transaction_stream', None)
+            if stream is not None:
+                stream.close()
+            raise
+
+    @staticmethod
+    def records_exist(model, ids):
+        """
+        Returns True if all the records of the model with the given ids
+        exist and can be read, using a single query.
+        """
+        try:
+            ids = set(map(int, ids))
+            with Transaction().set_context(active_test=False):
+                return model.search(
+                    [('id', 'in', list(ids))], count=True
+                ) == len(ids)
+        except (UserError, ValueError, TypeError):
+            return False
+
     def create_jinja_environment(self):
         """
         Extend the default jinja environment that is created. Also
@@ -531,9 +1183,16 @@ class Nereid(Flask):
             current_website=current_website,
         )
 
-        if self.cache:
+        if self.template_bytecode_cache_dir:
+            os.makedirs(self.template_bytecode_cache_dir, exist_ok=True)
+            rv.bytecode_cache = FileSystemBytecodeCache(
+                self.template_bytecode_cache_dir
+            )
+        elif self.cache and not isinstance(self.cache, NullCache):
             # Setup the bytecode cache
             rv.bytecode_cache = MemcachedBytecodeCache(self.cache)
+
+        if self.cache:
             # Setup for fragmented caching
             rv.fragment_cache = self.cache
             rv.fragment_cache_prefix = self.cache_key_prefix + "-frag-"
@@ -555,6 +1214,52 @@ class Nereid(Flask):
             self.database_name, searchpath=self.template_folder,
         )
 
+    def compile_templates(self, filter_func=None):
+        """
+        Compile all the templates found by the loader of the application
+        into the bytecode cache of the Jinja environment, so that the
+        workers load the compiled templates instead of compiling them on
+        first use. Returns the number of templates compiled.
+
+        Jinja stores the checksum of the source and its own version with the
+        bytecode, a template which changed is thus compiled again when it is
+        loaded.
+
+        :param filter_func: An optional function called with the name of
+                            every template which returns True if it must be
+                            compiled
+
+        .. versionadded:: 5.0.0.1
+        """
+        if self.jinja_env.bytecode_cache is None:
+            self.logger.warning(
+                'Templates are compiled without a bytecode cache, set '
+                'TEMPLATE_BYTECODE_CACHE_DIR to keep the compiled templates'
+            )
+
+        if Transaction().connection is None:
+            context = Transaction().start(self.database_name, 0, readonly=True)
+        else:
+            context = Transaction().set_user(0)
+
+        compiled = 0
+        with context:
+            for name in self.jinja_env.list_templates(filter_func=filter_func):
+                try:
+                    self.jinja_env.get_template(name)
+                except UnicodeDecodeError:
+                    # Not a template, like an image in a template folder
+                    continue
+                except TemplateError:
+                    self.logger.warning(
+                        'Could not compile the template %s', name,
+                        exc_info=True
+                    )
+                    continue
+                compiled += 1
+        self.logger.info('Compiled %d templates', compiled)
+        return compiled
+
     def select_jinja_autoescape(self, filename):
         """
         Returns `True` if autoescaping should be active for the given
@@ -0,0 +1,722 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import logging
+from collections import defaultdict
+from contextlib import contextmanager, ExitStack
+from datetime import datetime
+from itertools import count
+from threading import BoundedSemaphore, Lock
+from time import time
+from urllib.parse import unquote_plus
+
+from sql import Flavor, Table
+from sql.functions import CurrentTimestamp
+from trytond import backend
+from trytond.cache import Cache, MemoryCache, LRUDict, _clear_timeout
+from trytond.config import parse_uri
+from trytond.transaction import Transaction
+
+from .signals import transaction_commit, transaction_stop
+
+__all__ = ['ConnectionPool', 'ReplicaRouter', 'TransactionStream',
+           'sync_cache', 'pending_cache_resets', 'write_cache_resets',
+           'clear_cache_resets', 'replica_database', 'start_transaction']
+
+_replica_classes = {}
+_replica_classes_lock = Lock()
+
+
+# The functions synchronising the caches use the internals of the memory
+# cache of Tryton, as Cache.clean and Cache.resets always use a new
+# connection. They follow trytond 5.0, the version setup.py pins.
+
+
+def sync_cache(transaction):
+    """
+    Synchronise the Tryton caches of the worker with the `ir_cache` table of
+    the database of the transaction, like :meth:`Cache.clean` does but with
+    the cursor of the given transaction instead of a new connection.
+
+    The transaction must be started with `_nocache`, otherwise Tryton
+    already synchronised the caches on a new connection. The caches reset
+    by the worker are then written with :func:`write_cache_resets`.
+
+    Other cache classes than the memory cache of Tryton are synchronised
+    with their own methods.
+
+    .. versionadded:: 5.0.0.1
+    """
+    dbname = transaction.database.name
+    if not issubclass(Cache, MemoryCache):
+        Cache.clean(dbname)
+        return
+
+    now = datetime.now()
+    if (now - MemoryCache._clean_last).total_seconds() < _clear_timeout:
+        return
+
+    table = Table('ir_cache')
+    cursor = transaction.connection.cursor()
+    cursor.execute(*table.select(table.timestamp, table.name))
+    timestamps = dict(
+        (name, timestamp) for timestamp, name in cursor.fetchall()
+    )
+    for inst in MemoryCache._cache_instance:
+        if inst._name not in timestamps:
+            continue
+        with inst._lock:
+            inst_timestamp = inst._timestamp.get(dbname)
+            if not inst_timestamp or \
+                    timestamps[inst._name] > inst_timestamp:
+                inst._timestamp[dbname] = timestamps[inst._name]
+                inst._cache[dbname] = LRUDict(inst.size_limit)
+    MemoryCache._clean_last = now
+
+
+def pending_cache_resets(dbname):
+    """
+    Return the names of the caches reset by the worker which are not written
+    to the `ir_cache` table of the database yet.
+
+    .. versionadded:: 5.0.0.1
+    """
+    if not issubclass(Cache, MemoryCache):
+        return set()
+    with MemoryCache._resets_lock:
+        return set(MemoryCache._resets.get(dbname, ()))
+
+
+def write_cache_resets(transaction):
+    """
+    Write the caches reset by the worker to the `ir_cache` table with the
+    cursor of the transaction, like :meth:`Cache.resets` does on a new
+    connection. Nothing is written by readonly transactions, the resets are
+    then left to a following write transaction (see
+    :meth:`~nereid.application.Nereid.flush_cache_resets`).
+
+    Returns the names of the caches written, which must be passed to
+    :func:`clear_cache_resets` once the transaction is committed. If it is
+    rolled back they are written again by the next transaction.
+
+    .. versionadded:: 5.0.0.1
+    """
+    dbname = transaction.database.name
+    if not issubclass(Cache, MemoryCache):
+        Cache.resets(dbname)
+        return set()
+    if transaction.readonly:
+        return set()
+
+    names = pending_cache_resets(dbname)
+    table = Table('ir_cache')
+    cursor = transaction.connection.cursor()
+    for name in sorted(names):
+        cursor.execute(*table.update(
+            [table.timestamp], [CurrentTimestamp()],
+            where=table.name == name
+        ))
+        if not cursor.rowcount:
+            cursor.execute(*table.insert(
+                [table.timestamp, table.name], [[CurrentTimestamp(), name]]
+            ))
+    return names
+
+
+def clear_cache_resets(dbname, names):
+    """
+    Forget the caches reset by the worker once they are written to
+    `ir_cache` by a committed transaction. See :func:`write_cache_resets`.
+
+    .. versionadded:: 5.0.0.1
+    """
+    if not names:
+        return
+    with MemoryCache._resets_lock:
+        MemoryCache._resets.get(dbname, set()).difference_update(names)
+
+
+def replica_database(database_name, uri):
+    """
+    Return the Tryton database object of the database `database_name` on
+    the server of `uri`, a replica of the primary server. The user, password,
+    host and port of the uri override the ones of the `database.uri` of the
+    Tryton configuration.
+
+    The replica keeps the name of the primary database, so that the
+    transactions started on it use the Tryton pool and caches of the
+    primary database. Only the backends which connect with connection
+    parameters, like PostgreSQL, support replicas.
+
+    .. versionadded:: 5.0.0.1
+    """
+    Database = backend.get('Database')
+    if not hasattr(Database, '_connection_params'):
+        raise ValueError(
+            'The %s backend does not support replicas' % backend.name()
+        )
+
+    with _replica_classes_lock:
+        ReplicaDatabase = _replica_classes.get(uri)
+        if ReplicaDatabase is None:
+            ReplicaDatabase = type('ReplicaDatabase', (Database,), {
+                'replica_uri': uri,
+                '_databases': defaultdict(dict),
+                '_connection_params': classmethod(_replica_connection_params),
+            })
+            _replica_classes[uri] = ReplicaDatabase
+    return ReplicaDatabase(database_name).connect()
+
+
+def _replica_connection_params(cls, name):
+    params = super(cls, cls)._connection_params(name)
+    uri = parse_uri(cls.replica_uri)
+    if uri.username:
+        params['user'] = uri.username
+    if uri.password:
+        params['password'] = unquote_plus(uri.password)
+    if uri.hostname:
+        params['host'] = uri.hostname
+    if uri.port:
+        params['port'] = uri.port
+    return params
+
+
+def start_transaction(database, user, readonly=False, context=None,
+                      nocache=False):
+    """
+    Start a transaction like :meth:`Transaction.start` does, but on a
+    connection of the given database object rather than of the database
+    loaded from the name. See :func:`replica_database`.
+
+    .. versionadded:: 5.0.0.1
+    """
+    transaction = Transaction()
+    assert transaction.user is None
+    assert transaction.database is None
+    Flavor.set(database.flavor)
+    transaction.connection = database.get_connection(readonly=readonly)
+    transaction.user = user
+    transaction.database = database
+    transaction.readonly = readonly
+    transaction.close = False
+    transaction.context = context or {}
+    transaction.create_records = {}
+    transaction.delete_records = {}
+    transaction.delete = {}
+    transaction.timestamp = {}
+    transaction.counter = 0
+    transaction._datamanagers = []
+    transaction._nocache = nocache
+    if not nocache:
+        try:
+            Cache.clean(database.name)
+        except BaseException:
+            transaction.stop(False)
+            raise
+    return transaction
+
+
+class ConnectionPool(object):
+    """
+    Bounds and instruments the database connections checked out by the
+    nereid dispatcher.
+
+    Tryton keeps its own pool of connections for every database. This class
+    sits in front of it to:
+
+        * apply a minimum and maximum size to the pool of the backend (when
+          the backend has one, like PostgreSQL),
+        * limit the number of transactions the dispatcher starts at once,
+          waiting up to `timeout` seconds for a free connection,
+        * pre-warm connections when the application is initialised,
+        * optionally check the health of a connection before it is used,
+        * count checkouts, failures, the time spent waiting for a connection
+          and the number of connections in use.
+
+    The statistics are returned by :meth:`stats`. The dispatcher sends them
+    with :data:`~nereid.signals.transaction_start` and
+    :data:`~nereid.signals.transaction_stop`, along with the time the
+    transaction waited for its connection::
+
+        @transaction_start.connect
+        def log_pool(app, wait_time=None, pool_stats=None, **kwargs):
+            app.logger.debug('Waited %s: %s', wait_time, pool_stats)
+
+    A different pool can be used by setting `DATABASE_POOL_CLASS` in the
+    configuration of the application.
+
+    :param database_name: The name of the database
+    :param min_size: The minimum number of connections kept open
+    :param max_size: The maximum number of connections in use at once. If
+                     None the size is only limited by the backend.
+    :param timeout: The number of seconds to wait for a free connection when
+                    the pool is exhausted. None waits forever.
+    :param health_check: If True a `SELECT 1` is executed on the connection
+                         of every transaction before it is used. A
+                         connection which fails is closed and another one
+                         is checked out.
+    :param uri: The uri of the server of a replica of the database. The
+                connections are opened on this server instead of the
+                server of the Tryton configuration. See
+                :func:`replica_database`.
+    """
+
+    def __init__(self, database_name, min_size=0, max_size=None,
+                 timeout=None, health_check=False, uri=None):
+        self.database_name = database_name
+        self.uri = uri
+
+        #: The name of the pool in the statistics and the logs, the name of
+        #: the database followed by the server of a replica
+        self.name = database_name
+        if uri is not None:
+            uri = parse_uri(uri)
+            self.name = '%s@%s' % (database_name, uri.hostname or '')
+            if uri.port:
+                self.name += ':%s' % uri.port
+        self.min_size = min_size or 0
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.logger = logging.getLogger('nereid.backend')
+
+        self._semaphore = None
+        if max_size:
+            self._semaphore = BoundedSemaphore(max_size)
+        self._lock = Lock()
+
+        self.in_use = 0
+        self.checkouts = 0
+        self.failures = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.last_wait_time = 0.0
+
+    @property
+    def database(self):
+        """
+        The Tryton database object of the backend
+        """
+        if self.uri is not None:
+            return replica_database(self.database_name, self.uri)
+        Database = backend.get('Database')
+        return Database(self.database_name).connect()
+
+    def configure(self):
+        """
+        Apply the minimum and maximum size to the connection pool of the
+        backend if it has one.
+        """
+        connpool = getattr(self.database, '_connpool', None)
+        if connpool is None:
+            return
+        connpool.minconn = max(connpool.minconn, self.min_size)
+        if self.max_size:
+            connpool.maxconn = max(self.max_size, connpool.minconn)
+
+    def warm_up(self, count):
+        """
+        Open `count` connections and return them to the pool of the backend,
+        so that the first requests do not pay for the connection.
+        """
+        if not count:
+            return
+        if self.max_size:
+            count = min(count, self.max_size)
+
+        connpool = getattr(self.database, '_connpool', None)
+        minconn = None
+        if connpool is not None:
+            # Connections returned beyond minconn are closed by the pool
+            minconn = connpool.minconn
+            connpool.minconn = max(minconn, count)
+
+        database = self.database
+        connections = []
+        try:
+            for i in range(count):
+                connections.append(database.get_connection())
+        finally:
+            for connection in connections:
+                database.put_connection(connection)
+            if minconn is not None:
+                # The idle connections are kept, only the connections
+                # returned later beyond the configured minimum are closed
+                connpool.minconn = minconn
+        self.logger.info(
+            'Pre-warmed %d connections to %s', len(connections),
+            self.name
+        )
+
+    def _acquire(self):
+        """
+        Wait for a free slot in the pool, record the time spent waiting and
+        return it
+        """
+        start = time()
+        if self._semaphore is not None:
+            if self.timeout is None:
+                acquired = self._semaphore.acquire()
+            else:
+                acquired = self._semaphore.acquire(timeout=self.timeout)
+            if not acquired:
+                with self._lock:
+                    self.failures += 1
+                DatabaseOperationalError = backend.get(
+                    'DatabaseOperationalError'
+                )
+                raise DatabaseOperationalError(
+                    'Timed out waiting for a connection to %s' %
+                    self.name
+                )
+        waited = time() - start
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_time += waited
+            self.last_wait_time = waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return waited
+
+    def _release(self):
+        with self._lock:
+            self.in_use -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @contextmanager
+    def transaction(self, user, readonly=False, context=None,
+                    nocache=False):
+        """
+        Start a transaction on a connection checked out from the pool. The
+        transaction is stopped and the connection returned to the pool when
+        the context is exited.
+
+        The number of seconds spent waiting for the connection is kept in
+        the `pool_wait_time` attribute of the transaction.
+
+        :param nocache: Do not synchronise the Tryton caches when the
+                        transaction starts and stops. See :func:`sync_cache`.
+        """
+        waited = self._acquire()
+        try:
+            # A connection which fails the health check is discarded and
+            # another one is checked out once
+            for attempt in range(2 if self.health_check else 1):
+                try:
+                    if self.uri is not None:
+                        transaction = start_transaction(
+                            self.database, user, readonly=readonly,
+                            context=context, nocache=nocache
+                        )
+                    else:
+                        transaction = Transaction().start(
+                            self.database_name, user, readonly=readonly,
+                            context=context, _nocache=nocache
+                        )
+                except Exception:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                if not self.health_check or self.check(transaction):
+                    break
+                self.discard(transaction)
+            else:
+                DatabaseOperationalError = backend.get(
+                    'DatabaseOperationalError'
+                )
+                raise DatabaseOperationalError(
+                    'No healthy connection to %s' % self.name
+                )
+            transaction.pool_wait_time = waited
+            with transaction:
+                yield transaction
+        finally:
+            self._release()
+
+    def check(self, transaction):
+        """
+        Check the health of the connection of the transaction and return
+        True if it can be used.
+        """
+        try:
+            transaction.connection.cursor().execute('SELECT 1')
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            self.logger.warning(
+                'Health check failed for a connection to %s',
+                self.name, exc_info=True
+            )
+            return False
+        return True
+
+    def discard(self, transaction):
+        """
+        Stop the transaction and close its connection instead of returning
+        it to the pool of the backend.
+        """
+        # The transaction returns its connection with
+        # put_connection(connection, close=True) when it stops
+        transaction.close = True
+        try:
+            transaction.stop(False)
+        except Exception:
+            # The rollback fails on a broken connection, the connection is
+            # closed anyway
+            self.logger.debug(
+                'Rollback failed on a discarded connection to %s',
+                self.name, exc_info=True
+            )
+
+    def stats(self):
+        """
+        Return a dictionary of the statistics of the pool
+        """
+        with self._lock:
+            return {
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'failures': self.failures,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'last_wait_time': self.last_wait_time,
+            }
+
+
+class ReplicaRouter(object):
+    """
+    Routes readonly transactions to the connection pools of the replicas
+    of the database.
+
+    The replicas are servers which stream a copy of the primary database.
+    Their pools connect to the server of a replica with the name of the
+    primary database (see the `uri` of :class:`ConnectionPool`), so the
+    transactions use the Tryton pool and caches of the primary database.
+
+    Transactions which are not readonly, or which are explicitly asked to
+    run on the primary (for example right after a write by the same
+    session), always use the pool of the primary database. A replica which
+    fails to start a transaction is left out of the selection for
+    `cooldown` seconds and the transaction falls back to the primary. A
+    replica on which an operational error is raised during the transaction
+    is also left out, so that the retry of the transaction uses another
+    server.
+
+    :param primary: The :class:`ConnectionPool` of the primary database
+    :param replicas: A list of :class:`ConnectionPool` of the replicas
+    :param strategy: `round-robin` or `least-connections`
+    :param cooldown: The number of seconds for which an unhealthy replica
+                     is not used
+    """
+
+    strategies = ('round-robin', 'least-connections')
+
+    def __init__(self, primary, replicas, strategy='round-robin',
+                 cooldown=30):
+        if strategy not in self.strategies:
+            raise ValueError('Unknown replica strategy: %s' % strategy)
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.logger = logging.getLogger('nereid.backend')
+
+        self._unhealthy = {}
+        self._counter = count()
+
+    def healthy_replicas(self):
+        """
+        Return the replicas which are not cooling down after a failure
+        """
+        now = time()
+        return [
+            replica for replica in self.replicas
+            if self._unhealthy.get(replica.name, 0) <= now
+        ]
+
+    def select(self):
+        """
+        Return the pool of the replica on which the next readonly
+        transaction should run, or the primary if no replica is healthy.
+        """
+        replicas = self.healthy_replicas()
+        if not replicas:
+            return self.primary
+        if self.strategy == 'least-connections':
+            return min(replicas, key=lambda replica: replica.in_use)
+        return replicas[next(self._counter) % len(replicas)]
+
+    def mark_unhealthy(self, replica):
+        """
+        Leave the replica out of the selection for the cooldown period
+        """
+        self._unhealthy[replica.name] = time() + self.cooldown
+        self.logger.warning(
+            'Replica %s is unhealthy, using the primary for %s seconds',
+            replica.name, self.cooldown
+        )
+
+    @contextmanager
+    def transaction(self, user, readonly=False, context=None,
+                    primary=False, nocache=False):
+        """
+        Start a transaction on a replica if it is readonly, or on the
+        primary otherwise.
+
+        :param primary: Force the use of the primary database
+        :param nocache: See :meth:`ConnectionPool.transaction`
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        pool = self.primary
+        if readonly and not primary:
+            pool = self.select()
+
+        with ExitStack() as stack:
+            try:
+                transaction = stack.enter_context(pool.transaction(
+                    user, readonly=readonly, context=context,
+                    nocache=nocache
+                ))
+            except Exception:
+                if pool is self.primary:
+                    raise
+                # Any failure to connect to a replica, not only the
+                # operational errors of the backend
+                self.logger.debug(
+                    'Failed to start a transaction on %s', pool.name,
+                    exc_info=True
+                )
+                self.mark_unhealthy(pool)
+                pool = self.primary
+                transaction = stack.enter_context(pool.transaction(
+                    user, readonly=readonly, context=context,
+                    nocache=nocache
+                ))
+            try:
+                yield transaction
+            except DatabaseOperationalError:
+                if pool is not self.primary:
+                    self.mark_unhealthy(pool)
+                raise
+
+    def stats(self):
+        """
+        Return a dictionary of the statistics of the pools by name
+        """
+        rv = {self.primary.name: self.primary.stats()}
+        for replica in self.replicas:
+            rv[replica.name] = dict(
+                replica.stats(),
+                healthy=replica in self.healthy_replicas()
+            )
+        return rv
+
+
+class TransactionStream(object):
+    """
+    The body of a streamed response, which keeps the transaction of the
+    request open until the body is fully sent.
+
+    The chunks are produced by calling `generate` when the body is first
+    iterated, with the user and the context of the transaction at the time
+    the stream was created (usually in the view). Once all the chunks are
+    sent the transaction is committed. It is rolled back if producing a
+    chunk fails, or if the stream is closed before it is exhausted, as when
+    the client disconnects.
+
+    The dispatcher hands the transaction over to the stream with
+    :meth:`attach`, which takes the callbacks stopping the transaction.
+
+    :param app: The application, sender of the transaction signals
+    :param generate: A callable returning an iterable of the chunks
+    """
+
+    def __init__(self, app, generate):
+        self.app = app
+        self.generate = generate
+        self.user = Transaction().user
+        self.context = Transaction().context
+        self.transaction = None
+        self.stack = None
+        self._iterator = None
+        self._done = False
+
+    def attach(self, transaction, stack):
+        """
+        Take over the transaction and the :class:`~contextlib.ExitStack`
+        which stops it
+        """
+        self.transaction = transaction
+        self.stack = stack
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = self._iterate()
+        return next(self._iterator)
+
+    def _iterate(self):
+        transaction = self.transaction
+        if transaction is None:
+            # Not attached, as when the application does not dispatch the
+            # request in its own transaction: the body is generated in the
+            # transaction of the caller, which stops it.
+            for chunk in self.generate():
+                yield chunk
+            return
+        try:
+            with transaction.set_user(self.user), \
+                    transaction.set_context(self.context):
+                for chunk in self.generate():
+                    yield chunk
+        except BaseException:
+            self.finish(commit=False)
+            raise
+        self.finish(commit=True)
+
+    def finish(self, commit):
+        """
+        Commit or roll back the transaction and stop it
+        """
+        if self._done or self.transaction is None:
+            return
+        self._done = True
+        try:
+            if commit:
+                cache_resets = write_cache_resets(self.transaction)
+                self.transaction.commit()
+                clear_cache_resets(
+                    self.transaction.database.name, cache_resets
+                )
+                transaction_commit.send(self.app)
+            else:
+                self.transaction.rollback()
+        finally:
+            try:
+                self.stack.close()
+            finally:
+                transaction_stop.send(self.app, **self.get_signal_kwargs())
+
+    def get_signal_kwargs(self):
+        """
+        Return the keyword arguments of the transaction signals sent by the
+        application. See
+        :meth:`~nereid.application.Nereid.get_transaction_signal_kwargs`.
+        """
+        get_kwargs = getattr(self.app, 'get_transaction_signal_kwargs', None)
+        if get_kwargs is None:
+            return {}
+        return get_kwargs(self.transaction)
+
+    def close(self):
+        """
+        Called by the WSGI server when the response is done, or when the
+        client disconnected before the end of the stream
+        """
+        if self._iterator is not None:
+            self._iterator.close()
+        self.finish(commit=False)
@@ -0,0 +1,260 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import pickle
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from werkzeug.contrib.cache import BaseCache
+
+__all__ = ['TwoTierCache']
+
+
+class TwoTierCache(BaseCache):
+    """
+    A cache which keeps the hot keys in a bounded in-process LRU in front
+    of a shared cache backend (like memcached).
+
+    Reads are served from the local tier when possible, for at most
+    `local_timeout` seconds. Writes go to both tiers.
+
+    Every value written to the shared cache is stored with a version stamp
+    under a second key, in the same round trip. Each process fetches the
+    stamps of the keys of its local tier with a single `get_many` at most
+    every `check_interval` seconds, and drops the keys whose stamp changed
+    (written or deleted by another process). Only the changed keys are
+    invalidated, and a value read from the local tier is at most
+    `min(local_timeout, check_interval)` seconds stale. Values without a
+    stamp (written by `add`, `inc`, `dec` or by another client of the
+    shared cache) are not kept in the local tier.
+
+    Keys starting with one of the `exclude` prefixes never use the local
+    tier, for values which must always be fresh. By default these are the
+    sessions of :class:`~nereid.sessions.MemcachedSessionStore`.
+
+    The local tier keeps the values pickled, like the shared backends do,
+    so that a caller changing a value it got does not change the value
+    served to the others.
+
+    The hits and misses of each tier are counted in :attr:`stats`.
+
+    To use it set the `CACHE_TYPE` of the application to
+    `nereid.cache_backends.TwoTierCache`. The shared backend is then
+    configured as the cache used to be, with `CACHE_SHARED_TYPE` instead of
+    `CACHE_TYPE`.
+
+    :param shared: The shared cache backend
+    :param default_timeout: The default timeout of the shared cache
+    :param local_threshold: The maximum number of keys in the local tier
+    :param local_timeout: The number of seconds a key stays in the local
+                          tier
+    :param check_interval: The number of seconds between two checks of the
+                           stamps of the keys of the local tier
+    :param exclude: A list of prefixes of keys which are not kept locally
+
+    .. versionadded:: 5.0.0.1
+    """
+
+    #: The prefix of the keys of the stamps in the shared cache
+    stamp_prefix = 'nereid.stamp:'
+
+    def __init__(self, shared, default_timeout=300, local_threshold=500,
+                 local_timeout=5, check_interval=1,
+                 exclude=('nereid-session:',)):
+        BaseCache.__init__(self, default_timeout)
+        self.shared = shared
+        self.local_threshold = local_threshold
+        self.local_timeout = local_timeout
+        self.check_interval = check_interval
+        self.exclude = tuple(exclude)
+
+        self._local = OrderedDict()
+        self._lock = Lock()
+        self._checked_at = 0
+
+        #: The hits and misses of the local and shared tiers
+        self.stats = {
+            'local': {'hits': 0, 'misses': 0},
+            'shared': {'hits': 0, 'misses': 0},
+        }
+
+    def is_local(self, key):
+        """
+        Returns True if the key can be kept in the local tier
+        """
+        return not key.startswith(self.exclude)
+
+    def get_stamp_key(self, key):
+        """
+        Returns the key of the stamp of the key in the shared cache
+        """
+        return self.stamp_prefix + key
+
+    def _check_stamps(self):
+        """
+        Drop the keys of the local tier whose stamp changed in the shared
+        cache
+        """
+        now = time()
+        if now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            local = [(key, entry[1]) for key, entry in self._local.items()]
+            self._checked_at = now
+        if not local:
+            return
+        stamps = self.shared.get_many(
+            *[self.get_stamp_key(key) for key, stamp in local]
+        )
+        with self._lock:
+            for (key, stamp), shared_stamp in zip(local, stamps):
+                if shared_stamp == stamp:
+                    continue
+                entry = self._local.get(key)
+                if entry is not None and entry[1] == stamp:
+                    del self._local[key]
+
+    def _local_get(self, key):
+        with self._lock:
+            try:
+                expires, stamp, value = self._local[key]
+            except KeyError:
+                return False, None
+            if expires < time():
+                del self._local[key]
+                return False, None
+            self._local.move_to_end(key)
+        return True, pickle.loads(value)
+
+    def _local_set(self, key, stamp, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout > 0:
+            timeout = min(timeout, self.local_timeout)
+        else:
+            timeout = self.local_timeout
+        try:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Only kept in the shared cache
+            return
+        with self._lock:
+            self._local[key] = (time() + timeout, stamp, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_threshold:
+                self._local.popitem(last=False)
+
+    def _local_delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def _count(self, tier, hit):
+        self.stats[tier]['hits' if hit else 'misses'] += 1
+
+    def _shared_get_many(self, keys):
+        """
+        Returns the values of the keys in the shared cache and store the
+        ones which have a stamp in the local tier, with a single round trip
+        """
+        local = [key for key in keys if self.is_local(key)]
+        rv = self.shared.get_many(
+            *(list(keys) + [self.get_stamp_key(key) for key in local])
+        )
+        values = dict(zip(keys, rv))
+        stamps = dict(zip(local, rv[len(keys):]))
+        for key in keys:
+            value = values[key]
+            self._count('shared', value is not None)
+            if value is not None and stamps.get(key) is not None:
+                self._local_set(key, stamps[key], value)
+        return [values[key] for key in keys]
+
+    def get(self, key):
+        if self.is_local(key):
+            self._check_stamps()
+            found, value = self._local_get(key)
+            self._count('local', found)
+            if found:
+                return value
+            return self._shared_get_many([key])[0]
+        value = self.shared.get(key)
+        self._count('shared', value is not None)
+        return value
+
+    def get_many(self, *keys):
+        values = {}
+        missing = []
+        self._check_stamps()
+        for key in keys:
+            if self.is_local(key):
+                found, value = self._local_get(key)
+                self._count('local', found)
+                if found:
+                    values[key] = value
+                    continue
+            missing.append(key)
+        if missing:
+            values.update(zip(missing, self._shared_get_many(missing)))
+        return [values[key] for key in keys]
+
+    def set(self, key, value, timeout=None):
+        return self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        shared = dict(mapping)
+        stamps = {}
+        for key in mapping:
+            if self.is_local(key):
+                stamps[key] = shared[self.get_stamp_key(key)] = uuid4().hex
+        # The values and their stamps are written in a single round trip
+        rv = self.shared.set_many(shared, timeout)
+        for key, stamp in stamps.items():
+            self._local_set(key, stamp, mapping[key], timeout)
+        return rv
+
+    def add(self, key, value, timeout=None):
+        # The value has no stamp, so it is not kept locally. The stamp of a
+        # previous value was deleted with it.
+        return self.shared.add(key, value, timeout)
+
+    def delete(self, key):
+        return self.delete_many(key)
+
+    def delete_many(self, *keys):
+        self._local_delete(*keys)
+        keys = list(keys) + [
+            self.get_stamp_key(key) for key in keys if self.is_local(key)
+        ]
+        if type(self.shared).delete_many is BaseCache.delete_many:
+            # The default implementation stops at the first missing key
+            return all([self.shared.delete(key) for key in keys])
+        return self.shared.delete_many(*keys)
+
+    def has(self, key):
+        if self.is_local(key):
+            self._check_stamps()
+            found, value = self._local_get(key)
+            if found:
+                return True
+        return self.shared.has(key)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+        return self.shared.clear()
+
+    def _forget_stamp(self, key):
+        self._local_delete(key)
+        if self.is_local(key):
+            # The value changes without a new stamp
+            self.shared.delete(self.get_stamp_key(key))
+
+    def inc(self, key, delta=1):
+        self._forget_stamp(key)
+        return self.shared.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self._forget_stamp(key)
+        return self.shared.dec(key, delta)
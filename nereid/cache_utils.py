@@ -0,0 +1,547 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Helpers shared by the caches of nereid (memoized functions, template
+fragments and pages) to protect them from cache stampedes: when a popular
+key expires, only one worker recomputes it while the others wait for it or
+are served the stale value.
+
+Values are stored wrapped in a :class:`CacheEntry` which records when the
+value logically expires and how long it took to compute. This allows:
+
+    * An early probabilistic refresh: a worker may decide to recompute the
+      value shortly before it expires, with a probability growing as the
+      expiry approaches and with the cost of the computation (the XFetch
+      algorithm). Popular keys are then refreshed before they expire.
+    * Serving stale values: the entry is kept in the cache `stale_timeout`
+      seconds longer than its timeout, and served while another worker
+      recomputes it.
+    * A short lived lock, taken with `cache.add`, so that a single worker
+      recomputes an expired key.
+
+Entries can also carry tags, like the name of a model, a record
+(`product.product:12`) or a website (`nereid.website:1`). The version of
+every tag is stored in the cache and recorded in the entries computed with
+it. Invalidating a tag replaces its version, which invalidates all the
+entries which depend on it at once. Models which inherit
+:class:`CacheTagMixin` invalidate their tags when their records are
+created, written or deleted.
+
+:func:`memoize` and :func:`memoize_many` cache the values returned by a
+function keyed by its arguments.
+
+.. versionadded:: 5.0.0.1
+"""
+import inspect
+import math
+import random
+from collections import namedtuple, OrderedDict
+from functools import wraps
+from hashlib import blake2b
+from time import sleep, time
+from uuid import uuid4
+
+from flask.globals import current_app
+from flask.ctx import has_app_context
+from trytond.model import Model
+from trytond.transaction import Transaction
+from werkzeug.contrib.cache import NullCache
+
+__all__ = [
+    'CacheEntry', 'cached_call', 'get_entry', 'set_entry',
+    'needs_refresh', 'acquire_lock', 'release_lock',
+    'get_tags', 'get_tag_versions', 'invalidate_tags', 'set_tag_cache',
+    'model_tags', 'CacheTagMixin', 'make_key', 'memoize', 'memoize_many',
+]
+
+#: The number of seconds after which the lock of a key being recomputed is
+#: released even if the worker computing it died
+LOCK_TIMEOUT = 30
+
+#: The number of seconds a worker waits for another worker to compute a
+#: missing value before computing it itself
+WAIT_TIMEOUT = 5
+
+#: The interval between two checks of the cache while waiting
+WAIT_INTERVAL = 0.05
+
+#: The number of seconds a value is kept after it expires, to be served
+#: while it is recomputed
+STALE_TIMEOUT = 60
+
+#: The weight of the early refresh. Values above 1 favour earlier refreshes
+#: and 0 disables them.
+BETA = 1.0
+
+
+#: The prefix of the keys of the versions of the tags
+TAG_PREFIX = 'nereid.tag:'
+
+#: The cache in which tags are invalidated outside of an application
+#: context. See :func:`set_tag_cache`.
+_tag_cache = None
+
+
+class CacheEntry(
+        namedtuple('CacheEntry', ['value', 'expires', 'delta', 'tags'])):
+    """
+    A value stored in the cache with the time at which it expires (None if
+    it never does), the number of seconds it took to compute and the
+    versions of the tags it depends on.
+    """
+    __slots__ = ()
+
+    def __new__(cls, value, expires, delta, tags=None):
+        return super(CacheEntry, cls).__new__(
+            cls, value, expires, delta, tags
+        )
+
+
+def set_tag_cache(cache):
+    """
+    Set the cache in which the tags are invalidated by writes made outside
+    of a nereid application context (like a cron task or the Tryton server
+    if it shares the cache backend of the application). The cache of the
+    application is used within an application context.
+    """
+    global _tag_cache
+    _tag_cache = cache
+
+
+def get_tag_cache():
+    if has_app_context():
+        return current_app.cache
+    return _tag_cache
+
+
+def model_tags(model_name, ids=()):
+    """
+    Returns the tags of a model and of the records with the given ids
+    """
+    return [model_name] + ['%s:%s' % (model_name, id) for id in ids]
+
+
+def get_tags(tags, args=(), kwargs=None):
+    """
+    Returns the list of tags of a cached call: `tags` is either a list of
+    tags or a callable returning them from the arguments of the call.
+    """
+    if callable(tags):
+        tags = tags(*args, **(kwargs or {}))
+    return list(tags or [])
+
+
+def get_tag_versions(cache, tags):
+    """
+    Returns a dictionary of the current version of the tags, creating the
+    versions of the tags which have none. Nothing is cached by a `NullCache`
+    so the tags have no version in it.
+    """
+    tags = sorted(set(tags))
+    if not tags or isinstance(cache, NullCache):
+        return {}
+    keys = [TAG_PREFIX + tag for tag in tags]
+    versions = list(cache.get_many(*keys))
+    for index, version in enumerate(versions):
+        if version is None:
+            version = uuid4().hex
+            if not cache.add(keys[index], version, 0):
+                # Created concurrently
+                version = cache.get(keys[index])
+            versions[index] = version
+    return dict(zip(tags, versions))
+
+
+def invalidate_tags(tags, cache=None):
+    """
+    Invalidate all the entries which depend on the tags
+    """
+    if cache is None:
+        cache = get_tag_cache()
+    tags = set(tags)
+    if cache is None or not tags:
+        return
+    cache.set_many(
+        dict((TAG_PREFIX + tag, uuid4().hex) for tag in tags), 0
+    )
+
+
+def is_valid(cache, entry):
+    """
+    Returns True if the tags of the entry were not invalidated
+    """
+    if not entry.tags:
+        return True
+    return get_tag_versions(cache, entry.tags) == entry.tags
+
+
+def _get_timeout(cache, timeout):
+    if timeout is None:
+        timeout = getattr(cache, 'default_timeout', 300)
+    return timeout
+
+
+def get_entry(cache, key):
+    """
+    Returns the :class:`CacheEntry` stored in the cache for the key, or None.
+    A value stored by an older version of nereid without an entry is
+    returned as an entry which never expires.
+    """
+    entry = cache.get(key)
+    if entry is None or isinstance(entry, CacheEntry):
+        return entry
+    return CacheEntry(entry, None, 0)
+
+
+def set_entry(cache, key, value, timeout=None, delta=0,
+              stale_timeout=None, tags=None):
+    """
+    Stores the value in the cache wrapped in a :class:`CacheEntry`.
+
+    :param timeout: The number of seconds after which the value expires
+    :param delta: The number of seconds it took to compute the value
+    :param stale_timeout: The number of seconds the value is kept after it
+                          expired to be served while it is recomputed
+    :param tags: The versions of the tags the value depends on, as returned
+                 by :func:`get_tag_versions` *before* the value was computed
+    """
+    timeout = _get_timeout(cache, timeout)
+    if not timeout:
+        # Never expires
+        return cache.set(key, CacheEntry(value, None, delta, tags), 0)
+    if stale_timeout is None:
+        stale_timeout = STALE_TIMEOUT
+    return cache.set(
+        key, CacheEntry(value, time() + timeout, delta, tags),
+        timeout + stale_timeout
+    )
+
+
+def needs_refresh(entry, beta=None):
+    """
+    Returns True if the entry expired, or if it should be refreshed early.
+    """
+    if entry.expires is None:
+        return False
+    if beta is None:
+        beta = BETA
+    now = time()
+    if beta and entry.delta:
+        # XFetch: -log(random) is exponentially distributed, the refresh
+        # gets likelier as the expiry approaches and for costly values.
+        now -= entry.delta * beta * math.log(1 - random.random())
+    return now >= entry.expires
+
+
+def get_lock_key(key):
+    return key + ':lock'
+
+
+def acquire_lock(cache, key, lock_timeout=None):
+    """
+    Try to take the lock to recompute the key and return True if taken
+    """
+    if lock_timeout is None:
+        lock_timeout = LOCK_TIMEOUT
+    return bool(cache.add(get_lock_key(key), 1, lock_timeout))
+
+
+def release_lock(cache, key):
+    cache.delete(get_lock_key(key))
+
+
+def cached_call(cache, key, function, timeout=None, serve_stale=False,
+                stale_timeout=None, lock_timeout=None, beta=None,
+                tags=None):
+    """
+    Returns the value of the key in the cache, computing it by calling
+    `function` with no arguments if it is missing or expired, with
+    protection from stampedes.
+
+    :param timeout: The number of seconds for which the value is cached
+    :param serve_stale: If True, the expired value is returned while
+                        another worker recomputes it. Otherwise the other
+                        workers wait for the new value.
+    :param stale_timeout: The number of seconds an expired value is kept
+    :param lock_timeout: The number of seconds after which the lock of a key
+                         is released
+    :param beta: The weight of the early refresh
+    :param tags: A list of tags the value depends on
+    """
+    entry = get_entry(cache, key)
+    if entry is not None and not is_valid(cache, entry):
+        # Invalidated entries are never served
+        entry = None
+    if entry is not None and not needs_refresh(entry, beta):
+        return entry.value
+
+    if not acquire_lock(cache, key, lock_timeout):
+        # Another worker is computing the value. Stale values are served if
+        # allowed, or if the other worker is only refreshing the value early.
+        expired = entry is not None and entry.expires is not None and \
+            entry.expires <= time()
+        if entry is not None and (serve_stale or not expired):
+            return entry.value
+        waited = 0
+        while waited < WAIT_TIMEOUT:
+            sleep(WAIT_INTERVAL)
+            waited += WAIT_INTERVAL
+            new_entry = get_entry(cache, key)
+            if new_entry is not None and (
+                    entry is None or new_entry.expires != entry.expires) \
+                    and is_valid(cache, new_entry):
+                return new_entry.value
+        # Give up waiting and compute the value
+
+    try:
+        versions = get_tag_versions(cache, tags or [])
+        start = time()
+        value = function()
+        set_entry(
+            cache, key, value, timeout, delta=time() - start,
+            stale_timeout=stale_timeout if serve_stale else 0,
+            tags=versions,
+        )
+    finally:
+        release_lock(cache, key)
+    return value
+
+
+def _sort_key(value):
+    # Values of different types are not comparable, sort them by type first
+    return (type(value).__name__, repr(value))
+
+
+def key_part(value):
+    """
+    Returns a representation of the value which is stable across processes
+    to be used in a cache key. Tryton records are represented by their
+    model and id, and models by their name. The items of dictionaries and
+    sets are sorted, even if they mix types.
+    """
+    if isinstance(value, Model):
+        return (value.__name__, value.id)
+    if isinstance(value, type) and issubclass(value, Model):
+        return value.__name__
+    if isinstance(value, (list, tuple)):
+        return tuple(key_part(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((
+            (key_part(k), key_part(v)) for k, v in value.items()
+        ), key=lambda item: _sort_key(item[0])))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(
+            (key_part(v) for v in value), key=_sort_key
+        ))
+    return value
+
+
+def make_key(*parts):
+    """
+    Returns a cache key hashed from the parts
+    """
+    return blake2b(
+        repr(key_part(parts)).encode('utf-8'), digest_size=16
+    ).hexdigest()
+
+
+class _Memoized(object):
+    """
+    Builds the cache keys of the calls to a memoized function from its
+    arguments, bound once to the signature of the function.
+    """
+
+    def __init__(self, function, key, method=False):
+        self.function = function
+        self.key = key
+        self.signature = inspect.signature(function)
+        self.method = method
+        self.first = next(iter(self.signature.parameters), None)
+
+    def get_arguments(self, args, kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = bound.arguments
+        if self.method:
+            # The instance is part of the key only if it is a record
+            arguments = dict(arguments)
+            first = arguments.pop(self.first, None)
+            if isinstance(first, Model) or (
+                    isinstance(first, type) and issubclass(first, Model)):
+                arguments[self.first] = first
+        return arguments
+
+    def make_key(self, args, kwargs):
+        return make_key(self.key, self.get_arguments(args, kwargs))
+
+
+def memoize(key, timeout=None, unless=None, serve_stale=False, tags=None,
+            method=False):
+    """
+    Decorator caching the return value of a function in the cache of the
+    current application, keyed by `key` and the arguments of the call.
+
+    :param key: A name unique to the function
+    :param timeout: Time in seconds to retain cached value
+    :param unless: Callable for truth testing. If provided, the callable is
+                   called with no arguments and if true, caching operation
+                   will be cancelled
+    :param serve_stale: Serve the expired value while it is recomputed.
+                        See :func:`cached_call`.
+    :param tags: A list of cache tags the value depends on, or a callable
+                 returning them from the arguments of the function
+    :param method: If True the first argument (`self` or `cls`) is only
+                   part of the key if it is a Tryton record or model
+    """
+    def decorator(function):
+        memoized = _Memoized(function, key, method)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if callable(unless) and unless() is True:
+                return function(*args, **kwargs)
+            return cached_call(
+                current_app.cache, memoized.make_key(args, kwargs),
+                lambda: function(*args, **kwargs),
+                timeout, serve_stale=serve_stale,
+                tags=get_tags(tags, args, kwargs)
+            )
+        return wrapper
+    return decorator
+
+
+def memoize_many(key, timeout=None, unless=None, tags=None, method=False):
+    """
+    Decorator caching the values returned by a function computing a list of
+    values from a list of items (its first argument, or the one after
+    `self` or `cls` if `method` is True). Each value is cached separately,
+    keyed by its item and the other arguments of the call.
+
+    The values of all the items are fetched with a single `get_many`, the
+    function is called once with the list of the missing items only and
+    their values are stored with a single `set_many`. The function must
+    return one value for each item, in the order of the items, otherwise a
+    `ValueError` is raised.
+
+    .. code-block:: python
+
+        @memoize_many('product.sale_price', 600)
+        def get_sale_prices(products, quantity=1):
+            return [product.get_sale_price(quantity) for product in products]
+
+    The parameters are those of :func:`memoize`, the tags are the same for
+    all the values of a call.
+    """
+    def decorator(function):
+        memoized = _Memoized(function, key, method)
+        items_index = 1 if method else 0
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if callable(unless) and unless() is True:
+                return function(*args, **kwargs)
+
+            cache = current_app.cache
+            head = args[:items_index]
+            items = list(args[items_index])
+            rest = args[items_index + 1:]
+
+            # The key of every item is derived from the key of the call
+            # without the items
+            call_key = memoized.make_key(head + ([], ) + rest, kwargs)
+            keys = [make_key(call_key, item) for item in items]
+
+            versions = get_tag_versions(cache, get_tags(tags, args, kwargs))
+            values = {}
+            entries = cache.get_many(*keys) if keys else []
+            now = time()
+            for cache_key, entry in zip(keys, entries):
+                if not isinstance(entry, CacheEntry):
+                    continue
+                if entry.expires is not None and entry.expires <= now:
+                    continue
+                if (entry.tags or {}) != versions:
+                    continue
+                values[cache_key] = entry.value
+
+            missing = OrderedDict()
+            for cache_key, item in zip(keys, items):
+                if cache_key not in values:
+                    missing.setdefault(cache_key, item)
+            if missing:
+                start = time()
+                computed = list(function(
+                    *(head + (list(missing.values()), ) + rest), **kwargs
+                ))
+                if len(computed) != len(missing):
+                    raise ValueError(
+                        '%s returned %d values for %d items' % (
+                            function.__name__, len(computed), len(missing)
+                        )
+                    )
+                delta = (time() - start) / len(missing)
+                seconds = _get_timeout(cache, timeout)
+                expires = now + seconds if seconds else None
+                mapping = {}
+                for cache_key, value in zip(missing, computed):
+                    values[cache_key] = value
+                    mapping[cache_key] = CacheEntry(
+                        value, expires, delta, versions
+                    )
+                cache.set_many(mapping, seconds)
+            return [values[cache_key] for cache_key in keys]
+        return wrapper
+    return decorator
+
+
+class CacheTagMixin(object):
+    """
+    A mixin for Tryton models whose records are used in cached values. The
+    tags of the model and of the records created, written or deleted are
+    invalidated when the transaction ends, so that no value computed from
+    the data before the commit is cached with the new versions of the tags.
+
+    .. code-block:: python
+
+        class Product(CacheTagMixin, ModelSQL, ModelView):
+            __name__ = 'product.product'
+
+    Values cached with the tag `product.product` are then invalidated on
+    any change of a product, and values cached with the tag
+    `product.product:12` on a change of the product 12.
+    """
+
+    @classmethod
+    def get_cache_tags(cls, records):
+        """
+        Returns the tags invalidated by a change of the records
+        """
+        return model_tags(cls.__name__, [r.id for r in records])
+
+    @classmethod
+    def invalidate_cache_tags(cls, records):
+        cache = get_tag_cache()
+        if cache is None:
+            return
+        Transaction().atexit(
+            invalidate_tags, cls.get_cache_tags(records), cache
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(CacheTagMixin, cls).create(vlist)
+        cls.invalidate_cache_tags(records)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(CacheTagMixin, cls).write(*args)
+        records = []
+        for record_list in args[::2]:
+            records.extend(record_list)
+        cls.invalidate_cache_tags(records)
+
+    @classmethod
+    def delete(cls, records):
+        cls.invalidate_cache_tags(records)
+        super(CacheTagMixin, cls).delete(records)
@@ -1,12 +1,12 @@
 # This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 from functools import wraps
-from hashlib import md5
-import inspect
 from warnings import warn
 
 from flask.globals import current_app
 
+from .cache_utils import cached_call, get_tags, memoize, memoize_many
+
 warn(DeprecationWarning("This API will be deprecated"))
 
 
@@ -69,7 +69,8 @@ class Cache(object):
         "Proxy function for internal cache object."
         return current_app.cache.set_many(mapping, timeout)
 
-    def cache(self, key, timeout=None, unless=None):
+    def cache(self, key, timeout=None, unless=None, serve_stale=False,
+              tags=None):
         """
         Decorator to use as caching function
 
@@ -80,6 +81,11 @@ class Cache(object):
         :param unless: Callable for truth testing. If provided, the
                        callable is called with no arguments and if true,
                        caching operation will be cancelled.
+        :param serve_stale: Serve the expired value while it is recomputed.
+                            See :func:`~nereid.cache_utils.cached_call`.
+        :param tags: A list of cache tags the value depends on, or a
+                     callable returning them from the arguments of the
+                     function. See :mod:`~nereid.cache_utils`.
         """
         def decorator(function):
             @wraps(function)
@@ -87,16 +93,17 @@ class Cache(object):
                 if callable(unless) and unless() is True:
                     return function(*args, **kwargs)
 
-                rv = current_app.cache.get(key)
-
-                if rv is None:
-                    rv = function(*args, **kwargs)
-                    current_app.cache.set(key, rv, timeout)
-                return rv
+                return cached_call(
+                    current_app.cache, key,
+                    lambda: function(*args, **kwargs),
+                    timeout, serve_stale=serve_stale,
+                    tags=get_tags(tags, args, kwargs)
+                )
             return wrapper
         return decorator
 
-    def memoize(self, key, timeout=None, unless=None):
+    def memoize(self, key, timeout=None, unless=None,
+                serve_stale=False, tags=None):
         """
         Decorator to use as caching function but also evaluates
         the arguments
@@ -108,34 +115,23 @@ class Cache(object):
         :param unless: Callable for truth testing. If provided, the
                        callable is called with no arguments and if true,
                        caching operation will be cancelled
+        :param serve_stale: Serve the expired value while it is recomputed.
+                            See :func:`~nereid.cache_utils.cached_call`.
+        :param tags: A list of cache tags the value depends on, or a
+                     callable returning them from the arguments of the
+                     function. See :mod:`~nereid.cache_utils`.
+
+        .. versionchanged:: 5.0.0.1
+            The arguments are bound with :func:`inspect.signature` and
+            Tryton records are keyed by their model and id. See
+            :func:`~nereid.cache_utils.memoize`.
         """
-        def decorator(function):
-            arg_names = inspect.getargspec(function)[0]
-
-            @wraps(function)
-            def wrapper(*args, **kwargs):
-                if callable(unless) and unless() is True:
-                    return function(*args, **kwargs)
-
-                kwargs_origin = kwargs.copy()
-                kwargs.update(dict(list(zip(arg_names, args))))
-                kwargs = list(kwargs.items())
-                kwargs.sort()
-
-                hash = md5()
-                hash.update(key + repr(kwargs))
-                cache_key = hash.hexdigest()
-
-                rv = current_app.cache.get(cache_key)
-
-                if rv is None:
-                    rv = function(*args, **kwargs_origin)
-                    current_app.cache.set(cache_key, rv, timeout)
-                return rv
-            return wrapper
-        return decorator
+        return memoize(
+            key, timeout, unless, serve_stale=serve_stale, tags=tags
+        )
 
-    def memoize_method(self, key, timeout=None, unless=None):
+    def memoize_method(self, key, timeout=None, unless=None,
+                       serve_stale=False, tags=None):
         """
         Decorator to use as caching function but also evaluates
         the arguments
@@ -147,30 +143,30 @@ class Cache(object):
         :param unless: Callable for truth testing. If provided, the
                        callable is called with no arguments and if true,
                        caching operation will be cancelled
+        :param serve_stale: Serve the expired value while it is recomputed.
+                            See :func:`~nereid.cache_utils.cached_call`.
+        :param tags: A list of cache tags the value depends on, or a
+                     callable returning them from the arguments of the
+                     function. See :mod:`~nereid.cache_utils`.
+
+        .. versionchanged:: 5.0.0.1
+            `self` is part of the key, by its model and id, when it is a
+            Tryton record. It used to be left out of the key, so the value
+            computed for a record was also returned for the other records.
+            Instances which are not records are still left out of the key.
         """
-        def decorator(function):
-            arg_names = inspect.getargspec(function)[0]
-
-            @wraps(function)
-            def wrapper(*args, **kwargs):
-                if callable(unless) and unless() is True:
-                    return function(*args, **kwargs)
+        return memoize(
+            key, timeout, unless, serve_stale=serve_stale, tags=tags,
+            method=True
+        )
 
-                kwargs_origin = kwargs.copy()
-                kwargs.update(dict(list(zip(arg_names, args))))
-                kwargs.pop('self')
-                kwargs = list(kwargs.items())
-                kwargs.sort()
-
-                hash = md5()
-                hash.update(key + repr(args[1:]) + repr(kwargs))
-                cache_key = hash.hexdigest()
-
-                rv = current_app.cache.get(cache_key)
+    def memoize_many(self, key, timeout=None, unless=None, tags=None,
+                     method=False):
+        """
+        Decorator caching separately each of the values computed by a
+        function from a list of items. See
+        :func:`~nereid.cache_utils.memoize_many`.
 
-                if rv is None:
-                    rv = function(*args, **kwargs_origin)
-                    current_app.cache.set(cache_key, rv, timeout)
-                return rv
-            return wrapper
-        return decorator
+        .. versionadded:: 5.0.0.1
+        """
+        return memoize_many(key, timeout, unless, tags=tags, method=method)
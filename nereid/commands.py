@@ -0,0 +1,130 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Command line tools of nereid
+
+.. versionadded:: 5.0.0.1
+"""
+import argparse
+import logging
+import os
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .application import Nereid
+
+__all__ = ['compile_templates', 'compile_translations']
+
+
+def get_parser(description):
+    """
+    Returns an argument parser with the arguments common to the commands
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        'settings', help='A python file with the configuration of the '
+        'application'
+    )
+    parser.add_argument(
+        '-d', '--database', dest='database_name',
+        help='The name of the database, overrides DATABASE_NAME'
+    )
+    return parser
+
+
+def get_app(args, **options):
+    """
+    Returns the application configured from the settings file and the
+    database of the arguments, not initialised
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    app = Nereid(**options)
+    app.config.from_pyfile(os.path.abspath(args.settings))
+    if args.database_name:
+        app.config['DATABASE_NAME'] = args.database_name
+    return app
+
+
+def compile_templates(argv=None):
+    """
+    Compile the templates of an application into its bytecode cache
+    directory, to be run at deploy time before the workers are started::
+
+        nereid-compile-templates settings.py
+
+    The settings file is a python file with the configuration of the
+    application, like the one given to :meth:`flask.Config.from_pyfile`.
+    """
+    parser = get_parser(
+        'Compile the templates of a nereid application into a bytecode '
+        'cache directory'
+    )
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir',
+        help='The bytecode cache directory, overrides '
+        'TEMPLATE_BYTECODE_CACHE_DIR'
+    )
+    parser.add_argument(
+        '--template-folder', dest='template_folder',
+        help='The folder of the templates of the application'
+    )
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.template_folder:
+        options['template_folder'] = os.path.abspath(args.template_folder)
+    app = get_app(args, **options)
+    if args.cache_dir:
+        app.config['TEMPLATE_BYTECODE_CACHE_DIR'] = args.cache_dir
+    if not app.template_bytecode_cache_dir:
+        parser.error('No bytecode cache directory is configured')
+
+    # The templates are compiled below
+    app.config['TEMPLATE_PRECOMPILE'] = False
+    app.initialise()
+
+    compiled = app.compile_templates()
+    print('Compiled %d templates into %s' % (
+        compiled, app.template_bytecode_cache_dir
+    ))
+
+
+def compile_translations(argv=None):
+    """
+    Compile the nereid translations of the database into GNU .mo catalogues
+    in the translations path of the application, to be run at deploy time
+    and after the translations changed. The running workers load the new
+    catalogues::
+
+        nereid-compile-translations settings.py
+    """
+    parser = get_parser(
+        'Compile the translations of a nereid application into .mo '
+        'catalogues'
+    )
+    parser.add_argument(
+        '--path', dest='path',
+        help='The folder of the catalogues, overrides TRANSLATIONS_PATH'
+    )
+    args = parser.parse_args(argv)
+
+    app = get_app(args)
+    if args.path:
+        app.config['TRANSLATIONS_PATH'] = args.path
+    if not app.translations_path:
+        parser.error('No translations path is configured')
+    app.load_backend()
+
+    with Transaction().start(app.database_name, 0, readonly=True):
+        filenames = Pool().get('ir.translation').export_nereid_catalogues(
+            app.translations_path
+        )
+    print('Compiled %d catalogues into %s' % (
+        len(filenames), app.translations_path
+    ))
+
+
+if __name__ == '__main__':
+    compile_templates()
@@ -1,17 +1,97 @@
 # This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import gettext
+import mmap
+import os
+from threading import Lock
 
 import flask.ext.babel
+from flask.ctx import has_app_context
 from speaklater import is_lazy_string, make_lazy_string
 from flask.ext.babel import Babel  # noqa
 from babel import Locale
 from pytz import timezone
-from nereid.globals import _request_ctx_stack
+from nereid.globals import _request_ctx_stack, current_app
 from nereid import current_user, current_website, current_locale
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 
+#: The compiled catalogues loaded by the process, with the version of the
+#: translations they were loaded with. None for the missing or outdated ones.
+_catalogues = {}
+_catalogues_lock = Lock()
+
+
+def get_catalogue_filename(path, lang, ttype, module=None):
+    """
+    Returns the name of the file of the compiled catalogue of the
+    translations of a language, type and module (or all the modules if None)
+    in the translations path.
+
+    .. versionadded:: 5.0.0.1
+    """
+    domain = ttype if module is None else '%s.%s' % (ttype, module)
+    return os.path.join(path, lang, 'LC_MESSAGES', domain + '.mo')
+
+
+def load_catalogue(filename):
+    """
+    Returns the :class:`gettext.GNUTranslations` of the compiled catalogue
+    in the file, or None if there is none. The file is memory mapped while
+    it is parsed.
+
+    .. versionadded:: 5.0.0.1
+    """
+    try:
+        with open(filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as fp:
+                return gettext.GNUTranslations(fp)
+    except FileNotFoundError:
+        return None
+
+
+def get_catalogue(module, ttype, lang):
+    """
+    Returns the compiled catalogue of the translations of the module, type
+    and language in the `TRANSLATIONS_PATH` of the current application, or
+    None if there is none.
+
+    A catalogue is only used if it was compiled since the last change of the
+    translations. Every process loads the catalogues once for every version
+    of the translations, which changes when a translation is changed or the
+    catalogues are compiled again.
+
+    .. versionadded:: 5.0.0.1
+    """
+    path = current_app.translations_path if has_app_context() else None
+    if not path:
+        return None
+    IRTranslation = Pool().get('ir.translation')
+    key = (Transaction().database.name, path, lang, ttype, module)
+    version = IRTranslation.get_nereid_compiled_version()
+
+    cached = _catalogues.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _catalogues_lock:
+        cached = _catalogues.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        catalogue = load_catalogue(
+            get_catalogue_filename(path, lang, ttype, module)
+        )
+        if catalogue is not None and \
+                catalogue.info().get('x-nereid-translations-changed') != \
+                IRTranslation.get_nereid_changed():
+            # Compiled before the last change of the translations
+            catalogue = None
+        _catalogues[key] = (version, catalogue)
+    return catalogue
+
 
 class TrytonTranslations(gettext.NullTranslations, object):
     """
@@ -27,6 +107,12 @@ class TrytonTranslations(gettext.NullTranslations, object):
         The ir.translation module does not have the capability to handle
         ngettext well as there is no option to have multiple strings. The
         extraction system will create each message separately.
+
+    .. versionchanged:: 5.0.0.1
+
+        The translations are read from the catalogues compiled in the
+        `TRANSLATIONS_PATH` of the application if they are up to date, and
+        from the database otherwise. See :func:`get_catalogue`.
     """
 
     def __init__(self, module, ttype='nereid'):
@@ -35,18 +121,29 @@ class TrytonTranslations(gettext.NullTranslations, object):
         self.ttype = ttype
         super(TrytonTranslations, self).__init__(fp=None)
 
+    def translate(self, message):
+        """
+        Returns the translation of the message in the language of the
+        transaction, or None
+        """
+        lang = Transaction().language
+        catalogue = get_catalogue(self.module, self.ttype, lang)
+        if catalogue is not None:
+            rv = catalogue.gettext(message)
+            return rv if rv != message else None
+
+        IRTranslation = Pool().get('ir.translation')
+        return IRTranslation.get_translation_4_nereid(
+            self.module, self.ttype, lang, message
+        )
+
     def ugettext(self, message):
         """Translates a string with the current locale
         ::
 
             gettext(u'Hello World!')
         """
-        IRTranslation = Pool().get('ir.translation')
-
-        rv = IRTranslation.get_translation_4_nereid(
-            self.module, self.ttype, Transaction().language, message
-        )
-        return (rv or message)
+        return (self.translate(message) or message)
 
     def lazy_ugettext(self, message, **variables):
         """Translates a string with the current locale and passes in the
@@ -63,16 +160,11 @@ class TrytonTranslations(gettext.NullTranslations, object):
         """
         Translates a string with the current locale
         """
-        IRTranslation = Pool().get('ir.translation')
-
         if self.plural(n):
             message = plural
         else:
             message = singular
-        rv = IRTranslation.get_translation_4_nereid(
-            self.module, self.ttype, Transaction().language, message
-        )
-        return (rv or message)
+        return (self.translate(message) or message)
 
     def lazy_ungettext(self, singular, plural, n, **variables):
         """Translates a string with the current locale and passes in the
@@ -129,7 +221,7 @@ def get_locale():
     if locale is None:
         babel = ctx.app.extensions['babel']
         if babel.locale_selector_func is None:
-            rv = current_locale.language.code
+            rv = current_website.get_locale_language(current_locale)
         else:
             rv = babel.locale_selector_func()
 
@@ -3,6 +3,7 @@
 from flask.globals import (_request_ctx_stack, current_app,  # noqa
     request, session, g, LocalProxy, _find_app)
 from flask.ext.login import current_user                     # noqa
+from trytond.transaction import Transaction
 
 
 def _find_cache():
@@ -14,12 +15,86 @@ def _find_cache():
     return app.cache
 
 
+def get_current_stats():
+    """
+    Returns the counters of the current request for the `current_website`
+    and `current_locale` proxies, by proxy:
+
+        * accesses: the number of times the proxy was used
+        * builds: the number of times its record was built, every build
+          reading the fields of its prefetch paths again
+
+    The counters do not count queries: the fields of a record are read by
+    Tryton, which reads the eager fields of a model together and every
+    x2many field separately.
+
+    .. versionadded:: 5.0.0.1
+    """
+    ctx = _request_ctx_stack.top
+    stats = getattr(ctx, 'current_stats', None)
+    if stats is None:
+        stats = ctx.current_stats = {
+            'website': {'accesses': 0, 'builds': 0},
+            'locale': {'accesses': 0, 'builds': 0},
+        }
+    return stats
+
+
+def _prefetch(record, paths):
+    """
+    Access the fields of the record given as dotted paths, so that they are
+    read by the record and the following accesses are answered by its cache
+    """
+    for path in paths:
+        value = record
+        for name in path.split('.'):
+            value = getattr(value, name, None)
+            if value is None:
+                break
+
+
+def _get_current_record(name, model_name, record_id, prefetch):
+    """
+    Returns the record of the current website or locale.
+
+    The record is kept in the dictcache of the request, so that all the
+    accesses to the proxy within a transaction share the fields read by the
+    record. A record of another transaction, user or context is built
+    again.
+    """
+    stats = get_current_stats()[name]
+    stats['accesses'] += 1
+
+    Model = current_app.pool.get(model_name)
+    transaction = Transaction()
+    dictcache = getattr(_request_ctx_stack.top.request, '__dictcache__', None)
+    if transaction.connection is None or dictcache is None:
+        # Nothing can be read outside of a transaction
+        return Model(record_id)
+
+    key = 'nereid.current_' + name
+    record = dictcache.get(key)
+    if record is not None and record.id == record_id and \
+            record._transaction is transaction and \
+            record._user == transaction.user and \
+            record._context == transaction.context:
+        return record
+
+    record = Model(record_id)
+    stats['builds'] += 1
+    _prefetch(record, prefetch)
+    dictcache[key] = record
+    return record
+
+
 def _get_locale():
-    Locale = current_app.pool.get('nereid.website.locale')
     locale_id = getattr(_request_ctx_stack.top, 'locale', None)
     if locale_id is None:
         locale_id = _set_locale()
-    return Locale(locale_id)
+    return _get_current_record(
+        'locale', 'nereid.website.locale', locale_id,
+        current_app.current_locale_prefetch
+    )
 
 
 def _set_locale():
@@ -30,11 +105,13 @@ def _set_locale():
 
 
 def _get_website():
-    Website = current_app.pool.get('nereid.website')
     website_id = getattr(_request_ctx_stack.top, 'website', None)
     if website_id is None:
         website_id = _set_website()
-    return Website(website_id)
+    return _get_current_record(
+        'website', 'nereid.website', website_id,
+        current_app.current_website_prefetch
+    )
 
 
 def _set_website():
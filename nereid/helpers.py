@@ -10,7 +10,6 @@ import re
 import warnings
 import unicodedata
 from functools import wraps
-from hashlib import md5
 
 import trytond.modules
 from trytond.transaction import Transaction
@@ -26,6 +25,8 @@ from werkzeug.exceptions import NotFound
 from flask.ext.login import login_required      # noqa
 
 from .globals import current_app, request, current_locale, current_website, current_user  # noqa
+from .routing import register_decorated_method
+from .cache_utils import make_key
 
 
 _SLUGIFY_STRIP_RE = re.compile(r'[^\w\s-]')
@@ -321,11 +322,10 @@ def _rst_to_html_filter(value):
 def key_from_list(list_of_args):
     """
     Builds a key from a list of arguments which could be used for caching
-    The key s constructed as an md5 hash
+    The key is constructed as a hash of the arguments, in which Tryton
+    records are represented by their model and id.
     """
-    hash = md5()
-    hash.update(repr(list_of_args))
-    return hash.hexdigest()
+    return make_key(*list_of_args)
 
 
 def get_website_from_host(http_host):
@@ -457,11 +457,33 @@ def route(rule, **options):
                 ...
                 return 'Product Information'
 
+    In addition to the options of werkzeug rules, the following options are
+    understood by nereid:
+
+    * `readonly`: Dispatch the request in a readonly transaction. By default
+      only GET and HEAD requests are readonly.
+    * `exempt_csrf`: Do not check the CSRF token of the request.
+    * `check_exists`: For instance methods, check that the record with the
+      `active_id` of the URL exists before calling the method and respond
+      with a 404 if it doesn't. Defaults to True.
+    * `retry`: The number of times the request is retried if the transaction
+      fails with a `DatabaseOperationalError`, for example on lock
+      contention. Defaults to the `retry` option of the `database` section
+      of the Tryton configuration.
+    * `cache_page`: Cache the whole response in the cache of the application.
+      It is either True, a timeout or a dictionary of options. See
+      :class:`~nereid.page_cache.PageCache`.
+    * `stream`: Stream the template rendered by the view to the client as it
+      is rendered, instead of rendering the whole page first. A view can
+      also set the `stream` attribute of the
+      :class:`~nereid.templating.LazyRenderer` it returns. See
+      :meth:`~nereid.application.Nereid.make_streamed_response`.
     """
     def decorator(f):
         if not hasattr(f, '_url_rules'):
             f._url_rules = []
         f._url_rules.append((rule, options))
+        register_decorated_method(f)
         return f
     return decorator
 
@@ -498,6 +520,7 @@ def context_processor(name=None):
         f._context_processor = True
         if name is not None:
             f.__name__ = name
+        register_decorated_method(f)
         return f
     return decorator
 
@@ -539,5 +562,6 @@ def template_filter(name=None):
         f._template_filter = True
         if name is not None:
             f.__name__ = name
+        register_decorated_method(f)
         return f
     return decorator
@@ -0,0 +1,241 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from hashlib import md5
+from time import time, sleep
+
+from flask.globals import session
+from werkzeug.datastructures import Headers
+from werkzeug.http import unquote_etag
+
+from .cache_utils import get_entry, set_entry, needs_refresh, \
+    acquire_lock, release_lock, get_tags, get_tag_versions, \
+    WAIT_TIMEOUT, WAIT_INTERVAL
+
+__all__ = ['PageCache']
+
+
+class PageCache(object):
+    """
+    A cache of full responses of the routes declared with the `cache_page`
+    option of :func:`~nereid.helpers.route`.
+
+    .. code-block:: python
+
+        @classmethod
+        @route('/catalogue/<uri>', cache_page=600)
+        def render_catalogue(cls, uri):
+            ...
+
+    The option can be `True` (use the default timeout of the cache), a
+    timeout in seconds, or a dictionary with the keys:
+
+        * `timeout`: The timeout in seconds
+        * `vary`: A list of request headers whose values are part of the key
+        * `vary_on_user`: If True, the pages of logged in users are cached
+          separately for each user. By default only the pages served to
+          anonymous users are cached.
+        * `serve_stale`: If True (the default), an expired page is served
+          to the other requests while a single request renders it again.
+          Otherwise the other requests wait for the new page.
+        * `tags`: A list of cache tags the page depends on, or a callable
+          returning them from the arguments of the view. The page is
+          rendered again when one of the tags is invalidated (see
+          :mod:`nereid.cache_utils`).
+
+    The status, headers and body of the response are stored in the cache of
+    the application, keyed by the host, locale, path and query string of the
+    request. A cached response is served by the dispatcher before any
+    transaction is started for the view, or a `304 Not Modified` response
+    if the request matches the ETag of the cached response.
+
+    A single request renders a missing or expired page, the other requests
+    for the page wait for it for at most
+    :data:`~nereid.cache_utils.WAIT_TIMEOUT` seconds before rendering it
+    themselves.
+
+    Responses rendered for a session which was modified, or which holds a
+    CSRF token (the token is rendered in the forms of the page), are not
+    stored.
+
+    .. versionadded:: 5.0.0.1
+    """
+
+    #: The prefix of the keys of the cached pages
+    key_prefix = 'nereid.page'
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def get_options(rule):
+        """
+        Return the page cache options of the rule as a dictionary, or None
+        if the pages of the rule are not cached.
+        """
+        options = getattr(rule, 'cache_page', None)
+        if not options:
+            return None
+        if options is True:
+            options = {}
+        elif not isinstance(options, dict):
+            options = {'timeout': options}
+        return {
+            'timeout': options.get('timeout'),
+            'vary': tuple(options.get('vary', ())),
+            'vary_on_user': options.get('vary_on_user', False),
+            'serve_stale': options.get('serve_stale', True),
+            'tags': options.get('tags'),
+        }
+
+    @staticmethod
+    def get_tags(req, options):
+        """
+        Return the list of cache tags of the page served to the request
+        """
+        return get_tags(options['tags'], kwargs=req.view_args)
+
+    def get_user_id(self, req):
+        """
+        Return the id of the user logged in the session of the request
+        without loading the user, or None for anonymous requests. Requests
+        which could be authenticated by a remember cookie or an authorization
+        header are not considered anonymous.
+        """
+        user_id = session.get('user_id')
+        if user_id is not None:
+            return user_id
+        remember_cookie = self.app.config.get(
+            'REMEMBER_COOKIE_NAME', 'remember_token'
+        )
+        if remember_cookie in req.cookies or \
+                'Authorization' in req.headers:
+            return False
+        return None
+
+    def get_key(self, req, options):
+        """
+        Return the cache key of the response to the request, or None if the
+        response must not be cached.
+        """
+        if req.method not in ('GET', 'HEAD'):
+            return None
+
+        user_id = self.get_user_id(req)
+        if user_id is not None and \
+                (user_id is False or not options['vary_on_user']):
+            return None
+
+        parts = [
+            req.host,
+            req.view_args.get('locale'),
+            req.path,
+            sorted(req.args.items(multi=True)),
+            [req.headers.get(header) for header in options['vary']],
+            user_id,
+        ]
+        return '%s:%s' % (
+            self.key_prefix, md5(repr(parts).encode('utf-8')).hexdigest()
+        )
+
+    def get(self, req):
+        """
+        Return the cached response to the request if there is one
+        """
+        options = self.get_options(req.url_rule)
+        if options is None:
+            return None
+        key = self.get_key(req, options)
+        if key is None:
+            return None
+        # The versions of the tags are read before the page is rendered, so
+        # that a page rendered from data changed meanwhile is invalid.
+        versions = req.page_cache_tags = get_tag_versions(
+            self.app.cache, self.get_tags(req, options)
+        )
+        entry = get_entry(self.app.cache, key)
+        if entry is not None and (entry.tags or {}) != versions:
+            # Invalidated pages are never served
+            entry = None
+        if entry is not None and not needs_refresh(entry):
+            return self.make_response(req, entry)
+
+        if acquire_lock(self.app.cache, key):
+            # This request renders the page, see :meth:`release`
+            req.page_cache_lock = key
+            return None
+
+        # Another request is rendering the page. Stale pages are served if
+        # allowed, or if the other request is only refreshing the page early.
+        expired = entry is not None and entry.expires is not None and \
+            entry.expires <= time()
+        if entry is not None and (options['serve_stale'] or not expired):
+            return self.make_response(req, entry)
+        waited = 0
+        while waited < WAIT_TIMEOUT:
+            sleep(WAIT_INTERVAL)
+            waited += WAIT_INTERVAL
+            new_entry = get_entry(self.app.cache, key)
+            if new_entry is not None and (
+                    entry is None or new_entry.expires != entry.expires) \
+                    and (new_entry.tags or {}) == versions:
+                return self.make_response(req, new_entry)
+        # Give up waiting and render the page
+        return None
+
+    def make_response(self, req, entry):
+        """
+        Return the response stored in the cache entry, or a `304 Not
+        Modified` response if the request matches its ETag.
+        """
+        status, headers, body = entry.value
+        headers = Headers(headers)
+        etag = headers.get('ETag')
+        if etag is not None and status == 200:
+            etag, weak = unquote_etag(etag)
+            if req.if_none_match.contains_weak(etag):
+                headers.remove('Content-Length')
+                return self.app.response_class(status=304, headers=headers)
+        return self.app.response_class(body, status=status, headers=headers)
+
+    def set(self, req, response):
+        """
+        Store the response to the request in the cache if the rule of the
+        request is cached and the response can be shared
+        """
+        options = self.get_options(req.url_rule)
+        if options is None:
+            return
+        key = self.get_key(req, options)
+        if key is None:
+            return
+        try:
+            if response.status_code != 200 or response.is_streamed or \
+                    'Set-Cookie' in response.headers:
+                return
+            if session.modified or 'csrf_token' in session:
+                # The page is specific to the session
+                return
+            set_entry(
+                self.app.cache, key,
+                (
+                    response.status_code,
+                    list(response.headers.items()),
+                    response.get_data(),
+                ),
+                options['timeout'],
+                stale_timeout=None if options['serve_stale'] else 0,
+                tags=getattr(req, 'page_cache_tags', None),
+            )
+        finally:
+            self.release(req)
+
+    def release(self, req):
+        """
+        Release the lock taken by :meth:`get` for the request to render the
+        page again, if any. The dispatcher calls it once the request is
+        dispatched, even if the view failed.
+        """
+        key = getattr(req, 'page_cache_lock', None)
+        if key is not None:
+            req.page_cache_lock = None
+            release_lock(self.app.cache, key)
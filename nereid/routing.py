@@ -11,8 +11,242 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import inspect
+import logging
+from collections import defaultdict
+from itertools import count
+from threading import Lock
+
 from werkzeug import routing
-from nereid import request
+
+from .globals import request
+
+
+#: The names of the methods decorated with :func:`~nereid.helpers.route`,
+#: :func:`~nereid.helpers.context_processor` or
+#: :func:`~nereid.helpers.template_filter` keyed by the python module and
+#: the qualified name of the class in which they are defined.
+_decorated_methods = defaultdict(set)
+
+#: Counter used to version the route registries
+_registry_version = count(1)
+
+
+def register_decorated_method(function):
+    """
+    Record a method decorated by one of the nereid decorators so that the
+    :class:`RouteRegistry` of a pool can find it without scanning all the
+    members of every model.
+
+    Functions which are not defined in a class are ignored.
+    """
+    owner, _, name = function.__qualname__.rpartition('.')
+    if owner and not owner.endswith('<locals>'):
+        _decorated_methods[(function.__module__, owner)].add(name)
+
+
+class RouteRegistry(object):
+    """
+    The URL rules, context processors and template filters declared with
+    the nereid decorators on the models of a Tryton pool.
+
+    The registry is built once per pool, from the methods recorded by the
+    decorators for the classes in the MRO of each model. Building a URL map
+    from the registry is then proportional to the number of rules and not to
+    the number of models and their members.
+
+    :param models: The dictionary of models of the pool
+    :param rule_class: The class used to create the URL rules
+    """
+
+    def __init__(self, models, rule_class):
+        #: The dictionary of models the registry was built from
+        self.models = models
+
+        #: A number which changes every time a registry is built, or the
+        #: rules of the application change. See :meth:`changed`.
+        self.version = next(_registry_version)
+
+        #: The unbound URL rules. Use :meth:`get_rules` to get rules which
+        #: can be added to a map.
+        self.rules = []
+
+        #: The endpoints of the rules which are exempted from CSRF checks
+        self.csrf_exempt = set()
+
+        #: The context processors by name
+        self.context_processors = {}
+
+        #: A list of name, function pairs of the template filters
+        self.template_filters = []
+
+        #: The dispatch table of the endpoints of the rules. See
+        #: :meth:`get_endpoint`
+        self.endpoints = {}
+
+        for model_name, model in models.items():
+            for f_name in self._get_decorated_methods(model):
+                f = getattr(model, f_name)
+                is_method = inspect.ismethod(f)
+                if not (is_method or inspect.isfunction(f)):
+                    continue
+
+                for rule in getattr(f, '_url_rules', []):
+                    rule_obj = rule_class(
+                        rule[0],
+                        endpoint='.'.join([model_name, f_name]),
+                        **rule[1]
+                    )
+                    self.rules.append(rule_obj)
+                    if rule_obj.is_csrf_exempt:
+                        self.csrf_exempt.add(rule_obj.endpoint)
+                    self.endpoints.setdefault(
+                        rule_obj.endpoint,
+                        self._get_dispatch_entry(model, f_name)
+                    )
+
+                if not is_method:
+                    continue
+                if hasattr(f, '_context_processor'):
+                    self.context_processors[f.__name__] = f
+                if hasattr(f, '_template_filter'):
+                    self.template_filters.append((f.__name__, f))
+
+    @staticmethod
+    def _get_decorated_methods(model):
+        """
+        Return the sorted names of the decorated methods defined in the
+        classes of the MRO of the model.
+        """
+        names = set()
+        for klass in model.__mro__:
+            names.update(_decorated_methods.get(
+                (klass.__module__, klass.__qualname__), ()
+            ))
+        return sorted(names)
+
+    @staticmethod
+    def _get_dispatch_entry(model, method):
+        """
+        Return a tuple of the model, the method and a boolean which is True
+        if the method must be called on an instance of the model.
+        """
+        meth = getattr(model, method)
+        if hasattr(meth, '__self__') or isinstance(
+            inspect.getattr_static(model, method), staticmethod
+        ):
+            # static or class method
+            return (model, meth, False)
+        return (model, meth, True)
+
+    def get_endpoint(self, endpoint):
+        """
+        Return the dispatch entry of the endpoint: a tuple of the model,
+        the method and a boolean which is True if the method is an instance
+        method.
+
+        The entries of the routes in the registry are computed when the
+        registry is built. The entries of other endpoints of the form
+        `model.method` are computed and stored on first use.
+        """
+        try:
+            return self.endpoints[endpoint]
+        except KeyError:
+            model_name, method = endpoint.rsplit('.', 1)
+            rv = self.endpoints[endpoint] = self._get_dispatch_entry(
+                self.models[model_name], method
+            )
+            return rv
+
+    def get_rules(self):
+        """
+        Return unbound copies of the URL rules which can be added to a new
+        URL map.
+        """
+        return [rule.empty() for rule in self.rules]
+
+    def changed(self):
+        """
+        Change the version of the registry, as when rules are added to the
+        URL map of the application, so that the URL maps built with the
+        rules are built again.
+        """
+        self.version = next(_registry_version)
+
+
+class UrlMapStore(object):
+    """
+    A process local store of compiled URL maps.
+
+    Every map is stored with a version and is rebuilt only when it is
+    requested with a different version. Unlike the Tryton cache, the store
+    is not cleared when the Tryton caches are reset, which keeps the
+    compiled URL matchers warm in the worker.
+
+    The number of rebuilds and hits are counted in :attr:`rebuilds` and
+    :attr:`hits`.
+    """
+
+    def __init__(self):
+        self._maps = {}
+        self._lock = Lock()
+        self.logger = logging.getLogger('nereid.routing')
+
+        #: The number of times a map was built
+        self.rebuilds = 0
+
+        #: The number of times a map was served from the store
+        self.hits = 0
+
+    def get(self, key, version, builder):
+        """
+        Return the map stored for the key if it has the given version.
+        Otherwise build a new map by calling builder and store it with the
+        version.
+
+        :param key: The key of the map, usually the id of the website
+        :param version: A hashable which changes if the map has to change
+        :param builder: A callable which returns a new map
+        """
+        entry = self._maps.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        with self._lock:
+            entry = self._maps.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+
+            url_map = builder()
+            # Sort and compile the rules now rather than on the first match
+            url_map.update()
+            self._maps[key] = (version, url_map)
+            self.rebuilds += 1
+
+        self.logger.info(
+            'Built URL map for %s (rebuild #%d, %d hits so far)',
+            key, self.rebuilds, self.hits
+        )
+        return url_map
+
+    def clear(self):
+        """
+        Remove all the maps from the store
+        """
+        with self._lock:
+            self._maps.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of the number of maps, rebuilds and hits
+        """
+        return {
+            'maps': len(self._maps),
+            'rebuilds': self.rebuilds,
+            'hits': self.hits,
+        }
 
 
 class Map(routing.Map):
@@ -45,6 +279,19 @@ class Rule(routing.Rule):
     def __init__(self, *args, **kwargs):
         self.readonly = kwargs.pop('readonly', None)
         self.is_csrf_exempt = kwargs.pop('exempt_csrf', False)
+        #: If False, the dispatcher does not check that the record of an
+        #: instance method exists before calling the method.
+        self.check_exists = kwargs.pop('check_exists', True)
+        #: The number of times the request is retried when the transaction
+        #: fails with an operational error. If None, the `retry` option of
+        #: the `database` section of the Tryton configuration is used.
+        self.retry = kwargs.pop('retry', None)
+        #: The options of the page cache of the rule. See
+        #: :class:`~nereid.page_cache.PageCache`.
+        self.cache_page = kwargs.pop('cache_page', None)
+        #: Stream the templates rendered by the view. See
+        #: :meth:`~nereid.application.Nereid.make_streamed_response`.
+        self.stream = kwargs.pop('stream', False)
         super(Rule, self).__init__(*args, **kwargs)
 
     def empty(self):
@@ -59,9 +306,24 @@ class Rule(routing.Rule):
         return self.__class__(
             self.rule, defaults, self.subdomain, self.methods,
             self.build_only, self.endpoint, self.strict_slashes,
-            self.redirect_to, self.alias, self.host
+            self.redirect_to, self.alias, self.host,
+            **self.get_nereid_options()
         )
 
+    def get_nereid_options(self):
+        """
+        Return the nereid specific options of the rule as keyword arguments
+        to create a copy of the rule.
+        """
+        return {
+            'readonly': self.readonly,
+            'exempt_csrf': self.is_csrf_exempt,
+            'check_exists': self.check_exists,
+            'retry': self.retry,
+            'cache_page': self.cache_page,
+            'stream': self.stream,
+        }
+
     @property
     def is_readonly(self):
         if self.readonly is not None:
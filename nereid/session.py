@@ -4,4 +4,4 @@ from warnings import warn
 warn(DeprecationWarning("Use nereid.sessions instead"))
 
 from .sessions import (Session, NullSession, MemcachedSessionStore,  # noqa
-    NereidSessionInterface)
+    NereidSessionInterface, LazySession)
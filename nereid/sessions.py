@@ -1,16 +1,92 @@
 # This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import pickle
 from datetime import datetime  # noqa
+from time import time
 
-from flask.sessions import SessionInterface, SessionMixin
+from flask.helpers import total_seconds
+from flask.sessions import SessionInterface, SessionMixin, \
+    session_json_serializer
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from werkzeug.contrib.sessions import Session as SessionBase, SessionStore
 from flask.globals import current_app
 
+try:
+    import redis
+except ImportError:
+    redis = None
+
 
 class Session(SessionBase, SessionMixin):
     "Nereid Default Session Object"
 
 
+class LazySession(Session):
+    """
+    A session which fetches its data from the session store only the first
+    time it is read or written. A session which is never used during a
+    request does not cost a round trip to the store, and since reading
+    does not modify it, a session which is only read is never saved.
+
+    :param store: The session store to load the session from
+    :param sid: The id of the session
+    :param on_load: A callable called once the session is loaded
+    """
+
+    def __init__(self, store, sid, on_load=None):
+        Session.__init__(self, {}, sid, False)
+        self.store = store
+        self.on_load = on_load
+        #: True once the data of the session is fetched from the store
+        self.is_loaded = False
+
+    def load(self):
+        """
+        Fetch the data of the session from the store if not done yet
+        """
+        if self.is_loaded:
+            return
+        self.is_loaded = True
+        stored = self.store.get(self.sid)
+        if stored.sid != self.sid:
+            # The store replaced an invalid sid with a new session
+            self.sid, self.new = stored.sid, True
+        # Bypass the modification tracking, loading is not a change
+        dict.update(self, stored)
+        # Keep the attributes the store sets on the sessions it loads
+        vars(self).update(
+            (key, value)
+            for key, value in getattr(stored, '__dict__', {}).items()
+            if key not in vars(self)
+        )
+        if self.on_load is not None:
+            self.on_load(self)
+
+
+def _load_first(name):
+    """
+    Return a method of :class:`LazySession` which loads the session before
+    calling the method of the same name of :class:`Session`
+    """
+    method = getattr(Session, name)
+
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for name in (
+        '__getitem__', '__setitem__', '__delitem__', '__contains__',
+        '__iter__', '__len__', '__eq__', '__ne__', '__repr__', 'get', 'keys',
+        'values', 'items', 'pop', 'popitem', 'setdefault', 'update', 'clear',
+        'copy'):
+    setattr(LazySession, name, _load_first(name))
+del name
+
+
 class NullSession(Session):
     """
     Class used to generate nicer error messages if sessions are not
@@ -33,23 +109,39 @@ class MemcachedSessionStore(SessionStore):
 
     :param session_class: The session class to use.
     Defaults to :class:`Session`.
+
+    .. versionchanged:: 5.0.0.1
+
+        The sessions are stored under keys prefixed with :attr:`key_prefix`,
+        which the :class:`~nereid.cache_backends.TwoTierCache` does not keep
+        in its local tier.
     """
+
+    #: The prefix of the keys of the sessions in the cache
+    key_prefix = 'nereid-session:'
+
     def __init__(self, session_class=Session):
         SessionStore.__init__(self, session_class)
 
+    def get_key(self, sid):
+        """
+        Returns the key of the session in the cache
+        """
+        return self.key_prefix + sid
+
     def save(self, session):
         """
         Updates the session
         """
         current_app.cache.set(
-            session.sid, dict(session), 30 * 24 * 60 * 60
+            self.get_key(session.sid), dict(session), 30 * 24 * 60 * 60
         )
 
     def delete(self, session):
         """
         Deletes the session
         """
-        current_app.cache.delete(session.sid)
+        current_app.cache.delete(self.get_key(session.sid))
 
     def get(self, sid):
         """
@@ -57,7 +149,7 @@ class MemcachedSessionStore(SessionStore):
         """
         if not self.is_valid_key(sid):
             return self.new()
-        session_data = current_app.cache.get(sid)
+        session_data = current_app.cache.get(self.get_key(sid))
         if session_data is None:
             session_data = {}
         return self.session_class(session_data, sid, False)
@@ -69,12 +161,218 @@ class MemcachedSessionStore(SessionStore):
         raise Exception("Not implemented yet")
 
 
+class RedisSessionStore(SessionStore):
+    """
+    Session store that keeps every session in a redis hash.
+
+    Every key of the session is a field of the hash, so that saving a
+    session only writes the keys which changed and deletes the keys which
+    were removed. The expiry of a session slides: it is refreshed when the
+    session is saved, and when it is read if it was not refreshed for
+    `refresh_interval` seconds, with a single pipelined round trip.
+
+    The ids of the sessions of a logged in user are kept in an index, so
+    that the sessions of a user can be listed with :meth:`list` and purged
+    with :meth:`purge_user` (on a password change for example).
+
+    The store is loaded by setting the `SESSION_STORE_TYPE` configuration
+    of the application to `nereid.sessions.RedisSessionStore`, and its
+    arguments in `SESSION_STORE_INIT_KWARGS`. Requires the `redis` package,
+    version 3.5 or later (the `redis` extra of nereid), unless a client is
+    given.
+
+    :param session_class: The session class to use.
+    :param client: A redis client. If None, a client is created from `url`.
+    :param url: The url of the redis server
+    :param key_prefix: The prefix of the keys of the sessions
+    :param expiry: The number of seconds after which an unused session
+                   expires
+    :param refresh_interval: The minimum number of seconds between two
+                             refreshes of the expiry of a session which is
+                             only read
+    :param user_key: The key of the session which holds the id of the user
+    """
+
+    #: The field of the hash which holds the time of the last refresh
+    refreshed_field = '__refreshed__'
+
+    def __init__(self, session_class=Session, client=None,
+                 url='redis://localhost:6379/0', key_prefix='nereid-session:',
+                 expiry=30 * 24 * 60 * 60, refresh_interval=60 * 60,
+                 user_key='user_id'):
+        SessionStore.__init__(self, session_class)
+        if client is None:
+            if redis is None:
+                raise RuntimeError(
+                    'The redis package is required by RedisSessionStore'
+                )
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.key_prefix = key_prefix
+        self.index_prefix = key_prefix.rstrip(':') + '-user:'
+        self.expiry = expiry
+        self.refresh_interval = refresh_interval
+        self.user_key = user_key
+
+    def get_key(self, sid):
+        """
+        Returns the redis key of the session with the given id
+        """
+        return self.key_prefix + sid
+
+    def get_index_key(self, user_id):
+        """
+        Returns the redis key of the index of the sessions of the user
+        """
+        return '%s%s' % (self.index_prefix, user_id)
+
+    def get(self, sid):
+        """
+        Returns session
+        """
+        if not self.is_valid_key(sid):
+            return self.new()
+        fields = self.client.hgetall(self.get_key(sid))
+        refreshed = fields.pop(self.refreshed_field.encode('utf-8'), None)
+
+        stored_fields, data = {}, {}
+        for name, value in fields.items():
+            name = name.decode('utf-8')
+            stored_fields[name] = value
+            data[name] = pickle.loads(value)
+
+        # Sessions never refreshed are refreshed at once
+        refreshed = float(refreshed or 0)
+        if fields and time() - refreshed > self.refresh_interval:
+            self.refresh(sid)
+
+        session = self.session_class(data, sid, False)
+        #: The pickled values as stored in redis, to find the changed keys
+        session.stored_fields = stored_fields
+        return session
+
+    def refresh(self, sid, pipeline=None):
+        """
+        Slide the expiry of the session
+        """
+        pipe = pipeline or self.client.pipeline()
+        key = self.get_key(sid)
+        pipe.hset(key, self.refreshed_field, time())
+        pipe.expire(key, self.expiry)
+        if pipeline is None:
+            pipe.execute()
+
+    def save(self, session):
+        """
+        Writes the changed keys of the session and refreshes its expiry
+        """
+        key = self.get_key(session.sid)
+        stored_fields = getattr(session, 'stored_fields', None) or {}
+
+        changed = {}
+        for name, value in dict.items(session):
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if stored_fields.get(name) != pickled:
+                changed[name] = pickled
+        removed = [name for name in stored_fields if name not in session]
+
+        pipe = self.client.pipeline()
+        if removed:
+            pipe.hdel(key, *removed)
+        if changed:
+            pipe.hset(key, mapping=changed)
+        self.refresh(session.sid, pipeline=pipe)
+
+        previous_user = stored_fields.get(self.user_key)
+        if previous_user is not None:
+            previous_user = pickle.loads(previous_user)
+        user_id = dict.get(session, self.user_key)
+        if previous_user is not None and previous_user != user_id:
+            pipe.srem(self.get_index_key(previous_user), session.sid)
+        if user_id is not None:
+            index_key = self.get_index_key(user_id)
+            pipe.sadd(index_key, session.sid)
+            pipe.expire(index_key, self.expiry)
+        pipe.execute()
+
+        stored_fields.update(changed)
+        for name in removed:
+            del stored_fields[name]
+        session.stored_fields = stored_fields
+
+    def delete(self, session):
+        """
+        Deletes the session
+        """
+        pipe = self.client.pipeline()
+        pipe.delete(self.get_key(session.sid))
+        user_id = dict.get(session, self.user_key)
+        if user_id is not None:
+            pipe.srem(self.get_index_key(user_id), session.sid)
+        pipe.execute()
+
+    def list(self, user_id=None):
+        """
+        Lists the ids of the sessions in the store, or only those of the
+        given user
+        """
+        if user_id is not None:
+            return [
+                sid.decode('utf-8') for sid in
+                self.client.smembers(self.get_index_key(user_id))
+            ]
+        prefix_length = len(self.key_prefix)
+        return [
+            key.decode('utf-8')[prefix_length:] for key in
+            self.client.scan_iter(match=self.key_prefix + '*')
+        ]
+
+    def purge_user(self, user_id):
+        """
+        Deletes all the sessions of the user and returns their number
+        """
+        index_key = self.get_index_key(user_id)
+        sids = self.client.smembers(index_key)
+        pipe = self.client.pipeline()
+        for sid in sids:
+            pipe.delete(self.get_key(sid.decode('utf-8')))
+        pipe.delete(index_key)
+        pipe.execute()
+        return len(sids)
+
+
 class NereidSessionInterface(SessionInterface):
     """Session Management Class"""
 
     session_store = MemcachedSessionStore()
     null_session_class = NullSession
 
+    #: Open the sessions of requests with a session cookie as
+    #: :class:`LazySession`, which are fetched from the store on first use.
+    lazy = True
+
+    def __init__(self):
+        #: The number of sessions opened from a cookie, and the number of
+        #: them which were fetched from the store. See :meth:`get_stats`.
+        self.opened = 0
+        self.loaded = 0
+
+    def _session_loaded(self, session):
+        self.loaded += 1
+
+    def get_stats(self):
+        """
+        Return a dictionary with the number of sessions opened from a cookie,
+        the number of them loaded from the store, and the number of requests
+        which avoided the round trip to the store.
+        """
+        opened, loaded = self.opened, self.loaded
+        return {
+            'opened': opened,
+            'loaded': loaded,
+            'skipped': opened - loaded,
+        }
+
     def open_session(self, app, request):
         """
         Creates or opens a new session.
@@ -82,10 +380,14 @@ class NereidSessionInterface(SessionInterface):
         :param request: an instance of :attr:`request_class`.
         """
         sid = request.cookies.get(app.session_cookie_name, None)
-        if sid:
-            return self.session_store.get(sid)
-        else:
+        if not sid:
             return self.session_store.new()
+        if not self.lazy:
+            return self.session_store.get(sid)
+        self.opened += 1
+        return LazySession(
+            self.session_store, sid, on_load=self._session_loaded
+        )
 
     def save_session(self, app, session, response):
         """
@@ -110,3 +412,150 @@ class NereidSessionInterface(SessionInterface):
                     app.session_cookie_name, session.sid,
                     expires=expires, httponly=False, domain=domain
                 )
+
+    def prepare_streamed_session(self, app, session, request):
+        """
+        Prepares the session of a streamed response, which is saved with the
+        headers before the body is generated. Returns False if the changes
+        made to the session while the body is generated could not be saved
+        once it is sent, because they would need a new cookie.
+
+        A session without a cookie is saved with the headers if it holds
+        values, so that its cookie is sent and the later changes are saved in
+        the store. An empty session is not saved, and False is returned as
+        the changes made to it would need its cookie.
+
+        .. versionadded:: 5.0.0.1
+        """
+        if session.sid is None:
+            return False
+        if request.cookies.get(app.session_cookie_name, None) != session.sid:
+            if not session and not session.modified:
+                return False
+            session.modified = True
+        return True
+
+
+class ClientSessionInterface(NereidSessionInterface):
+    """
+    A session interface which keeps small sessions in a signed cookie, so
+    that most requests cost no round trip to the session store.
+
+    The cookie is signed with the `secret_key` of the application and
+    compressed when that makes it shorter. A session which does not fit in
+    `max_cookie_size` bytes, or which holds values that cannot be
+    serialised to JSON, is saved in the :attr:`session_store` instead and
+    the cookie only holds its id, like with :class:`NereidSessionInterface`.
+    A session saved in the store stays there.
+
+    To use it, set the session interface of the application:
+
+    .. code-block:: python
+
+        app.session_interface = ClientSessionInterface()
+
+    .. versionadded:: 5.0.0.1
+    """
+
+    #: The maximum size of the value of the cookie. Browsers limit cookies
+    #: to about 4kb including the name and attributes.
+    max_cookie_size = 3072
+
+    #: The salt of the signature of the cookie
+    salt = 'nereid-session'
+
+    def __init__(self, max_cookie_size=None):
+        super(ClientSessionInterface, self).__init__()
+        if max_cookie_size is not None:
+            self.max_cookie_size = max_cookie_size
+        #: The number of sessions opened from a signed cookie
+        self.client_opened = 0
+
+    def get_serializer(self, app):
+        """
+        Returns the serializer of the cookies of the application. The
+        values are serialised with the tagged JSON serializer of Flask, like
+        the cookies of its `SecureCookieSessionInterface`, so that tuples,
+        bytes, markup and datetimes are kept.
+        """
+        return URLSafeTimedSerializer(
+            app.secret_key, salt=self.salt,
+            serializer=session_json_serializer
+        )
+
+    def get_stats(self):
+        """
+        Returns the statistics of :meth:`NereidSessionInterface.get_stats`
+        and the number of sessions opened from a signed cookie.
+        """
+        rv = super(ClientSessionInterface, self).get_stats()
+        rv['client'] = self.client_opened
+        return rv
+
+    def open_session(self, app, request):
+        """
+        Opens the session from the signed cookie or from the session store
+        if the cookie holds the id of a session.
+        """
+        value = request.cookies.get(app.session_cookie_name, None)
+        if not value or '.' not in value:
+            # Ids of the sessions in the store are never dotted
+            return super(ClientSessionInterface, self).open_session(
+                app, request
+            )
+        try:
+            data = self.get_serializer(app).loads(
+                value, max_age=total_seconds(app.permanent_session_lifetime)
+            )
+        except BadSignature:
+            return self.session_store.new()
+        self.client_opened += 1
+        return self.session_store.session_class(data, None, False)
+
+    def prepare_streamed_session(self, app, session, request):
+        """
+        Returns False unless the session is in the session store, as the
+        changes of a session kept in the cookie need a new cookie.
+        """
+        if session.sid is None or session.new:
+            return False
+        return super(ClientSessionInterface, self).prepare_streamed_session(
+            app, session, request
+        )
+
+    def save_session(self, app, session, response):
+        """
+        Saves the session in the cookie if it is small enough, or in the
+        session store otherwise.
+        """
+        if not session.should_save:
+            return
+        if session.sid is not None and not session.new:
+            # Already in the store
+            return super(ClientSessionInterface, self).save_session(
+                app, session, response
+            )
+
+        domain = self.get_cookie_domain(app)
+        if not session:
+            response.delete_cookie(app.session_cookie_name, domain=domain)
+            return
+
+        try:
+            value = self.get_serializer(app).dumps(dict(session))
+        except TypeError:
+            value = None
+        if value is None or len(value) > self.max_cookie_size:
+            if session.sid is None:
+                session.sid = self.session_store.generate_key()
+            return super(ClientSessionInterface, self).save_session(
+                app, session, response
+            )
+
+        response.set_cookie(
+            app.session_cookie_name, value,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            domain=domain, path=self.get_cookie_path(app),
+        )
@@ -22,7 +22,23 @@ logout = _signals.signal('logout')
 registration = _signals.signal('registration')
 
 
+#: Triggered when the transaction of a view starts and stops. The receivers
+#: get the number of seconds the transaction waited for a connection
+#: (`wait_time`) and a snapshot of the statistics of the connection pool
+#: (`pool_stats`), both None without a pool. See
+#: :meth:`~nereid.application.Nereid.get_transaction_signal_kwargs`.
 transaction_start = _signals.signal('nereid.transaction.start')
 transaction_stop = _signals.signal('nereid.transaction.stop')
 # transaction_commit is triggered when transaction successfully ends
 transaction_commit = _signals.signal('nereid.transaction.commit')
+
+#: Triggered before a request is retried after its transaction failed with a
+#: `DatabaseOperationalError`. The receivers get the number of the `attempt`
+#: about to start (1 for the first retry) and the `delay` in seconds waited
+#: before it.
+transaction_retry = _signals.signal('nereid.transaction.retry')
+#: Triggered when a request gives up after all the retries of its
+#: transaction failed. The receivers get the number of `attempts` made.
+transaction_retry_exhausted = _signals.signal(
+    'nereid.transaction.retry-exhausted'
+)
@@ -4,10 +4,15 @@
 import os
 from contextlib import ExitStack
 from decimal import Decimal
+from threading import Lock
+from time import time
 
+from flask.ctx import has_request_context
+from flask.signals import before_render_template, template_rendered
 from flask.templating import render_template as flask_render_template
 from jinja2 import (BaseLoader, TemplateNotFound, nodes, Template,  # noqa
         ChoiceLoader, FileSystemLoader, BaseLoader)
+from jinja2.loaders import split_template_path
 from speaklater import _LazyString
 from jinja2.ext import Extension
 from email.mime.multipart import MIMEMultipart
@@ -17,8 +22,10 @@ from email import encoders, charset
 import trytond.tools as tools
 from trytond.transaction import Transaction
 
-from .globals import request, current_app, current_website  # noqa
+from .globals import request, current_app, current_website, \
+    current_locale, current_user  # noqa
 from .helpers import _rst_to_html_filter, make_crumbs
+from .cache_utils import cached_call, get_tags, make_key
 
 
 # Override python's weird assumption that utf-8 text should be encoded with
@@ -58,6 +65,19 @@ class LazyRenderer(_LazyString):
     >>> lazy_render_object.sattus = 201
     >>> lazy_render_object.headers['X-Some-Header'] = 'header value'
 
+    A view which knows a cheap version of what it renders (like the
+    `write_date` of a record) can set it as the ETag of the response. The
+    dispatcher then answers a matching `If-None-Match` with a 304 without
+    rendering the template.
+
+    >>> lazy_render_object.etag = '%d-%s' % (product.id, product.write_date)
+
+    A large page can be streamed to the client as it is rendered, the
+    transaction of the request is then kept open until the template is
+    fully rendered.
+
+    >>> lazy_render_object.stream = True
+
     .. note::
 
         If the template renders objects which depend on the application,
@@ -65,7 +85,10 @@ class LazyRenderer(_LazyString):
         the call must be made within those contexts.
     """
 
-    __slots__ = ('template_name_or_list', 'context', 'headers', 'status')
+    __slots__ = (
+        'template_name_or_list', 'context', 'headers', 'status', 'etag',
+        'stream',
+    )
 
     def __init__(
         self, template_name_or_list, context, headers=None, eager=False
@@ -85,6 +108,11 @@ class LazyRenderer(_LazyString):
         self.context = context
         self.headers = {}
         self.status = 200
+        #: The validator of the rendered content. See
+        #: :meth:`~nereid.application.Nereid.make_lazy_response`
+        self.etag = None
+        #: Stream the template to the client as it is rendered
+        self.stream = False
         if eager:
             self.render()
 
@@ -103,17 +131,52 @@ class LazyRenderer(_LazyString):
             self.template_name_or_list, **self.context
         )
 
+    def generate(self, buffer_size=None):
+        """
+        Return an iterator of the chunks of the rendered template with the
+        current context, rendered as they are consumed.
+
+        :param buffer_size: If set, the chunks are buffered and yielded by
+                            groups of this number of template events.
+
+        The `before_render_template` and `template_rendered` signals of
+        Flask are sent as in :meth:`render`, the latter once the template is
+        fully rendered.
+
+        .. versionadded:: 5.0.0.1
+        """
+        app = current_app._get_current_object()
+        context = dict(self.context)
+        app.update_template_context(context)
+        template = app.jinja_env.get_or_select_template(
+            self.template_name_or_list
+        )
+        before_render_template.send(app, template=template, context=context)
+        stream = template.stream(context)
+        if buffer_size:
+            stream.enable_buffering(buffer_size)
+
+        def generate():
+            for chunk in stream:
+                yield chunk
+            template_rendered.send(app, template=template, context=context)
+        return generate()
+
     def __getstate__(self):
         return (
             self.template_name_or_list,
             self.context,
             self.headers,
             self.status,
+            self.etag,
+            self.stream,
         )
 
     def __setstate__(self, tup):
-        self.template_name_or_list, self.context, \
-                self.headers, self.status = tup
+        # Pickled before the etag or stream were added
+        tup = tup + (None, False)[len(tup) - 4:]
+        (self.template_name_or_list, self.context,
+            self.headers, self.status, self.etag, self.stream) = tup
 
 
 def render_template(template_name_or_list, **context):
@@ -138,11 +201,12 @@ def render_template(template_name_or_list, **context):
             '/'.join([current_website.name, template_name_or_list]),
             template_name_or_list
         ]
-    return LazyRenderer(
+    rv = LazyRenderer(
         template_name_or_list,
         context,
         eager=current_app.eager_template_render
     )
+    return rv
 
 
 def nereid_default_template_ctx_processor():
@@ -180,12 +244,141 @@ class ModuleTemplateLoader(ChoiceLoader):
     .. versionchanged:: 2.8.0.6
 
         Does not accept prefixing of site name anymore
+
+    .. versionchanged:: 5.0.0.1
+
+        The templates of the filesystem loaders are indexed once by name,
+        so that resolving a template (or failing to, like the lookups of
+        templates prefixed by the website name) does not probe every
+        folder. In debug mode (when the environment reloads templates) the
+        index is rebuilt when a folder changes.
     '''
+
+    #: The minimum number of seconds between two checks of the folders of
+    #: the index for changes when templates are reloaded
+    check_interval = 1
+
     def __init__(
             self, database_name=None, searchpath=None):
         self.database_name = database_name
         self.searchpath = searchpath
         self._loaders = None
+        self._index = None
+        self._index_lock = Lock()
+        self._checked_at = 0
+
+        #: The number of lookups served by the index and of the lookups of
+        #: templates which do not exist
+        self.stats = {'hits': 0, 'misses': 0, 'builds': 0}
+
+    def build_index(self):
+        """
+        Index the templates of the filesystem loaders by name. Returns a
+        tuple of the index, a dictionary of template names to a tuple of the
+        loader, the filename and its modification time, and of a dictionary
+        of the modification times of the folders walked.
+        """
+        index = {}
+        folders = {}
+        for loader in self.loaders:
+            if not isinstance(loader, FileSystemLoader):
+                continue
+            for searchpath in loader.searchpath:
+                walk = os.walk(searchpath, followlinks=loader.followlinks)
+                for dirpath, _, filenames in walk:
+                    folders[dirpath] = os.path.getmtime(dirpath)
+                    prefix = os.path.relpath(dirpath, searchpath)
+                    for filename in filenames:
+                        name = os.path.normpath(
+                            os.path.join(prefix, filename)
+                        ).replace(os.path.sep, '/')
+                        if name in index:
+                            # The first loader has precedence
+                            continue
+                        path = os.path.join(dirpath, filename)
+                        index[name] = (loader, path, os.path.getmtime(path))
+        self.stats['builds'] += 1
+        return index, folders
+
+    def folders_changed(self, folders):
+        for folder, mtime in folders.items():
+            try:
+                if os.path.getmtime(folder) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def get_index(self, environment):
+        """
+        Returns the index of the templates, building it if required
+        """
+        with self._index_lock:
+            if self._index is not None and environment.auto_reload and \
+                    time() - self._checked_at >= self.check_interval:
+                self._checked_at = time()
+                if self.folders_changed(self._index[1]):
+                    self._index = None
+            if self._index is None:
+                self._index = self.build_index()
+                self._checked_at = time()
+            return self._index[0]
+
+    def get_source(self, environment, template):
+        index = self.get_index(environment)
+        name = '/'.join(split_template_path(template))
+        entry = index.get(name)
+
+        for loader in self.loaders:
+            if entry is not None and loader is entry[0]:
+                source = self._get_indexed_source(entry)
+                if source is not None:
+                    self.stats['hits'] += 1
+                    return source
+                # The file was removed since the index was built
+                return ChoiceLoader.get_source(self, environment, template)
+            if isinstance(loader, FileSystemLoader):
+                # Indexed, the template is not in this loader
+                continue
+            try:
+                return loader.get_source(environment, template)
+            except TemplateNotFound:
+                pass
+        self.stats['misses'] += 1
+        raise TemplateNotFound(template)
+
+    def load(self, environment, name, globals=None):
+        # ChoiceLoader loads from every loader in turn, load from the source
+        # resolved by the index instead
+        return BaseLoader.load(self, environment, name, globals)
+
+    @staticmethod
+    def _get_indexed_source(entry):
+        loader, filename, _ = entry
+        try:
+            with open(filename, 'rb') as f:
+                contents = f.read().decode(loader.encoding)
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            return None
+
+        def uptodate():
+            try:
+                return os.path.getmtime(filename) == mtime
+            except OSError:
+                return False
+        return contents, filename, uptodate
+
+    def list_templates(self):
+        found = set()
+        with self._index_lock:
+            if self._index is None:
+                self._index = self.build_index()
+            found.update(self._index[0])
+        for loader in self.loaders:
+            if not isinstance(loader, FileSystemLoader):
+                found.update(loader.list_templates())
+        return sorted(found)
 
     @property
     def loaders(self):
@@ -252,16 +445,55 @@ class ModuleTemplateLoader(ChoiceLoader):
 
 
 class FragmentCacheExtension(Extension):
+    """
+    Caches the rendered fragments of templates in the `{% cache %}` tag::
+
+        {% cache 'categories', 600 %}
+            ...
+        {% endcache %}
+
+    The key of a fragment is scoped by the current website and locale
+    automatically. The optional arguments, given as keywords or, for the
+    timeout and the tags, positionally after the name, are:
+
+        * `timeout`: The number of seconds for which the fragment is cached
+        * `tags`: A list of cache tags the fragment depends on (see
+          :mod:`nereid.cache_utils`)
+        * `vary`: A list of values which are part of the key
+        * `vary_on_login`: If True, the fragments rendered for anonymous and
+          logged in users are cached separately
+
+    ::
+
+        {% cache 'product', 600, vary=[product.id], vary_on_login=True %}
+            ...
+        {% endcache %}
+
+    The hits and misses of every fragment name are counted in the
+    `fragment_cache_stats` attribute of the environment.
+
+    .. versionchanged:: 5.0.0.1
+        Keys are scoped by website and locale, and the `tags`, `vary` and
+        `vary_on_login` arguments were added.
+    """
     # a set of names that trigger the extension.
     tags = set(['cache'])
 
+    #: The options of the tag, in the order of the arguments of
+    #: :meth:`_cache_support`
+    options = ('timeout', 'tags', 'vary', 'vary_on_login')
+
+    #: The options which can be given as positional arguments
+    positional_options = ('timeout', 'tags')
+
     def __init__(self, environment):
         super(FragmentCacheExtension, self).__init__(environment)
 
         # add the defaults to the environment
         environment.extend(
             fragment_cache_prefix='',
-            fragment_cache=None
+            fragment_cache=None,
+            fragment_cache_stats={},
         )
 
     def parse(self, parser):
@@ -269,17 +501,30 @@ class FragmentCacheExtension(Extension):
         # we only listen to ``'cache'`` so this will be a name token with
         # `cache` as value.  We get the line number so that we can give
         # that line number to the nodes we create by hand.
-        lineno = parser.stream.next().lineno
+        lineno = next(parser.stream).lineno
 
         # now we parse a single expression that is used as cache key.
-        args = [parser.parse_expression()]
-
-        # if there is a comma, the user provided a timeout.  If not use
-        # None as second parameter.
-        if parser.stream.skip_if('comma'):
-            args.append(parser.parse_expression())
-        else:
-            args.append(nodes.Const(None))
+        name = parser.parse_expression()
+
+        # the other arguments are either positional (the timeout, then the
+        # tags) or keywords.  The missing ones are None.
+        values = dict((option, nodes.Const(None)) for option in self.options)
+        positional = list(self.positional_options)
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.type == 'name' and \
+                    parser.stream.look().type == 'assign':
+                option = next(parser.stream).value
+                if option not in self.options:
+                    parser.fail(
+                        'Unknown option %r of the cache tag' % option, lineno
+                    )
+                next(parser.stream)
+                values[option] = parser.parse_expression()
+            elif positional:
+                values[positional.pop(0)] = parser.parse_expression()
+            else:
+                parser.fail('Too many arguments to the cache tag', lineno)
+        args = [name] + [values[option] for option in self.options]
 
         # now we parse the body of the cache block up to `endcache` and
         # drop the needle (which would always be `endcache` in that case)
@@ -290,18 +535,45 @@ class FragmentCacheExtension(Extension):
         return nodes.CallBlock(self.call_method('_cache_support', args),
                                [], [], body).set_lineno(lineno)
 
-    def _cache_support(self, name, timeout, caller):
+    def get_scope(self, vary_on_login=False):
+        """
+        Returns the parts of the key of a fragment which depend on the
+        request: the website, the locale and, if `vary_on_login` is True,
+        whether the user is logged in.
+        """
+        if not has_request_context():
+            return []
+        scope = [current_website.id, current_locale.id]
+        if vary_on_login:
+            scope.append(not current_user.is_anonymous)
+        return scope
+
+    def _cache_support(self, name, timeout, tags, vary, vary_on_login,
+                       caller):
         """Helper callback."""
-        key = self.environment.fragment_cache_prefix + name
+        key = self.environment.fragment_cache_prefix + name + ':' + make_key(
+            self.get_scope(vary_on_login), vary
+        )
+
+        rendered = []
+
+        def render():
+            rendered.append(True)
+            return caller()
 
         # try to load the block from the cache
         # if there is no fragment in the cache, render it and store
-        # it in the cache.
-        rv = self.environment.fragment_cache.get(key)
-        if rv is not None:
-            return rv
-        rv = caller()
-        self.environment.fragment_cache.add(key, rv, timeout)
+        # it in the cache. A single worker renders an expired fragment
+        # while the others are served the stale one.
+        rv = cached_call(
+            self.environment.fragment_cache, key, render, timeout,
+            serve_stale=True, tags=get_tags(tags)
+        )
+
+        stats = self.environment.fragment_cache_stats.setdefault(
+            name, {'hits': 0, 'misses': 0}
+        )
+        stats['misses' if rendered else 'hits'] += 1
         return rv
 
 
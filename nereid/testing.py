@@ -62,7 +62,9 @@ class NereidTestApp(Nereid):
         req.view_args.pop('locale', None)
         active_id = req.view_args.pop('active_id', None)
 
-        return self._dispatch_request(req, locale.language.code, active_id)
+        return self._dispatch_request(
+            req, website.get_locale_language(locale), active_id
+        )
 
 
 def get_app(**options):
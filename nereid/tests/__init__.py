@@ -2,10 +2,17 @@
 # this repository contains the full copyright notices and license terms.
 import unittest
 
-from .test_templates import TestTemplateLoading, TestLazyRendering
+from .test_templates import TestTemplateLoading, TestLazyRendering, \
+    TestTemplateIndex
 from .test_helpers import TestURLfor, TestHelperFunctions
 from .test_signals import SignalsTestCase
 from .test_pagination import TestPagination
+from .test_backend import TestReplicaRouter, TestTransactionStream
+from .test_sessions import TestLazySession, TestRedisSessionStore, \
+    TestClientSessionInterface
+from .test_cache_backends import TestTwoTierCache, TestStampedeProtection, \
+    TestCacheTags, TestMemoize, TestFragmentCache
+from .test_dispatch import suite as dispatch_suite
 
 
 def suite():
@@ -14,9 +21,24 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestTemplateLoading),
         unittest.TestLoader().loadTestsFromTestCase(TestLazyRendering),
+        unittest.TestLoader().loadTestsFromTestCase(TestTemplateIndex),
         unittest.TestLoader().loadTestsFromTestCase(TestURLfor),
         unittest.TestLoader().loadTestsFromTestCase(TestHelperFunctions),
         unittest.TestLoader().loadTestsFromTestCase(SignalsTestCase),
         unittest.TestLoader().loadTestsFromTestCase(TestPagination),
+        unittest.TestLoader().loadTestsFromTestCase(TestReplicaRouter),
+        unittest.TestLoader().loadTestsFromTestCase(TestTransactionStream),
+        unittest.TestLoader().loadTestsFromTestCase(TestLazySession),
+        unittest.TestLoader().loadTestsFromTestCase(TestRedisSessionStore),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestClientSessionInterface
+        ),
+        unittest.TestLoader().loadTestsFromTestCase(TestTwoTierCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestStampedeProtection),
+        unittest.TestLoader().loadTestsFromTestCase(TestCacheTags),
+        unittest.TestLoader().loadTestsFromTestCase(TestMemoize),
+        unittest.TestLoader().loadTestsFromTestCase(TestFragmentCache),
+        # The dispatcher tests commit and drop the database, run them last
+        dispatch_suite(),
     ])
     return test_suite
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+from time import time
+
+import mock
+from flask import Flask
+from jinja2 import Environment, TemplateSyntaxError
+from trytond.model import Model
+from werkzeug.contrib.cache import SimpleCache, NullCache
+from nereid.helpers import key_from_list
+from nereid.cache_backends import TwoTierCache
+from nereid.sessions import MemcachedSessionStore
+from nereid.cache_utils import CacheEntry, cached_call, acquire_lock, \
+    get_entry, get_tags, get_tag_versions, invalidate_tags, model_tags, \
+    make_key, memoize, memoize_many
+
+
+class TestTwoTierCache(unittest.TestCase):
+    """
+    Test the two tier cache with two caches sharing a backend like two
+    processes would
+    """
+
+    def setUp(self):
+        self.shared = SimpleCache()
+        self.cache1 = TwoTierCache(self.shared, check_interval=0)
+        self.cache2 = TwoTierCache(self.shared, check_interval=0)
+
+    def test_0010_local_hits(self):
+        self.cache1.set('a', 1)
+        self.assertEqual(self.cache1.get('a'), 1)
+        self.assertEqual(self.cache1.stats['local']['hits'], 1)
+        self.assertEqual(self.cache1.stats['shared']['hits'], 0)
+
+        # The other process fetches the key once from the shared cache
+        self.assertEqual(self.cache2.get('a'), 1)
+        self.assertEqual(self.cache2.get('a'), 1)
+        self.assertEqual(self.cache2.stats, {
+            'local': {'hits': 1, 'misses': 1},
+            'shared': {'hits': 1, 'misses': 0},
+        })
+
+        self.assertEqual(self.cache2.get_many('a', 'b'), [1, None])
+        self.assertEqual(self.cache2.stats['shared']['misses'], 1)
+
+    def test_0020_writes_propagate(self):
+        self.cache1.set('a', 1)
+        self.assertEqual(self.cache2.get('a'), 1)
+
+        self.cache1.set('a', 2)
+        self.assertEqual(self.cache2.get('a'), 2)
+
+        self.cache1.delete('a')
+        self.assertEqual(self.cache2.get('a'), None)
+
+        self.cache1.set_many({'a': 3, 'b': 4})
+        self.assertEqual(self.cache2.get_many('a', 'b'), [3, 4])
+        self.cache1.clear()
+        self.assertEqual(self.cache2.get('b'), None)
+
+    def test_0030_check_interval(self):
+        cache = TwoTierCache(self.shared, check_interval=60)
+        self.cache1.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+        # Within the interval the local value is served
+        self.cache1.set('a', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        # but a local write still sees its own value
+        cache.set('a', 3)
+        self.assertEqual(cache.get('a'), 3)
+
+    def test_0040_exclude(self):
+        cache = TwoTierCache(self.shared, check_interval=60, exclude=['s:'])
+        cache.set('s:1', 1)
+        cache.get('s:1')
+        self.assertEqual(cache.stats['local'], {'hits': 0, 'misses': 0})
+
+        self.shared.set('s:1', 2)
+        self.assertEqual(cache.get('s:1'), 2)
+
+    def test_0050_lru(self):
+        cache = TwoTierCache(self.shared, local_threshold=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(list(cache._local), ['a', 'c'])
+
+    def test_0060_changed_keys_only(self):
+        self.cache1.set_many({'a': 1, 'b': 2})
+        self.assertEqual(self.cache2.get_many('a', 'b'), [1, 2])
+
+        # A write costs a single round trip
+        with mock.patch.object(
+                self.shared, 'set_many', wraps=self.shared.set_many) as \
+                set_many, \
+                mock.patch.object(self.shared, 'inc') as inc:
+            self.cache1.set('a', 3)
+        set_many.assert_called_once_with(mock.ANY, None)
+        self.assertFalse(inc.called)
+
+        # and only invalidates the key written in the other processes
+        self.assertEqual(self.cache2.get('b'), 2)
+        self.assertEqual(self.cache2.stats['local']['hits'], 1)
+        self.assertEqual(self.cache2.get('a'), 3)
+        self.assertEqual(self.cache2.stats['local']['misses'], 3)
+
+        self.cache1.delete('b')
+        self.assertEqual(self.cache2.get('b'), None)
+        self.assertEqual(self.cache2.get('a'), 3)
+
+        # Values without a stamp are not kept locally
+        self.cache1.add('lock', 1)
+        self.assertEqual(self.cache2.get('lock'), 1)
+        self.cache1.delete('lock')
+        self.assertEqual(self.cache2.get('lock'), None)
+        self.cache1.set('counter', 1)
+        self.assertEqual(self.cache2.get('counter'), 1)
+        self.cache1.inc('counter')
+        self.assertEqual(self.cache2.get('counter'), 2)
+
+    def test_0070_mutable_values(self):
+        self.cache1.set('a', {'items': [1]})
+        value = self.cache1.get('a')
+        value['items'].append(2)
+        self.assertEqual(self.cache1.get('a'), {'items': [1]})
+
+    def test_0080_sessions(self):
+        """
+        A session saved by a process is read by the others at once
+        """
+        cache1 = TwoTierCache(self.shared, check_interval=60)
+        cache2 = TwoTierCache(self.shared, check_interval=60)
+        store = MemcachedSessionStore()
+        app = Flask(__name__)
+
+        session = store.new()
+        session['user'] = 1
+        with app.app_context():
+            app.cache = cache1
+            store.save(session)
+
+            app.cache = cache2
+            self.assertEqual(dict(store.get(session.sid)), {'user': 1})
+
+            # Logged out in the first process
+            app.cache = cache1
+            del session['user']
+            store.save(session)
+
+            app.cache = cache2
+            self.assertEqual(dict(store.get(session.sid)), {})
+        self.assertEqual(cache2.stats['local'], {'hits': 0, 'misses': 0})
+
+
+class TestStampedeProtection(unittest.TestCase):
+    """
+    Test the protection of cached values from stampedes
+    """
+
+    def setUp(self):
+        self.cache = SimpleCache()
+        self.calls = []
+
+    def compute(self):
+        self.calls.append(1)
+        return len(self.calls)
+
+    def test_0010_cached_call(self):
+        self.assertEqual(cached_call(self.cache, 'k', self.compute, 60), 1)
+        self.assertEqual(cached_call(self.cache, 'k', self.compute, 60), 1)
+        self.assertEqual(len(self.calls), 1)
+
+        entry = get_entry(self.cache, 'k')
+        self.assertTrue(entry.expires > time())
+
+        # Values cached before entries were used never expire
+        self.cache.set('legacy', 'value')
+        self.assertEqual(
+            cached_call(self.cache, 'legacy', self.compute), 'value'
+        )
+        self.assertEqual(len(self.calls), 1)
+
+    def test_0020_serve_stale(self):
+        self.cache.set('k', CacheEntry('stale', time() - 1, 0), 60)
+
+        # Another worker holds the lock, the stale value is served
+        self.assertTrue(acquire_lock(self.cache, 'k'))
+        self.assertEqual(
+            cached_call(self.cache, 'k', self.compute, serve_stale=True),
+            'stale'
+        )
+        self.assertEqual(self.calls, [])
+
+        # Once the lock is released, the value is recomputed
+        self.cache.delete('k:lock')
+        self.assertEqual(
+            cached_call(self.cache, 'k', self.compute, serve_stale=True), 1
+        )
+        self.assertEqual(self.cache.get('k:lock'), None)
+
+    def test_0030_early_refresh(self):
+        # A costly value about to expire is refreshed early
+        self.cache.set('k', CacheEntry('old', time() + 1, 10), 60)
+        self.assertEqual(
+            cached_call(self.cache, 'k', self.compute, 60, beta=10000), 1
+        )
+
+        # But not while another worker refreshes it
+        self.cache.set('k', CacheEntry('old', time() + 1, 10), 60)
+        acquire_lock(self.cache, 'k')
+        self.assertEqual(
+            cached_call(self.cache, 'k', self.compute, 60, beta=10000), 'old'
+        )
+
+
+class TestCacheTags(unittest.TestCase):
+    """
+    Test the invalidation of cached values by tags
+    """
+
+    def setUp(self):
+        self.cache = SimpleCache()
+        self.calls = []
+
+    def compute(self):
+        self.calls.append(1)
+        return len(self.calls)
+
+    def test_0010_invalidate(self):
+        def call(tags):
+            return cached_call(
+                self.cache, ','.join(tags), self.compute, 60, tags=tags
+            )
+
+        self.assertEqual(call(['product.product:1']), 1)
+        self.assertEqual(call(['product.product']), 2)
+        self.assertEqual(call(['product.product:1']), 1)
+
+        # Only the values depending on the tag are recomputed
+        invalidate_tags(model_tags('product.product', [1]), self.cache)
+        self.assertEqual(call(['product.product:1']), 3)
+        self.assertEqual(call(['product.product']), 4)
+
+        invalidate_tags(['product.product:2'], self.cache)
+        self.assertEqual(call(['product.product:1']), 3)
+        self.assertEqual(len(self.calls), 4)
+
+    def test_0020_invalidated_while_computing(self):
+        def compute():
+            # A write is committed while the value is computed
+            invalidate_tags(['currency.currency'], self.cache)
+            return self.compute()
+
+        cached_call(
+            self.cache, 'k', compute, 60, tags=['currency.currency']
+        )
+        # The value was computed from the old data and is not served
+        self.assertEqual(
+            cached_call(
+                self.cache, 'k', self.compute, 60, tags=['currency.currency']
+            ), 2
+        )
+        self.assertEqual(
+            cached_call(
+                self.cache, 'k', self.compute, 60, tags=['currency.currency']
+            ), 2
+        )
+
+    def test_0030_tag_versions(self):
+        versions = get_tag_versions(self.cache, ['a', 'b', 'a'])
+        self.assertEqual(sorted(versions), ['a', 'b'])
+        self.assertEqual(get_tag_versions(self.cache, ['a', 'b']), versions)
+
+        # A NullCache stores no versions
+        cache = mock.Mock(spec=NullCache())
+        self.assertEqual(get_tag_versions(cache, ['a', 'b']), {})
+        self.assertEqual(cache.method_calls, [])
+
+        self.assertEqual(
+            get_tags(lambda id: ['nereid.website:%d' % id], kwargs={'id': 1}),
+            ['nereid.website:1']
+        )
+        self.assertEqual(get_tags(None), [])
+
+
+class TestMemoize(unittest.TestCase):
+    """
+    Test the memoization of functions
+    """
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.cache = SimpleCache()
+        self.calls = []
+
+    def test_0010_memoize(self):
+        @memoize('test.square', 60)
+        def square(value, power=2):
+            self.calls.append(value)
+            return value ** power
+
+        with self.app.app_context():
+            self.assertEqual(square(3), 9)
+            # The arguments are bound to the signature of the function
+            self.assertEqual(square(value=3), 9)
+            self.assertEqual(square(3, 2), 9)
+            self.assertEqual(self.calls, [3])
+
+            self.assertEqual(square(3, power=3), 27)
+            self.assertEqual(self.calls, [3, 3])
+
+        self.assertEqual(make_key('a', {'b': 1, 'c': 2}), make_key(
+            'a', {'c': 2, 'b': 1}
+        ))
+        self.assertNotEqual(make_key('a', 1), make_key('a', '1'))
+        self.assertEqual(len(key_from_list(['a', 1])), 32)
+
+        # Keys and members of mixed types are sorted too
+        self.assertEqual(
+            make_key({1: 'a', 'b': 2, None: 3}),
+            make_key({None: 3, 'b': 2, 1: 'a'})
+        )
+        self.assertEqual(make_key({1, 'a', (2, 3)}), make_key({(2, 3), 'a', 1}))
+        self.assertNotEqual(make_key({1, 'a'}), make_key({'1', 'a'}))
+
+    def test_0015_memoize_method(self):
+        def record(id):
+            record = mock.Mock(spec=Model, id=id)
+            record.__name__ = 'test.model'
+            return record
+
+        class Helper(object):
+            @memoize('test.method', 60, method=True)
+            def name(this, item):
+                self.calls.append(item)
+                return '%s:%s' % (getattr(this, 'id', None), item)
+
+        with self.app.app_context():
+            # An instance which is not a record is not part of the key
+            self.assertEqual(Helper().name('a'), 'None:a')
+            self.assertEqual(Helper().name('a'), 'None:a')
+            self.assertEqual(self.calls, ['a'])
+
+            # Records are part of the key, by their model and id
+            self.assertEqual(Helper.name(record(1), 'a'), '1:a')
+            self.assertEqual(Helper.name(record(1), 'a'), '1:a')
+            self.assertEqual(Helper.name(record(2), 'a'), '2:a')
+            self.assertEqual(self.calls, ['a', 'a', 'a'])
+
+    def test_0020_memoize_many(self):
+        @memoize_many('test.double', 60)
+        def double(values, factor=2):
+            self.calls.append(list(values))
+            return [value * factor for value in values]
+
+        with self.app.app_context():
+            self.assertEqual(double([1, 2]), [2, 4])
+            # Only the missing values are computed, in a single call
+            self.assertEqual(double([3, 2, 1, 3]), [6, 4, 2, 6])
+            self.assertEqual(self.calls, [[1, 2], [3]])
+
+            self.assertEqual(double([1], factor=3), [3])
+            self.assertEqual(double([]), [])
+            self.assertEqual(self.calls, [[1, 2], [3], [1]])
+
+        @memoize_many('test.truncated', 60)
+        def truncated(values):
+            return values[:-1]
+
+        with self.app.app_context():
+            # A function which does not return a value for every item fails
+            # rather than caching the values for the wrong items
+            self.assertRaises(ValueError, truncated, [1, 2])
+
+
+class TestFragmentCache(unittest.TestCase):
+    """
+    Test the caching of template fragments
+    """
+
+    def setUp(self):
+        self.env = Environment(
+            extensions=['nereid.templating.FragmentCacheExtension']
+        )
+        self.env.fragment_cache = SimpleCache()
+        self.calls = []
+        self.env.globals['render'] = lambda: self.calls.append(1) or \
+            len(self.calls)
+
+    def test_0010_cache_tag(self):
+        template = self.env.from_string(
+            "{% cache 'fragment', 60, vary=[value] %}"
+            "{{ render() }}"
+            "{% endcache %}"
+        )
+        self.assertEqual(template.render(value=1), '1')
+        self.assertEqual(template.render(value=1), '1')
+        self.assertEqual(template.render(value=2), '2')
+        self.assertEqual(
+            self.env.fragment_cache_stats['fragment'],
+            {'hits': 1, 'misses': 2}
+        )
+
+        # Tags may be given positionally
+        template = self.env.from_string(
+            "{% cache 'tagged', 60, ['product.product'] %}"
+            "{{ render() }}"
+            "{% endcache %}"
+        )
+        self.assertEqual(template.render(), '3')
+        invalidate_tags(['product.product'], self.env.fragment_cache)
+        self.assertEqual(template.render(), '4')
+
+        self.assertRaises(
+            TemplateSyntaxError, self.env.from_string,
+            "{% cache 'x', unknown=1 %}{% endcache %}"
+        )
+
+
+def suite():
+    "Nereid cache backends test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestTwoTierCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestStampedeProtection),
+        unittest.TestLoader().loadTestsFromTestCase(TestCacheTags),
+        unittest.TestLoader().loadTestsFromTestCase(TestMemoize),
+        unittest.TestLoader().loadTestsFromTestCase(TestFragmentCache),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
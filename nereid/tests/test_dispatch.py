@@ -3,18 +3,30 @@
 # this repository contains the full copyright notices and license terms.
 import os
 import unittest
-from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import time
 
-import trytond.tests.test_tryton
+from mock import patch
+
+import trytond.tests.test_tryton    # noqa
 from trytond import backend
-from trytond.config import CONFIG
+from sql import Table
+from trytond.cache import Cache, MemoryCache
+from trytond.config import config
+from trytond.pool import Pool
 from trytond.transaction import Transaction
-from trytond.tests.test_tryton import POOL, USER, DB, DB_NAME, CONTEXT
+from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT, \
+    activate_module, drop_db
+from flask.signals import before_render_template, template_rendered
 from werkzeug.contrib.sessions import FilesystemSessionStore
-from nereid import Nereid
-from nereid.signals import transaction_start
+from nereid import Nereid, render_template
+from nereid.signals import transaction_start, transaction_stop, \
+    transaction_retry, transaction_retry_exhausted
 from nereid.sessions import Session
 from nereid.contrib.locale import Babel
+from nereid.backend import sync_cache, write_cache_resets, \
+    clear_cache_resets
+from nereid.cache_utils import CacheEntry, acquire_lock, release_lock
 
 from .test_templates import BaseTestCase
 
@@ -25,37 +37,49 @@ class NereidTestApp(Nereid):
     subject of this test.
     """
 
-    @property
-    def root_transaction(self):
-        """
-        There is no need of a separate root transaction as everything could
-        be loaded in the transaction context provided in the test case
-        """
-        @contextmanager
-        def do_nothing():
-            yield
-        return do_nothing()
-
     def load_backend(self):
         """
         Just reuse the pool and DB already loaded by the tryton test loader
         """
-        self._database = DB
-        self._pool = POOL
+        Database = backend.get('Database')
+        self._database = Database(self.database_name).connect()
+        self._pool = Pool(self.database_name)
 
+        # Build the route registry of the pool once
+        self.route_registry
 
-class TestDispatcherRetry(BaseTestCase):
+
+class BaseDispatcherTestCase(BaseTestCase):
     """
-    Test the transaction retry mechanism in dispatcher
+    Base test case for tests which use the transaction handling of the
+    dispatcher.
 
-    This test will end up committing code and hence it should be the last test
-    in a test suite as there would be certain side effects.
+    The tests commit their data, so the database is dropped once the tests
+    of the case are run.
     """
     def setUp(self):
-        trytond.tests.test_tryton.install_module('nereid_test')
-        super(TestDispatcherRetry, self).setUp()
+        activate_module('nereid_test')
 
-        self.error_counter = 0
+    @classmethod
+    def tearDownClass(cls):
+        super(BaseDispatcherTestCase, cls).tearDownClass()
+        drop_db()
+
+    def setup_defaults(self):
+        """
+        The defaults may already have been committed by an earlier test
+        """
+        Website = Pool().get('nereid.website')
+        if not Website.search([('name', '=', 'localhost')]):
+            super(BaseDispatcherTestCase, self).setup_defaults()
+
+    def set_retry(self, retry):
+        """
+        Set the number of retries of the transactions for the test
+        """
+        previous = config.get('database', 'retry')
+        config.set('database', 'retry', str(retry))
+        self.addCleanup(config.set, 'database', 'retry', previous)
 
     def get_app(self, **options):
         app = NereidTestApp(
@@ -79,24 +103,37 @@ class TestDispatcherRetry(BaseTestCase):
         Babel(app)
         return app
 
+
+class TestDispatcherRetry(BaseDispatcherTestCase):
+    """
+    Test the transaction retry mechanism in dispatcher
+
+    This test will end up committing code and hence it should be the last test
+    in a test suite as there would be certain side effects.
+    """
+    def setUp(self):
+        super(TestDispatcherRetry, self).setUp()
+
+        self.error_counter = 0
+
     def test_0010_test_failure_counter(self):
         context = CONTEXT.copy()
         with Transaction().start(DB_NAME, USER, context=context) as txn:
             self.setup_defaults()
             app = self.get_app()
 
-            txn.cursor.commit()
+            txn.commit()
 
         DatabaseOperationalError = backend.get('DatabaseOperationalError')
 
         @transaction_start.connect
-        def incr_error_count(app):
+        def incr_error_count(app, **kwargs):
             """
             Subscribe to the transaction_start to increment the counter
             """
             self.error_counter += 1
 
-        CONFIG['retry'] = 4
+        self.set_retry(4)
 
         with app.test_client() as c:
             try:
@@ -104,12 +141,602 @@ class TestDispatcherRetry(BaseTestCase):
             except DatabaseOperationalError:
                 self.assertEqual(self.error_counter, 5)
 
+    def test_0020_contention_backoff(self):
+        """
+        Requests are retried with a growing delay and give up once the
+        retry budget of the rule is spent
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        app = self.get_app(
+            DATABASE_RETRY_BACKOFF=0.001, DATABASE_RETRY_BACKOFF_MAX=0.004
+        )
+        retries, exhausted = [], []
+
+        def record_retry(app, attempt, delay):
+            retries.append((attempt, delay))
+
+        def record_exhausted(app, attempts):
+            exhausted.append(attempts)
+
+        self.set_retry(4)
+
+        with transaction_retry.connected_to(record_retry, app), \
+                transaction_retry_exhausted.connected_to(
+                    record_exhausted, app):
+            with app.test_client() as c:
+                # Succeeds on the third attempt
+                response = c.get('/simulate-contention/backoff/2')
+                self.assertEqual(response.data, b'3')
+                self.assertEqual([a for a, d in retries], [1, 2])
+                self.assertTrue(0 <= retries[0][1] <= 0.001)
+                self.assertTrue(0 <= retries[1][1] <= 0.002)
+                self.assertEqual(exhausted, [])
+
+                # The rule allows a single retry
+                self.assertRaises(
+                    DatabaseOperationalError,
+                    c.get, '/simulate-contention-budget/budget/2'
+                )
+                self.assertEqual(exhausted, [2])
+
+        self.assertTrue(
+            all(0 <= app.get_retry_delay(i) <= 0.004 for i in range(1, 10))
+        )
+
+
+class TestDispatcherTransactions(BaseDispatcherTestCase):
+    """
+    Benchmark the number of database round trips made by the dispatcher
+    for every request.
+
+    Like the retry tests, these commit the default data and should be run
+    at the end of the test suite.
+    """
+
+    def count_round_trips(self, app, url, requests=10, warm_up=True):
+        """
+        Return the average number of connection checkouts, of connection
+        checkouts made by the dispatcher and of transactions started for a
+        GET request to the given url.
+        """
+        Database = backend.get('Database')
+        get_connection = Database.get_connection
+        dispatch_request = app.dispatch_request
+        counter = {'checkouts': 0, 'dispatcher': 0, 'transactions': 0}
+        dispatching = []
+
+        def counting_get_connection(database, *args, **kwargs):
+            counter['checkouts'] += 1
+            if dispatching:
+                counter['dispatcher'] += 1
+            return get_connection(database, *args, **kwargs)
+
+        def counting_dispatch_request():
+            dispatching.append(True)
+            try:
+                return dispatch_request()
+            finally:
+                dispatching.pop()
+
+        def count_transaction(app, **kwargs):
+            counter['transactions'] += 1
+
+        app.dispatch_request = counting_dispatch_request
+        with patch.object(Database, 'get_connection', counting_get_connection):
+            with app.test_client() as c:
+                if warm_up:
+                    # Warm up the caches of the website and url adapters
+                    c.get(url)
+                counter.update(dict.fromkeys(counter, 0))
+                with transaction_start.connected_to(count_transaction, app):
+                    for i in range(requests):
+                        response = c.get(url)
+                        self.assertEqual(response.status_code, 200)
+
+        return dict(
+            (key, value / float(requests)) for key, value in counter.items()
+        )
+
+    def test_0010_single_transaction_round_trips(self):
+        """
+        Single transaction dispatch should checkout one connection per request
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        default = self.count_round_trips(self.get_app(), '/')
+        single = self.count_round_trips(
+            self.get_app(SINGLE_TRANSACTION_DISPATCH=True), '/'
+        )
+
+        # Both modes call the view in exactly one transaction
+        self.assertEqual(default['transactions'], 1)
+        self.assertEqual(single['transactions'], 1)
+
+        # The default mode checks out a connection to synchronise the cache,
+        # one to resolve the website and one for the view. The single
+        # transaction mode does all of it on the connection of the view.
+        self.assertEqual(default['dispatcher'], 3)
+        self.assertEqual(single['dispatcher'], 1)
+
+        # The URL adapter of the request is built from the cached website
+        # in its own readonly transaction, before the request is dispatched
+        self.assertEqual(default['checkouts'], 4)
+        self.assertEqual(single['checkouts'], 2)
+
+    def test_0020_single_transaction_cache_sync(self):
+        """
+        The caches of the worker are synchronised with ir_cache on the
+        connection of the transaction of the view
+        """
+        Database = backend.get('Database')
+        get_connection = Database.get_connection
+        checkouts = []
+
+        def counting_get_connection(database, *args, **kwargs):
+            checkouts.append(1)
+            return get_connection(database, *args, **kwargs)
+
+        cache = Cache('nereid.test.sync', context=False)
+        with Transaction().start(DB_NAME, 0) as txn:
+            cache.set('key', 'value')
+            # Another worker cleared the cache
+            table = Table('ir_cache')
+            txn.connection.cursor().execute(*table.insert(
+                [table.timestamp, table.name],
+                [[datetime.now() + timedelta(seconds=1), 'nereid.test.sync']]
+            ))
+            txn.commit()
+
+        # This worker reset another cache
+        Cache.reset(DB_NAME, 'nereid.test.reset')
+        MemoryCache._clean_last = datetime.min
+
+        with patch.object(Database, 'get_connection', counting_get_connection):
+            with Transaction().start(DB_NAME, 0, _nocache=True) as txn:
+                sync_cache(txn)
+                self.assertIsNone(cache.get('key'))
+                self.assertNotEqual(MemoryCache._clean_last, datetime.min)
+
+                names = write_cache_resets(txn)
+                self.assertEqual(names, {'nereid.test.reset'})
+                txn.commit()
+                clear_cache_resets(DB_NAME, names)
+        self.assertEqual(len(checkouts), 1)
+        self.assertNotIn('nereid.test.reset', Cache._resets[DB_NAME])
+
+        with Transaction().start(DB_NAME, 0) as txn:
+            cursor = txn.connection.cursor()
+            cursor.execute(*table.select(
+                table.name, where=table.name == 'nereid.test.reset'
+            ))
+            self.assertEqual(cursor.fetchall(), [('nereid.test.reset',)])
+
+        # Nothing is cleared from the resets until the transaction commits
+        Cache.reset(DB_NAME, 'nereid.test.reset')
+        with Transaction().start(DB_NAME, 0, _nocache=True) as txn:
+            write_cache_resets(txn)
+            txn.rollback()
+        self.assertIn('nereid.test.reset', Cache._resets[DB_NAME])
+
+    def test_0030_single_transaction_readonly_cache_resets(self):
+        """
+        The caches reset in a readonly transaction of a view are written to
+        ir_cache once the transaction is stopped
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(SINGLE_TRANSACTION_DISPATCH=True)
+        name = 'nereid.test.test_model.clear_cache'
+        with app.test_client() as c:
+            response = c.get('/clear-cache')
+            self.assertEqual(response.data, b'cleared')
+        self.assertNotIn(name, Cache._resets[DB_NAME])
+
+        table = Table('ir_cache')
+        with Transaction().start(DB_NAME, 0) as txn:
+            cursor = txn.connection.cursor()
+            cursor.execute(*table.select(table.name, where=table.name == name))
+            self.assertEqual(cursor.fetchall(), [(name,)])
+
+
+class TestConnectionPool(BaseDispatcherTestCase):
+    """
+    Test the connection pool used by the dispatcher
+    """
+
+    def test_0010_pool_stats(self):
+        """
+        The pool statistics are readable from the transaction signals
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(
+            DATABASE_POOL_MAX_SIZE=2,
+            DATABASE_POOL_PREWARM=1,
+            DATABASE_POOL_HEALTH_CHECK=True,
+        )
+        seen = []
+
+        def record_stats(app, **kwargs):
+            seen.append(('start', kwargs))
+
+        def record_stop_stats(app, **kwargs):
+            seen.append(('stop', kwargs))
+
+        with transaction_start.connected_to(record_stats, app), \
+                transaction_stop.connected_to(record_stop_stats, app):
+            with app.test_client() as c:
+                response = c.get('/')
+                self.assertEqual(response.status_code, 200)
+
+        # The view transaction is the only one in use when it starts
+        (start, started), (stop, stopped) = seen[-2:]
+        self.assertEqual((start, stop), ('start', 'stop'))
+        self.assertEqual(started['pool_stats']['in_use'], 1)
+        self.assertEqual(started['pool_stats']['checkouts'], 3)
+        self.assertTrue(started['wait_time'] >= 0)
+        self.assertEqual(stopped['wait_time'], started['wait_time'])
+        self.assertEqual(stopped['pool_stats']['in_use'], 1)
+
+        stats = app.connection_pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['failures'], 0)
+        self.assertTrue(stats['max_wait_time'] >= 0)
+
+    def test_0020_pool_timeout(self):
+        """
+        A request waiting too long for a connection fails with an
+        operational error
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        app = self.get_app(
+            DATABASE_POOL_MAX_SIZE=1, DATABASE_POOL_TIMEOUT=0.01
+        )
+
+        with app.connection_pool.transaction(0):
+            self.assertRaises(
+                DatabaseOperationalError,
+                app.connection_pool.transaction(0).__enter__
+            )
+        stats = app.connection_pool.stats()
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+
+class TestPageCache(BaseDispatcherTestCase):
+    """
+    Test the cache of the responses of routes with the cache_page option
+    """
+
+    def test_0010_cache_page(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(CACHE_TYPE='werkzeug.contrib.cache.SimpleCache')
+        transactions = []
+
+        def count_transaction(app, **kwargs):
+            transactions.append(1)
+
+        with transaction_start.connected_to(count_transaction, app):
+            with app.test_client() as c:
+                first = c.get('/cached-page').data
+
+                # Served from the cache without a transaction
+                del transactions[:]
+                self.assertEqual(c.get('/cached-page').data, first)
+                self.assertEqual(transactions, [])
+
+                # The query string is part of the key
+                self.assertNotEqual(
+                    c.get('/cached-page?page=2').data, first
+                )
+
+                # Logged in users are not served cached pages
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+                self.assertNotEqual(c.get('/cached-page').data, first)
+
+    def test_0020_cache_page_vary(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(CACHE_TYPE='werkzeug.contrib.cache.SimpleCache')
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            en = c.get(
+                '/cached-page-by-user', headers={'Accept-Language': 'en'}
+            ).data
+            self.assertEqual(
+                c.get(
+                    '/cached-page-by-user',
+                    headers={'Accept-Language': 'en'}
+                ).data, en
+            )
+            fr = c.get(
+                '/cached-page-by-user', headers={'Accept-Language': 'fr'}
+            ).data
+            self.assertNotEqual(fr, en)
+
+            # Pages are cached by user
+            with c.session_transaction() as sess:
+                sess['user_id'] = 2
+            self.assertNotEqual(
+                c.get(
+                    '/cached-page-by-user',
+                    headers={'Accept-Language': 'en'}
+                ).data, en
+            )
+
+    def test_0030_cache_page_lock(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(CACHE_TYPE='werkzeug.contrib.cache.SimpleCache')
+        TestModel = Pool(DB_NAME).get('nereid.test.test_model')
+
+        def locks():
+            return [k for k in app.cache._cache if k.endswith(':lock')]
+
+        with app.test_client() as c:
+            first = c.get('/cached-page-error').data
+
+            # Expire the cached page, the next request renders it again
+            for key in list(app.cache._cache):
+                entry = app.cache.get(key)
+                if isinstance(entry, CacheEntry):
+                    app.cache.set(key, entry._replace(expires=time() - 1))
+
+            TestModel._cached_page_error[0] = True
+            self.addCleanup(
+                TestModel._cached_page_error.__setitem__, 0, False
+            )
+            try:
+                c.get('/cached-page-error')
+            except ValueError:
+                pass
+            # The lock is released although the view failed
+            self.assertEqual(locks(), [])
+
+            TestModel._cached_page_error[0] = False
+            self.assertNotEqual(c.get('/cached-page-error').data, first)
+            self.assertEqual(locks(), [])
+
+    def test_0040_cache_page_session(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(CACHE_TYPE='werkzeug.contrib.cache.SimpleCache')
+
+        # A page with the csrf token of the session is not cached
+        with app.test_client() as c:
+            first = c.get('/cached-page-csrf').data
+            self.assertNotEqual(c.get('/cached-page-csrf').data, first)
+
+        # Nor served to another session
+        with app.test_client() as c:
+            self.assertNotEqual(c.get('/cached-page-csrf').data, first)
+
+    def test_0050_cache_page_miss(self):
+        """
+        A single request renders a missing page, the other requests wait
+        for it
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(CACHE_TYPE='werkzeug.contrib.cache.SimpleCache')
+        TestModel = Pool(DB_NAME).get('nereid.test.test_model')
+
+        with app.test_client() as c:
+            first = c.get('/cached-page').data
+            key, = [
+                k for k in app.cache._cache
+                if isinstance(app.cache.get(k), CacheEntry)
+            ]
+            entry = app.cache.get(key)
+
+            # A first request for the missing page takes the lock
+            app.cache.delete(key)
+            self.assertTrue(acquire_lock(app.cache, key))
+
+            def render(seconds):
+                # The first request stores the page while the second waits
+                app.cache.set(key, entry)
+                release_lock(app.cache, key)
+
+            calls = TestModel._cached_page_calls[0]
+            with patch('nereid.page_cache.sleep', side_effect=render):
+                self.assertEqual(c.get('/cached-page').data, first)
+            self.assertEqual(TestModel._cached_page_calls[0], calls)
+
+            # The second request renders the page if the first one is too
+            # slow
+            app.cache.delete(key)
+            self.assertTrue(acquire_lock(app.cache, key))
+            with patch('nereid.page_cache.sleep') as sleep:
+                self.assertNotEqual(c.get('/cached-page').data, first)
+            self.assertTrue(sleep.called)
+            self.assertEqual(TestModel._cached_page_calls[0], calls + 1)
+            release_lock(app.cache, key)
+
+    def test_0060_cache_page_etag(self):
+        """
+        A cached page is answered with a 304 if the request matches its ETag
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app(CACHE_TYPE='werkzeug.contrib.cache.SimpleCache')
+        transactions = []
+
+        def count_transaction(app, **kwargs):
+            transactions.append(1)
+
+        with transaction_start.connected_to(count_transaction, app):
+            with app.test_client() as c:
+                response = c.get('/cached-page-etag')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers['ETag'], '"cached"')
+
+                del transactions[:]
+                response = c.get(
+                    '/cached-page-etag', headers={'If-None-Match': '"cached"'}
+                )
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.data, b'')
+                self.assertEqual(response.headers['ETag'], '"cached"')
+                self.assertEqual(transactions, [])
+
+                response = c.get(
+                    '/cached-page-etag', headers={'If-None-Match': '"other"'}
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.data, b'')
+                self.assertEqual(transactions, [])
+
+
+class TestStreaming(BaseDispatcherTestCase):
+    """
+    Test the streamed responses, which keep the transaction of the request
+    open until the body is sent
+    """
+
+    def test_0010_stream_session(self):
+        """
+        The changes made to the session while the template is streamed are
+        saved once it is rendered
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app()
+
+        with app.test_client() as c:
+            with c.session_transaction() as session:
+                session['_flashes'] = [('message', 'streamed')]
+
+            response = c.get('/test-stream-flashes')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.data, b'streamed')
+
+            # The messages were popped
+            response = c.get('/test-stream-flashes')
+            self.assertEqual(response.data, b'')
+
+        self.assertEqual(app.connection_pool.stats()['in_use'], 0)
+
+    def test_0015_stream_new_session(self):
+        """
+        An empty session without a cookie is not saved to stream the page
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app()
+
+        with app.test_client() as c:
+            response = c.get('/test-stream-flashes')
+            # The page was rendered before the response was returned
+            self.assertIn('Content-Length', response.headers)
+            self.assertEqual(response.data, b'')
+            self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_0018_stream_signals(self):
+        """
+        The template signals of Flask are sent for streamed templates
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app()
+        signals = []
+
+        def before_render(app, template, context, **kwargs):
+            signals.append(('before', template.name))
+
+        def rendered(app, template, context, **kwargs):
+            signals.append(('rendered', template.name))
+
+        with before_render_template.connected_to(before_render, app), \
+                template_rendered.connected_to(rendered, app):
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session['_flashes'] = [('message', 'streamed')]
+                response = c.get('/test-stream-flashes')
+                self.assertNotIn('Content-Length', response.headers)
+                self.assertEqual(response.data, b'streamed')
+
+        self.assertEqual(signals, [
+            ('before', 'tests/flashes.jinja'),
+            ('rendered', 'tests/flashes.jinja'),
+        ])
+
+        # The context of render_template has no reserved name
+        with app.test_request_context('/'):
+            app.template_prefix_website_name = False
+            rv = render_template('tests/flashes.jinja', stream=True)
+            self.assertEqual(rv.context, {'stream': True})
+            self.assertFalse(rv.stream)
+
+    def test_0020_stream_after_request_error(self):
+        """
+        The transaction of the stream is stopped if processing the response
+        fails
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            txn.commit()
+
+        app = self.get_app()
+
+        @app.after_request
+        def fail(response):
+            raise ValueError('after request')
+
+        with app.test_client() as c:
+            self.assertRaises(ValueError, c.get, '/test-stream-flashes')
+
+        self.assertEqual(app.connection_pool.stats()['in_use'], 0)
+
 
 def suite():
     "Nereid Dispatcher test suite"
     test_suite = unittest.TestSuite()
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestDispatcherRetry),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestDispatcherTransactions
+        ),
+        unittest.TestLoader().loadTestsFromTestCase(TestConnectionPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestPageCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestStreaming),
     ])
     return test_suite
 
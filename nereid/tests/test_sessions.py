@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import fnmatch
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from flask import Flask
+from werkzeug.contrib.sessions import FilesystemSessionStore
+from nereid import Nereid
+from nereid.sessions import Session, LazySession, NereidSessionInterface, \
+    RedisSessionStore, ClientSessionInterface
+
+
+class DummyRedis(object):
+    """
+    An in-process stand-in for the part of the redis client used by the
+    session store, which records the commands it receives
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expiries = {}
+        self.commands = []
+        self.written = []
+
+    @staticmethod
+    def _bytes(value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode('utf-8')
+
+    def hgetall(self, key):
+        self.commands.append('hgetall')
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        self.commands.append('hset')
+        fields = self.data.setdefault(key, {})
+        if mapping is None:
+            mapping = {field: value}
+        for field, value in mapping.items():
+            self.written.append(self._bytes(field))
+            fields[self._bytes(field)] = self._bytes(value)
+
+    def hdel(self, key, *fields):
+        self.commands.append('hdel')
+        for field in fields:
+            self.data.get(key, {}).pop(self._bytes(field), None)
+
+    def expire(self, key, seconds):
+        self.commands.append('expire')
+        self.expiries[key] = seconds
+
+    def delete(self, key):
+        self.commands.append('delete')
+        self.data.pop(key, None)
+
+    def sadd(self, key, member):
+        self.commands.append('sadd')
+        self.data.setdefault(key, set()).add(self._bytes(member))
+
+    def srem(self, key, member):
+        self.commands.append('srem')
+        self.data.get(key, set()).discard(self._bytes(member))
+
+    def smembers(self, key):
+        self.commands.append('smembers')
+        return set(self.data.get(key, set()))
+
+    def scan_iter(self, match):
+        return [
+            key.encode('utf-8') for key in self.data
+            if fnmatch.fnmatch(key, match)
+        ]
+
+    def pipeline(self):
+        return DummyPipeline(self)
+
+
+class DummyPipeline(object):
+    """
+    Queue the commands until execute is called
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.queue = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.queue.append((name, args, kwargs))
+        return queue
+
+    def execute(self):
+        self.client.commands.append('execute')
+        for name, args, kwargs in self.queue:
+            getattr(self.client, name)(*args, **kwargs)
+
+
+class TestLazySession(unittest.TestCase):
+    """
+    Test the lazy loading of sessions
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = FilesystemSessionStore(
+            self.path, session_class=Session
+        )
+        self.app = Flask(__name__)
+        self.interface = NereidSessionInterface()
+        self.interface.session_store = self.store
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open_session(self, sid):
+        headers = {'Cookie': '%s=%s' % (self.app.session_cookie_name, sid)}
+        with self.app.test_request_context(headers=headers) as ctx:
+            return self.interface.open_session(self.app, ctx.request)
+
+    def test_0010_unused_session(self):
+        stored = self.store.new()
+        stored['user_id'] = 1
+        self.store.save(stored)
+
+        session = self.open_session(stored.sid)
+        self.assertTrue(isinstance(session, LazySession))
+        self.assertFalse(session.is_loaded)
+        self.assertFalse(session.should_save)
+        self.assertEqual(self.interface.get_stats(), {
+            'opened': 1, 'loaded': 0, 'skipped': 1,
+        })
+
+    def test_0020_read_session(self):
+        stored = self.store.new()
+        stored['user_id'] = 1
+        self.store.save(stored)
+
+        session = self.open_session(stored.sid)
+        self.assertEqual(session.get('user_id'), 1)
+        self.assertTrue(session.is_loaded)
+        self.assertTrue('user_id' in session)
+
+        # Reading is not a modification
+        self.assertFalse(session.should_save)
+        self.assertEqual(self.interface.get_stats()['loaded'], 1)
+
+        session['cart'] = 2
+        self.assertTrue(session.should_save)
+        self.assertEqual(dict(session), {'user_id': 1, 'cart': 2})
+        self.assertEqual(self.interface.get_stats()['loaded'], 1)
+
+    def test_0030_invalid_sid(self):
+        session = self.open_session('../invalid')
+        session['a'] = 1
+        self.assertTrue(session.new)
+        self.assertNotEqual(session.sid, '../invalid')
+
+
+class TestRedisSessionStore(unittest.TestCase):
+    """
+    Test the redis session store against an in-process stand-in
+    """
+
+    def setUp(self):
+        self.client = DummyRedis()
+        self.store = RedisSessionStore(client=self.client, expiry=3600)
+
+    def test_0010_save_changed_keys(self):
+        session = self.store.new()
+        session['user_id'] = 1
+        session['cart'] = [1, 2]
+        self.store.save(session)
+
+        key = self.store.get_key(session.sid)
+        self.assertEqual(self.client.expiries[key], 3600)
+
+        session = self.store.get(session.sid)
+        self.assertEqual(dict(session), {'user_id': 1, 'cart': [1, 2]})
+
+        # Only the changed key is written and the removed one deleted
+        del self.client.commands[:], self.client.written[:]
+        session['cart'] = [1, 2, 3]
+        del session['user_id']
+        self.store.save(session)
+        self.assertEqual(self.client.commands.count('hdel'), 1)
+        self.assertEqual(
+            self.client.written,
+            [b'cart', self.store.refreshed_field.encode('utf-8')]
+        )
+        self.assertEqual(
+            set(self.client.data[key]),
+            {b'cart', self.store.refreshed_field.encode('utf-8')}
+        )
+        self.assertEqual(self.store.get(session.sid)['cart'], [1, 2, 3])
+
+    def test_0020_refresh_interval(self):
+        session = self.store.new()
+        session['a'] = 1
+        self.store.save(session)
+
+        # Recently refreshed, a read costs a single command
+        del self.client.commands[:]
+        self.store.get(session.sid)
+        self.assertEqual(self.client.commands, ['hgetall'])
+
+        # Once the interval passed, the expiry is refreshed in a pipeline
+        self.store.refresh_interval = -1
+        del self.client.commands[:]
+        self.store.get(session.sid)
+        self.assertEqual(
+            self.client.commands, ['hgetall', 'execute', 'hset', 'expire']
+        )
+
+    def test_0030_user_index(self):
+        sessions = []
+        for user_id in (1, 1, 2):
+            session = self.store.new()
+            session['user_id'] = user_id
+            self.store.save(session)
+            sessions.append(session.sid)
+
+        self.assertEqual(set(self.store.list()), set(sessions))
+        self.assertEqual(set(self.store.list(1)), set(sessions[:2]))
+
+        self.assertEqual(self.store.purge_user(1), 2)
+        self.assertEqual(self.store.list(1), [])
+        self.assertEqual(self.store.list(), [sessions[2]])
+
+        # Deleted sessions leave the index
+        self.store.delete(self.store.get(sessions[2]))
+        self.assertEqual(self.store.list(2), [])
+        self.assertEqual(self.store.list(), [])
+
+
+class TestClientSessionInterface(unittest.TestCase):
+    """
+    Test the sessions kept in a signed cookie
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = FilesystemSessionStore(
+            self.path, session_class=Session
+        )
+        self.app = Flask(__name__)
+        self.app.secret_key = 'secret-key'
+        self.interface = ClientSessionInterface(max_cookie_size=200)
+        self.interface.session_store = self.store
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def roundtrip(self, cookie=None, **values):
+        """
+        Open the session of a request with the given cookie, set the values
+        and return the session and the value of the cookie of the response
+        """
+        headers = {}
+        if cookie:
+            headers['Cookie'] = '%s=%s' % (
+                self.app.session_cookie_name, cookie
+            )
+        with self.app.test_request_context(headers=headers) as ctx:
+            session = self.interface.open_session(self.app, ctx.request)
+            session.update(values)
+            response = self.app.response_class()
+            self.interface.save_session(self.app, session, response)
+        for header in response.headers.getlist('Set-Cookie'):
+            name, value = header.split(';')[0].split('=', 1)
+            if name == self.app.session_cookie_name:
+                return session, value
+        return session, cookie
+
+    def test_0010_small_session_in_cookie(self):
+        session, cookie = self.roundtrip(cart=1)
+        self.assertTrue('.' in cookie)
+        self.assertEqual(self.store.list(), [])
+
+        session, cookie = self.roundtrip(cookie)
+        self.assertEqual(dict(session), {'cart': 1})
+        self.assertEqual(self.interface.get_stats()['client'], 1)
+
+        # A tampered cookie gives a new session
+        session, cookie = self.roundtrip(cookie[:-2] + 'xx')
+        self.assertEqual(dict(session), {})
+
+        # The types supported by the cookies of Flask are kept
+        values = {
+            'point': (1, 2),
+            'created': datetime(2018, 1, 1, 12, 30),
+            'raw': b'\x00\xff',
+        }
+        session, cookie = self.roundtrip(**values)
+        self.assertTrue('.' in cookie)
+        session, cookie = self.roundtrip(cookie)
+        self.assertEqual(dict(session), values)
+
+    def test_0020_large_session_in_store(self):
+        session, cookie = self.roundtrip(cart=1)
+        session, cookie = self.roundtrip(cookie, history=list(range(100)))
+
+        # The cookie now holds the id of the session in the store
+        self.assertEqual(cookie, session.sid)
+        self.assertEqual(self.store.list(), [session.sid])
+        self.assertEqual(
+            dict(self.store.get(session.sid)),
+            {'cart': 1, 'history': list(range(100))}
+        )
+
+        session, cookie = self.roundtrip(cookie, cart=2)
+        self.assertEqual(cookie, session.sid)
+        self.assertEqual(self.store.get(session.sid)['cart'], 2)
+
+    def test_0025_prepare_streamed_session(self):
+        def prepare(cookie=None):
+            headers = {}
+            if cookie:
+                headers['Cookie'] = '%s=%s' % (
+                    self.app.session_cookie_name, cookie
+                )
+            with self.app.test_request_context(headers=headers) as ctx:
+                session = self.interface.open_session(self.app, ctx.request)
+                return self.interface.prepare_streamed_session(
+                    self.app, session, ctx.request
+                )
+
+        # The changes of sessions in the cookie cannot be saved once the
+        # headers are sent
+        self.assertFalse(prepare())
+        session, cookie = self.roundtrip(cart=1)
+        self.assertFalse(prepare(cookie))
+
+        # Unlike the changes of sessions in the store
+        session, cookie = self.roundtrip(cookie, history=list(range(100)))
+        self.assertTrue(prepare(cookie))
+
+    def test_0030_load_session_store(self):
+        app = Nereid()
+        app.session_interface = self.interface
+        self.interface.lazy = False
+        app.config['SESSION_STORE_TYPE'] = \
+            'werkzeug.contrib.sessions.FilesystemSessionStore'
+        app.config['SESSION_STORE_INIT_KWARGS'] = {'path': self.path}
+        app.load_session_store()
+
+        # The application uses a copy of the configured interface
+        interface = app.session_interface
+        self.assertIsNot(interface, self.interface)
+        self.assertIsInstance(interface, ClientSessionInterface)
+        self.assertEqual(interface.max_cookie_size, 200)
+        self.assertFalse(interface.lazy)
+        self.assertIsNot(interface.session_store, self.store)
+        self.assertIs(self.interface.session_store, self.store)
+
+
+def suite():
+    "Nereid sessions test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestLazySession),
+        unittest.TestLoader().loadTestsFromTestCase(TestRedisSessionStore),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestClientSessionInterface
+        ),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -4,8 +4,12 @@
 import os
 import unittest
 import pickle
+import shutil
+import tempfile
+import time
 from email.header import decode_header
 
+import jinja2
 import pycountry
 import trytond.tests.test_tryton
 from trytond.transaction import Transaction
@@ -15,6 +19,7 @@ from trytond.pool import Pool
 from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT, \
     with_transaction, activate_module
 from nereid import render_template, LazyRenderer, render_email
+from nereid.templating import ModuleTemplateLoader
 from nereid.testing import NereidTestCase, NereidTestApp
 from nereid.sessions import Session
 from nereid.contrib.locale import Babel
@@ -441,6 +446,93 @@ class TestTemplateLoading(BaseTestCase):
             else:
                 self.fail('Alternative part not found')
 
+    @with_transaction()
+    def test_0120_compile_templates(self):
+        """
+        Compile the templates into a bytecode cache directory
+        """
+        self.setup_defaults()
+        cache_dir = tempfile.mkdtemp()
+        app = self.get_app(TEMPLATE_BYTECODE_CACHE_DIR=cache_dir)
+
+        self.assertTrue(app.compile_templates() > 0)
+        self.assertTrue(os.listdir(cache_dir))
+
+        # The workers load the compiled templates
+        app = self.get_app(TEMPLATE_BYTECODE_CACHE_DIR=cache_dir)
+        with app.test_request_context('/'):
+            self.assertEqual(
+                render_template('from-local.html'),
+                'from-local-folder'
+            )
+        shutil.rmtree(cache_dir)
+
+
+class TestTemplateIndex(unittest.TestCase):
+    """
+    Test the index of the templates of the module template loader
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.other_folder = tempfile.mkdtemp()
+        self.write(self.folder, 'home.html', 'home')
+        self.write(self.folder, 'tests/both.html', 'first')
+        self.write(self.other_folder, 'tests/both.html', 'second')
+        self.write(self.other_folder, 'other.html', 'other')
+
+        self.loader = ModuleTemplateLoader()
+        self.loader._loaders = [
+            jinja2.DictLoader({'dict.html': 'dict', 'home.html': 'dict'}),
+            jinja2.FileSystemLoader(self.folder),
+            jinja2.FileSystemLoader(self.other_folder),
+        ]
+        self.env = jinja2.Environment(loader=self.loader, auto_reload=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.other_folder)
+
+    def write(self, folder, name, content):
+        filename = os.path.join(folder, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(content)
+
+    def render(self, name):
+        return self.env.get_template(name).render()
+
+    def test_0010_lookup(self):
+        # The loaders keep their precedence
+        self.assertEqual(self.render('home.html'), 'dict')
+        self.assertEqual(self.render('tests/both.html'), 'first')
+        self.assertEqual(self.render('other.html'), 'other')
+        self.assertRaises(
+            jinja2.TemplateNotFound, self.render, 'localhost/home.html'
+        )
+        self.assertEqual(self.loader.stats['builds'], 1)
+        self.assertEqual(self.loader.stats['hits'], 2)
+        self.assertEqual(self.loader.stats['misses'], 1)
+
+        self.assertEqual(
+            self.loader.list_templates(),
+            ['dict.html', 'home.html', 'other.html', 'tests/both.html']
+        )
+
+    def test_0020_reload(self):
+        self.assertRaises(jinja2.TemplateNotFound, self.render, 'new.html')
+
+        # New templates are not seen unless templates are reloaded
+        self.write(self.folder, 'new.html', 'new')
+        self.assertRaises(jinja2.TemplateNotFound, self.render, 'new.html')
+
+        self.env.auto_reload = True
+        self.loader.check_interval = 0
+        os.utime(self.folder, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.render('new.html'), 'new')
+        self.assertEqual(self.loader.stats['builds'], 2)
+
 
 class TestLazyRendering(BaseTestCase):
     '''
@@ -546,12 +638,84 @@ class TestLazyRendering(BaseTestCase):
             # Drop the cache as the transaction is rollbacked
             Cache.drop(DB_NAME)
 
+    def test_0050_etag(self):
+        '''
+        A view supplied ETag answers a matching request with a 304 without
+        rendering the template
+        '''
+        activate_module('nereid_test')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                response = c.get('/test-etag/v1')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers['ETag'], '"v1"')
+
+                response = c.get(
+                    '/test-etag/v1', headers={'If-None-Match': '"v1"'}
+                )
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.data, b'')
+
+            txn.rollback()
+            # Drop the cache as the transaction is rollbacked
+            Cache.drop(DB_NAME)
+
+    def test_0055_stream(self):
+        '''
+        A streamed template has the same body as a rendered one
+        '''
+        activate_module('nereid_test')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                rendered = c.get('/')
+                response = c.get('/test-stream')
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.is_streamed)
+                self.assertEqual(response.data, rendered.data)
+
+            txn.rollback()
+            # Drop the cache as the transaction is rollbacked
+            Cache.drop(DB_NAME)
+
+    def test_0060_etag_rendered_templates(self):
+        '''
+        The ETag of rendered templates is a hash of the body
+        '''
+        activate_module('nereid_test')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            app = self.get_app(ETAG_RENDERED_TEMPLATES=True)
+
+            with app.test_client() as c:
+                response = c.get('/test-lazy-renderer')
+                # Only successful responses are validated
+                self.assertNotIn('ETag', response.headers)
+
+                response = c.get('/')
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers['ETag']
+
+                response = c.get('/', headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.headers['ETag'], etag)
+
+            txn.rollback()
+            # Drop the cache as the transaction is rollbacked
+            Cache.drop(DB_NAME)
+
 
 def suite():
     "Nereid Template Loading test suite"
     test_suite = unittest.TestSuite()
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestTemplateLoading),
+        unittest.TestLoader().loadTestsFromTestCase(TestTemplateIndex),
         unittest.TestLoader().loadTestsFromTestCase(TestLazyRendering),
     ])
     return test_suite
@@ -61,7 +61,7 @@ class Request(RequestBase):
 
     @staticmethod
     @transaction_stop.connect
-    def clear_dictcache(app):
+    def clear_dictcache(app, **kwargs):
         """
         Clears the dictcache which stored the cached values of the records
         below.
@@ -2,11 +2,12 @@
 # this repository contains the full copyright notices and license terms.
 from trytond.model import ModelSQL, fields
 from trytond.pool import Pool
+from trytond.cache import Cache
 from flask_wtf import Form
 from flask_wtf.csrf import generate_csrf
 from wtforms import StringField
 from wtforms.validators import DataRequired
-from nereid import route
+from nereid import route, request, render_template
 
 
 class MyForm(Form):
@@ -30,6 +31,94 @@ class TestModel(ModelSQL):
         DatabaseOperationalError = backend.get('DatabaseOperationalError')
         raise DatabaseOperationalError()
 
+    #: The number of calls of simulate_contention by key
+    _contention_attempts = {}
+
+    @classmethod
+    @route('/simulate-contention/<key>/<int:failures>',
+           methods=['GET', 'POST'])
+    @route('/simulate-contention-budget/<key>/<int:failures>', retry=1,
+           methods=['GET', 'POST'])
+    def simulate_contention(cls, key, failures):
+        """
+        Fail with a DatabaseOperationalError the first `failures` times it
+        is called for the `key`, like a row locked by a concurrent
+        transaction, and then return the number of attempts made.
+        """
+        from trytond import backend
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        attempts = cls._contention_attempts.get(key, 0) + 1
+        cls._contention_attempts[key] = attempts
+        if attempts <= failures:
+            raise DatabaseOperationalError()
+        return '%d' % attempts
+
+    #: A Tryton cache cleared by clear_cache
+    _clear_cache = Cache('nereid.test.test_model.clear_cache', context=False)
+
+    @classmethod
+    @route('/clear-cache')
+    def clear_cache(cls):
+        """
+        Clear a Tryton cache in a readonly transaction
+        """
+        cls._clear_cache.clear()
+        return 'cleared'
+
+    #: The number of calls of cached_page
+    _cached_page_calls = [0]
+
+    @classmethod
+    @route('/cached-page', cache_page=60)
+    @route('/cached-page-by-user', cache_page={
+        'vary': ['Accept-Language'], 'vary_on_user': True,
+    })
+    def cached_page(cls):
+        """
+        Return the number of times the view was called
+        """
+        cls._cached_page_calls[0] += 1
+        return '%d' % cls._cached_page_calls[0]
+
+    #: Set to make cached_page_error fail
+    _cached_page_error = [False]
+
+    @classmethod
+    @route('/cached-page-error', cache_page=60)
+    def cached_page_error(cls):
+        """
+        Return the number of times the view was called, or fail
+        """
+        if cls._cached_page_error[0]:
+            raise ValueError('The page failed')
+        return cls.cached_page()
+
+    @classmethod
+    @route('/cached-page-etag', cache_page=60)
+    def cached_page_etag(cls):
+        """
+        Return the home page with a fixed ETag
+        """
+        rv = Pool().get('nereid.website').home()
+        rv.etag = 'cached'
+        return rv
+
+    @classmethod
+    @route('/cached-page-csrf', cache_page=60)
+    def cached_page_csrf(cls):
+        """
+        Return the number of times the view was called with a csrf token
+        """
+        return '%s %s' % (cls.cached_page(), generate_csrf())
+
+    @route('/test-record/<int:active_id>', check_exists=False)
+    def test_record_without_check(self):
+        """
+        Return the id of the record without checking that it exists
+        """
+        return '%d' % self.id
+
     @classmethod
     @route('/test-lazy-renderer')
     def test_lazy_renderer(cls):
@@ -41,6 +130,35 @@ class TestModel(ModelSQL):
         rv.status = 201
         return rv
 
+    @classmethod
+    @route('/test-etag/<version>')
+    def test_etag(cls, version):
+        """
+        Return the home page with the given version as ETag and remove the
+        template so that a rendering would fail
+        """
+        rv = Pool().get('nereid.website').home()
+        rv.etag = version
+        if request.if_none_match:
+            rv.template_name_or_list = 'no-such-template.jinja'
+        return rv
+
+    @classmethod
+    @route('/test-stream', stream=True)
+    def test_stream(cls):
+        """
+        Return the home page, streamed as it is rendered
+        """
+        return Pool().get('nereid.website').home()
+
+    @classmethod
+    @route('/test-stream-flashes', stream=True)
+    def test_stream_flashes(cls):
+        """
+        Stream a template which pops the flashed messages of the session
+        """
+        return render_template('tests/flashes.jinja')
+
     @classmethod
     @route('/gen-csrf', methods=['GET'])
     def gen_csrf(cls):
@@ -142,6 +142,12 @@ install_requires.append(
     (major_version, minor_version, major_version, minor_version + 1)
 )
 
+# Optional dependencies
+extras_require = {
+    # RedisSessionStore writes hashes with hset(mapping=...)
+    'redis': ['redis>=3.5'],
+}
+
 # Testing dependencies
 tests_require = [
     'mock',
@@ -169,6 +175,7 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     install_requires=install_requires,
+    extras_require=extras_require,
     packages=[
         'nereid',
         'nereid.contrib',
@@ -200,6 +207,9 @@ setup(
     [trytond.modules]
     nereid = trytond.modules.nereid
     nereid_test = trytond.modules.nereid_test
+    [console_scripts]
+    nereid-compile-templates = nereid.commands:compile_templates
+    nereid-compile-translations = nereid.commands:compile_translations
     """,
     test_suite='tests.suite',
     test_loader='trytond.test_loader:Loader',
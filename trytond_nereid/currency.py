@@ -1,32 +1,146 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from decimal import Decimal
+
 from trytond.model import ModelView, ModelSQL
-from nereid import context_processor, current_website, current_locale
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from nereid import context_processor, template_filter, current_website, \
+    current_locale, request
+from nereid.ctx import has_request_context
+from nereid.cache_utils import CacheTagMixin
+
+__all__ = ['Currency', 'CurrencyConverter']
+
+
+class CurrencyConverter(object):
+    """
+    Converts amounts from a currency to another, reading the currencies and
+    their rates once for all the amounts.
+
+    The amounts are converted and rounded exactly like
+    :meth:`Currency.compute` does.
+
+    :param from_currency: The currency (or its id) of the amounts
+    :param to_currency: The currency (or its id) to convert the amounts to
+
+    .. versionadded:: 5.0.0.1
+    """
+
+    def __init__(self, from_currency, to_currency):
+        Currency = Pool().get('currency.currency')
+
+        self.from_currency = Currency(int(from_currency))
+        self.to_currency = Currency(int(to_currency))
+        self.from_rate = self.to_rate = None
+        if self.from_currency != self.to_currency:
+            self.from_rate = self.from_currency.rate
+            self.to_rate = self.to_currency.rate
 
-__all__ = ['Currency']
+    def convert(self, amount, round=True):
+        """
+        Returns the amount converted
+        """
+        return self.convert_many([amount], round)[0]
+
+    def convert_many(self, amounts, round=True):
+        """
+        Returns the list of the amounts converted
+        """
+        amounts = list(amounts)
+        if self.from_currency == self.to_currency:
+            if not round:
+                return amounts
+            return [self.to_currency.round(amount) for amount in amounts]
 
+        if not self.from_rate or not self.to_rate:
+            # Raise the error of the missing rate, Currency.compute is
+            # routed through the converter
+            super(Currency, Pool().get('currency.currency')).compute(
+                self.from_currency, Decimal('0'), self.to_currency
+            )
 
-class Currency(ModelSQL, ModelView):
+        rv = [amount * self.to_rate / self.from_rate for amount in amounts]
+        if round:
+            rv = [self.to_currency.round(amount) for amount in rv]
+        return rv
+
+
+class Currency(CacheTagMixin, ModelSQL, ModelView):
     '''Currency Manipulation for core.'''
     __name__ = 'currency.currency'
 
+    @classmethod
+    def get_converter(cls, from_currency=None, to_currency=None):
+        """
+        Returns the :class:`CurrencyConverter` of the currencies, by default
+        from the currency of the company which owns the current website to
+        the currency of the current locale.
+
+        Within a request the converter is built once per transaction, so
+        that the currencies and their rates are read once for all the
+        amounts of the page.
+
+        .. versionadded:: 5.0.0.1
+        """
+        if from_currency is None:
+            from_currency = current_website.company.currency
+        if to_currency is None:
+            to_currency = current_locale.currency
+
+        if not has_request_context():
+            return CurrencyConverter(from_currency, to_currency)
+
+        # The rates depend on the date of the context
+        key = ('currency.currency.converter', int(from_currency),
+               int(to_currency), Transaction().context.get('date'))
+        converter = request.__dictcache__.get(key)
+        if converter is None:
+            converter = request.__dictcache__[key] = CurrencyConverter(
+                from_currency, to_currency
+            )
+        return converter
+
     @classmethod
     @context_processor('convert')
     def convert(cls, amount):
         """A helper method which converts the amount from the currency of the
         company which owns the current website to the currency of the current
         session.
+
+        .. versionchanged:: 5.0.0.1
+
+            The currencies and their rates are read once per request. See
+            :meth:`get_converter`.
         """
-        return cls.compute(
-            current_website.company.currency,
-            amount,
-            current_locale.currency
-        )
+        return cls.get_converter().convert(amount)
+
+    @classmethod
+    @context_processor('convert_many')
+    @template_filter('convert_many')
+    def convert_many(cls, amounts):
+        """Converts a list of amounts from the currency of the company which
+        owns the current website to the currency of the current session,
+        reading the currencies and their rates once::
+
+            {% for price in prices|convert_many %}
+              {{ price }}
+            {% endfor %}
+
+        .. versionadded:: 5.0.0.1
+        """
+        return cls.get_converter().convert_many(amounts)
 
     @classmethod
     @context_processor('compute')
     def compute(cls, from_currency, amount, to_currency, round=True):
-        """Adds compute method to context processors"""
-        return super(Currency, cls).compute(
-            from_currency, amount, to_currency, round
+        """Adds compute method to context processors
+
+        .. versionchanged:: 5.0.0.1
+
+            The amount is converted by the converter of the currencies, see
+            :meth:`get_converter`.
+        """
+        return cls.get_converter(from_currency, to_currency).convert(
+            amount, round
         )
@@ -4,9 +4,12 @@
 import unittest
 from decimal import Decimal
 
+from mock import patch
+
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import activate_module, USER, with_transaction
 from trytond.pool import Pool
+from trytond.exceptions import UserError
 from nereid.testing import NereidTestCase
 
 
@@ -154,6 +157,63 @@ class TestCurrency(NereidTestCase):
                 self.currency_obj.convert(Decimal('100')), Decimal('200')
             )
 
+    @with_transaction()
+    def test_0030_convert_many(self):
+        """
+        Convert a list of amounts with the rates read once per request
+        """
+        self.setup_defaults()
+        self.templates['home.jinja'] = \
+            '{{ [1, 2]|convert_many|join(",") }}'
+        app = self.get_app()
+
+        with app.test_client() as c:
+            rv = c.get('/es_ES/')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.data.decode('utf-8'), '2.00,4.00')
+
+        with app.test_request_context('/es_ES/'):
+            converter = self.currency_obj.get_converter()
+            self.assertIs(self.currency_obj.get_converter(), converter)
+            self.assertEqual(
+                self.currency_obj.convert_many([
+                    Decimal('100'), Decimal('0.125'), Decimal('-1.333')
+                ]),
+                [Decimal('200'), Decimal('0.25'), Decimal('-2.67')]
+            )
+            self.assertEqual(
+                converter.convert_many([Decimal('0.125')], round=False),
+                [Decimal('0.250')]
+            )
+            # compute converts with the converter of the request
+            with patch.object(
+                    converter, 'convert', return_value=Decimal('42')
+            ) as convert:
+                self.assertEqual(
+                    self.currency_obj.compute(
+                        self.usd, Decimal('1'), self.eur, round=False
+                    ),
+                    Decimal('42')
+                )
+            convert.assert_called_once_with(Decimal('1'), False)
+
+            # A missing rate fails like it does without the converter
+            no_rate, = self.currency_obj.create([{
+                'code': 'C5',
+                'symbol': 'C5',
+                'name': 'Currency 5',
+            }])
+            self.assertRaises(
+                UserError, self.currency_obj.compute,
+                self.usd, Decimal('1'), no_rate
+            )
+
+            to_c1 = self.currency_obj.get_converter(
+                to_currency=self.website_currencies[0]
+            )
+            self.assertIsNot(to_c1, converter)
+            self.assertEqual(to_c1.convert(Decimal('1')), Decimal('10'))
+
 
 def suite():
     "Currency test suite"
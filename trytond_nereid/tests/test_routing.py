@@ -235,6 +235,40 @@ class TestRouting(NereidTestCase):
             response = c.get('/countries/6/subdivisions')  # Invalid record
             self.assertEqual(response.status_code, 404)
 
+            # The existence check can be disabled on the rule
+            response = c.get('/test-record/6')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'6')
+
+    @with_transaction()
+    def test_0065_endpoint_dispatch_table(self):
+        """
+        The endpoints of routes are resolved when the registry is built
+        """
+        self.setup_defaults()
+        app = self.get_app()
+        Country = Pool().get('country.country')
+        Website = Pool().get('nereid.website')
+
+        model, meth, instance_method = app.route_registry.endpoints[
+            'country.country.get_subdivisions'
+        ]
+        self.assertIs(model, Country)
+        self.assertTrue(instance_method)
+
+        model, meth, instance_method = app.route_registry.endpoints[
+            'nereid.website.home'
+        ]
+        self.assertIs(model, Website)
+        self.assertEqual(meth, Website.home)
+        self.assertFalse(instance_method)
+
+        country, = Country.create([{'name': 'India', 'code': 'IN'}])
+        self.assertTrue(app.records_exist(Country, [country.id]))
+        self.assertFalse(app.records_exist(Country, [country.id, -1]))
+        self.assertFalse(app.records_exist(Country, [None]))
+        self.assertFalse(app.records_exist(Country, ['abc']))
+
     @with_transaction()
     def test_0070_csrf(self):
         """
@@ -298,6 +332,90 @@ class TestRouting(NereidTestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(response.data, b'Success')
 
+    @with_transaction()
+    def test_0080_route_registry(self):
+        """
+        Test the routes, context processors and filters in the registry
+        """
+        self.setup_defaults()
+        app = self.get_app()
+
+        registry = app.route_registry
+        # The registry is only built once for the pool
+        self.assertIs(app.route_registry, registry)
+
+        endpoints = set(rule.endpoint for rule in registry.rules)
+        self.assertIn('nereid.website.home', endpoints)
+        self.assertIn('nereid.website.login', endpoints)
+        self.assertIn('nereid.test.test_model.test_csrf', endpoints)
+
+        self.assertEqual(
+            registry.csrf_exempt,
+            set(['nereid.test.test_model.test_csrf_exempt'])
+        )
+        self.assertIn('convert', registry.context_processors)
+        self.assertIn('get_using_xml_id', registry.context_processors)
+
+        # The rules are copied with their nereid options
+        rule, = [
+            r for r in registry.get_rules()
+            if r.endpoint == 'nereid.test.test_model.test_csrf_exempt'
+        ]
+        self.assertIsNone(rule.map)
+        self.assertTrue(rule.is_csrf_exempt)
+        self.assertTrue(rule.empty().is_csrf_exempt)
+
+    @with_transaction()
+    def test_0090_url_map_store(self):
+        """
+        The URL map should only be rebuilt when the routes or the locales of
+        the website change.
+        """
+        self.setup_defaults()
+        app = self.get_app()
+
+        with app.test_client() as c:
+            self.assertEqual(c.get('/en_US/').status_code, 200)
+            self.assertEqual(c.get('/es_ES/').status_code, 200)
+        self.assertEqual(app.url_map_store.rebuilds, 1)
+
+        # Clearing the Tryton caches does not rebuild the map
+        self.nereid_website_obj.clear_url_adapter_cache()
+        with app.test_client() as c:
+            self.assertEqual(c.get('/en_US/').status_code, 200)
+        self.assertEqual(app.url_map_store.rebuilds, 1)
+
+        # But changing the locales of the website does
+        self.nereid_website_obj.write([self.nereid_website], {
+            'default_locale': self.locale_es_es.id,
+        })
+        with app.test_client() as c:
+            rv = c.get('/')
+            self.assertTrue(rv.location.endswith('/es_ES'))
+        self.assertEqual(app.url_map_store.rebuilds, 2)
+
+        self.nereid_website_obj.write([self.nereid_website], {
+            'default_locale': self.locale_en_us.id,
+            'locales': [('remove', [self.locale_es_es.id])],
+        })
+        with app.test_client() as c:
+            rv = c.get('/')
+            self.assertTrue(rv.location.endswith('/en_US'))
+        self.assertEqual(app.url_map_store.rebuilds, 3)
+        version = self.nereid_website.get_url_map_version(app)
+        self.assertNotIn('es_ES', version[2])
+
+        # Or adding a rule to the application
+        app = self.get_app()
+        version = self.nereid_website.get_url_map_version(app)
+        app.add_url_rule('/extra', 'extra', lambda: 'extra')
+        self.assertNotEqual(
+            self.nereid_website.get_url_map_version(app), version
+        )
+        with app.test_client() as c:
+            self.assertEqual(c.get('/en_US/').status_code, 200)
+            self.assertEqual(c.get('/extra').data, b'extra')
+
 
 def suite():
     "Nereid test suite"
@@ -1,10 +1,15 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import shutil
+import tempfile
 import unittest
+from mock import patch
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import activate_module, with_transaction
 from trytond.pool import Pool
 from nereid.testing import NereidTestCase
+from nereid.contrib.locale import get_catalogue, get_catalogue_filename, \
+    load_catalogue
 
 
 class TestTranslation(NereidTestCase):
@@ -402,6 +407,134 @@ class TestTranslation(NereidTestCase):
         IRTranslation.translation_export(new_lang.code, 'nereid_test')
         IRTranslation.translation_export(new_lang.code, 'nereid')
 
+    @with_transaction()
+    def test_0500_translation_catalogue(self):
+        """
+        Translations are answered from a catalogue reloaded on changes
+        """
+        IRTranslation = Pool().get('ir.translation')
+
+        translation, = IRTranslation.create([{
+            'name': 'test',
+            'lang': 'fr',
+            'type': 'nereid',
+            'module': 'nereid_test',
+            'src': 'Hello',
+            'value': 'Bonjour',
+            'res_id': -1,
+            'fuzzy': False,
+        }])
+        self.assertEqual(
+            IRTranslation.get_translation_4_nereid(
+                'nereid_test', 'nereid', 'fr', 'Hello'
+            ),
+            'Bonjour'
+        )
+        self.assertIsNone(
+            IRTranslation.get_translation_4_nereid(
+                'nereid_test', 'nereid', 'fr', 'Goodbye'
+            )
+        )
+        catalogue = IRTranslation.get_nereid_catalogue(
+            'nereid_test', 'nereid', 'fr'
+        )
+        self.assertIs(
+            IRTranslation.get_nereid_catalogue('nereid_test', 'nereid', 'fr'),
+            catalogue
+        )
+
+        IRTranslation.write([translation], {'value': 'Salut'})
+        self.assertEqual(
+            IRTranslation.get_translation_4_nereid(
+                'nereid_test', 'nereid', 'fr', 'Hello'
+            ),
+            'Salut'
+        )
+
+    @with_transaction()
+    def test_0600_compile_catalogues(self):
+        """
+        Translations are compiled into .mo catalogues
+        """
+        IRTranslation = Pool().get('ir.translation')
+
+        IRTranslation.create([{
+            'name': 'test',
+            'lang': 'fr',
+            'type': 'nereid',
+            'module': 'nereid_test',
+            'src': 'Hello',
+            'value': 'Bonjour',
+            'res_id': -1,
+            'fuzzy': False,
+        }])
+
+        path = tempfile.mkdtemp()
+        try:
+            filenames = IRTranslation.export_nereid_catalogues(path)
+            filename = get_catalogue_filename(
+                path, 'fr', 'nereid', 'nereid_test'
+            )
+            self.assertIn(filename, filenames)
+            self.assertIn(
+                get_catalogue_filename(path, 'fr', 'nereid'), filenames
+            )
+
+            catalogue = load_catalogue(filename)
+            self.assertEqual(catalogue.gettext('Hello'), 'Bonjour')
+            self.assertEqual(catalogue.gettext('Goodbye'), 'Goodbye')
+
+            self.assertIsNone(
+                load_catalogue(get_catalogue_filename(path, 'de', 'nereid'))
+            )
+        finally:
+            shutil.rmtree(path)
+
+    @with_transaction()
+    def test_0610_compiled_catalogue_changes(self):
+        """
+        Compiled catalogues are not used once the translations change, until
+        they are compiled again
+        """
+        IRTranslation = Pool().get('ir.translation')
+
+        translation, = IRTranslation.create([{
+            'name': 'test',
+            'lang': 'fr',
+            'type': 'nereid',
+            'module': 'nereid_test',
+            'src': 'Hello',
+            'value': 'Bonjour',
+            'res_id': -1,
+            'fuzzy': False,
+        }])
+
+        path = tempfile.mkdtemp()
+        try:
+            app = self.get_app(TRANSLATIONS_PATH=path)
+            with app.app_context():
+                IRTranslation.export_nereid_catalogues(path)
+                catalogue = get_catalogue('nereid_test', 'nereid', 'fr')
+                self.assertEqual(catalogue.gettext('Hello'), 'Bonjour')
+                self.assertIs(
+                    get_catalogue('nereid_test', 'nereid', 'fr'), catalogue
+                )
+
+                # Another process changed the translations
+                with patch.object(
+                        IRTranslation, 'get_nereid_changed',
+                        return_value='later'):
+                    IRTranslation.write([translation], {'value': 'Salut'})
+                    self.assertIsNone(
+                        get_catalogue('nereid_test', 'nereid', 'fr')
+                    )
+
+                    IRTranslation.export_nereid_catalogues(path)
+                    catalogue = get_catalogue('nereid_test', 'nereid', 'fr')
+                    self.assertEqual(catalogue.gettext('Hello'), 'Salut')
+        finally:
+            shutil.rmtree(path)
+
 
 def suite():
     "Nereid test suite"
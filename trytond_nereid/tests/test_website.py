@@ -3,9 +3,14 @@
 import unittest
 import json
 
+from mock import patch
+
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import activate_module, USER, with_transaction
 from trytond.pool import Pool
+from trytond.transaction import Transaction
+from nereid import current_website, current_locale, request
+from nereid.globals import get_current_stats
 from nereid.testing import NereidTestCase
 
 
@@ -43,16 +48,16 @@ class TestWebsite(NereidTestCase):
 
         en_us, = self.Language.search([('code', '=', 'en')])
         currency, = self.Currency.search([('code', '=', 'USD')])
-        locale, = self.NereidWebsiteLocale.create([{
+        self.locale, = self.NereidWebsiteLocale.create([{
             'code': 'en_US',
             'language': en_us,
             'currency': currency,
         }])
-        self.NereidWebsite.create([{
+        self.website, = self.NereidWebsite.create([{
             'name': 'localhost',
             'company': self.company,
             'application_user': USER,
-            'default_locale': locale,
+            'default_locale': self.locale,
         }])
 
     @with_transaction()
@@ -74,6 +79,78 @@ class TestWebsite(NereidTestCase):
             self.assertEqual(data['status']['logged_id'], False)
             self.assertEqual(data['status']['messages'], [])
 
+    @with_transaction()
+    def test_0020_host_snapshot_cache(self):
+        """
+        Resolving a host should not hit the database once the snapshot is
+        cached, and changes to the website or locales should invalidate it.
+        """
+        self.setup_defaults()
+
+        snapshot = self.NereidWebsite.get_snapshot_from_host('localhost')
+        self.assertEqual(snapshot['id'], self.website.id)
+        self.assertEqual(snapshot['company'], self.company.id)
+        self.assertEqual(snapshot['application_user'], USER)
+        self.assertEqual(snapshot['default_locale']['code'], 'en_US')
+        self.assertEqual(snapshot['default_locale']['language'], 'en')
+        self.assertEqual(snapshot['locales'], {})
+
+        with patch.object(
+                self.NereidWebsite, 'search_from_host') as search_from_host:
+            self.assertEqual(
+                self.NereidWebsite.get_from_host('localhost'), self.website
+            )
+            self.assertFalse(search_from_host.called)
+
+        # Adding a locale to the website invalidates the snapshot
+        self.NereidWebsite.write([self.website], {
+            'locales': [('add', [self.locale.id])],
+        })
+        snapshot = self.NereidWebsite.get_snapshot_from_host('localhost')
+        self.assertEqual(list(snapshot['locales']), ['en_US'])
+
+        # So does changing the code of a locale
+        self.locale.code = 'en_GB'
+        self.locale.save()
+        snapshot = self.NereidWebsite.get_snapshot_from_host('localhost')
+        self.assertEqual(list(snapshot['locales']), ['en_GB'])
+        self.assertEqual(snapshot['default_locale']['code'], 'en_GB')
+
+    @with_transaction()
+    def test_0030_current_records(self):
+        """
+        The current website and locale are built once per transaction,
+        user and context of a request
+        """
+        self.setup_defaults()
+        app = self.get_app()
+
+        with app.test_request_context('/'):
+            website = current_website._get_current_object()
+            self.assertEqual(website, self.website)
+            self.assertIs(current_website._get_current_object(), website)
+            self.assertEqual(current_website.company, self.company)
+            self.assertEqual(current_locale.currency.code, 'USD')
+            self.assertIs(current_locale._get_current_object(),
+                          current_locale._get_current_object())
+
+            stats = get_current_stats()
+            self.assertEqual(stats['website']['builds'], 1)
+            self.assertEqual(stats['locale']['builds'], 1)
+            self.assertGreater(stats['website']['accesses'], 3)
+
+            # A new record is built for another context
+            with Transaction().set_context(company=self.company.id):
+                self.assertIsNot(
+                    current_website._get_current_object(), website
+                )
+            self.assertEqual(stats['website']['builds'], 2)
+
+            # and once the transaction of the request is stopped
+            request.__dictcache__ = {}
+            self.assertIsNot(current_website._get_current_object(), website)
+            self.assertEqual(stats['website']['builds'], 3)
+
 
 def suite():
     "Nereid test suite"
@@ -15,12 +15,15 @@
 import os
 import polib
 import logging
+from threading import Lock
+from uuid import uuid4
 
 import wtforms
 from jinja2 import FileSystemLoader, Environment
 from jinja2.ext import babel_extract, GETTEXT_FUNCTIONS
 from babel.messages.extract import extract_from_dir
 from babel.messages.extract import extract_from_file
+from sql import Table
 from trytond.model import fields
 from trytond.wizard import Wizard
 from trytond.transaction import Transaction
@@ -28,6 +31,7 @@ from trytond.pool import Pool, PoolMeta
 from trytond.cache import Cache
 from trytond.tools import file_open, cursor_dict
 from trytond.ir.translation import TrytonPOFile
+from nereid.contrib.locale import get_catalogue_filename
 
 __all__ = [
     'Translation',
@@ -299,59 +303,196 @@ class Translation(metaclass=PoolMeta):
             return
 
     # Begin nereid changes
-    _nereid_translation_cache = Cache(
-        'ir.translation', size_limit=10240, context=False
-    # End nereid changes
+    #: A token identifying the current version of the nereid translations,
+    #: replaced on every change of a translation. The cache is shared by the
+    #: processes through the reset mechanism of the Tryton cache.
+    _nereid_catalogue_version = Cache(
+        'ir.translation.nereid_catalogue_version', context=False
     )
 
+    #: The catalogues of translations by database, language, type and
+    #: module. Each is a tuple of the version token it was loaded with and
+    #: a dictionary of the translations by source. The catalogues are shared
+    #: by the threads of the process.
+    _nereid_catalogues = {}
+    _nereid_catalogues_lock = Lock()
+
+    #: A token identifying the current version of the compiled catalogues,
+    #: replaced when they are compiled again
+    _nereid_compiled_version = Cache(
+        'ir.translation.nereid_compiled_version', context=False
+    )
+    # End nereid changes
+
     @classmethod
-    def get_translation_4_nereid(cls, module, ttype, lang, source):
-        "Return translation for source"
-        ttype = str(ttype)
-        lang = str(lang)
-        source = str(source)
+    def get_nereid_catalogue_version(cls):
+        """
+        Return the token of the current version of the nereid translations
+        """
+        version = cls._nereid_catalogue_version.get('version')
+        if version is None:
+            version = uuid4().hex
+            cls._nereid_catalogue_version.set('version', version)
+        return version
 
-        cache_key = (lang, ttype, source, module)
+    @classmethod
+    def get_nereid_compiled_version(cls):
+        """
+        Return the token of the current version of the nereid translations
+        and of their compiled catalogues
+        """
+        version = cls._nereid_compiled_version.get('version')
+        if version is None:
+            version = uuid4().hex
+            cls._nereid_compiled_version.set('version', version)
+        return (cls.get_nereid_catalogue_version(), version)
 
-        trans = cls._nereid_translation_cache.get(cache_key, -1)
-        if trans != -1:
-            return trans
+    @classmethod
+    def get_nereid_changed(cls):
+        """
+        Return the time of the last change of the nereid translations in
+        any process, as recorded by the reset of the cache of their version,
+        or an empty string if they never changed.
+        """
+        cursor = Transaction().connection.cursor()
+        table = Table('ir_cache')
+        cursor.execute(*table.select(
+            table.timestamp,
+            where=table.name == 'ir.translation.nereid_catalogue_version',
+        ))
+        row = cursor.fetchone()
+        return str(row[0]) if row else ''
+
+    @classmethod
+    def get_nereid_catalogue(cls, module, ttype, lang):
+        """
+        Return a dictionary of the translations of the given type and
+        language by source, loaded with a single query. If module is None
+        the translations of all the modules are returned.
 
+        The catalogue is loaded once for every version of the translations.
+        """
+        key = (Transaction().database.name, lang, ttype, module)
+        version = cls.get_nereid_catalogue_version()
+
+        cached = cls._nereid_catalogues.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with cls._nereid_catalogues_lock:
+            cached = cls._nereid_catalogues.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            where = table.lang == lang
+            where &= table.type == ttype
+            where &= table.value != ''
+            where &= table.value != None
+            where &= table.fuzzy == False
+            if module is not None:
+                where &= (table.module == module)
+
+            catalogue = {}
+            cursor.execute(*table.select(
+                table.src, table.value, where=where, order_by=table.id
+            ))
+            for source, value in cursor.fetchall():
+                catalogue.setdefault(source, value)
+            cls._nereid_catalogues[key] = (version, catalogue)
+        return catalogue
+
+    @classmethod
+    def get_translation_4_nereid(cls, module, ttype, lang, source):
+        "Return translation for source"
+        return cls.get_nereid_catalogue(
+            module, str(ttype), str(lang)
+        ).get(str(source))
+
+    @classmethod
+    def export_nereid_catalogues(cls, path):
+        """
+        Compile the nereid translations into GNU .mo catalogues in the path,
+        one for every language, type and module and one for every language
+        and type with the translations of all the modules. Returns the list
+        of the files written.
+
+        The translations of nereid are read from these catalogues when the
+        path is the `TRANSLATIONS_PATH` of the application, until the
+        translations change. See :func:`~nereid.contrib.locale.get_catalogue`.
+        """
+        changed = cls.get_nereid_changed()
         cursor = Transaction().connection.cursor()
         table = cls.__table__()
-        where = (
-            (table.lang == lang) &
-            (table.type == ttype) &
-            (table.value != '') &
-            (table.value != None) &
-            (table.fuzzy == False) &
-            (table.src == source)
-        )
-        if module is not None:
-            where &= (table.module == module)
-
-        cursor.execute(*table.select(table.value, where=where))
-        res = cursor.fetchone()
-        if res:
-            cls._nereid_translation_cache.set(cache_key, res[0])
-            return res[0]
-        else:
-            cls._nereid_translation_cache.set(cache_key, False)
-            return None
+        where = table.type.in_(_nereid_types)
+        where &= table.value != ''
+        where &= table.value != None  # noqa
+        where &= table.fuzzy == False  # noqa
+        cursor.execute(*table.select(
+            table.lang, table.type, table.module, where=where,
+            group_by=[table.lang, table.type, table.module],
+        ))
+        catalogues = set()
+        for lang, ttype, module in cursor.fetchall():
+            catalogues.add((lang, ttype, module))
+            catalogues.add((lang, ttype, None))
+
+        filenames = []
+        for lang, ttype, module in sorted(
+                catalogues, key=lambda c: (c[0], c[1], c[2] or '')):
+            mofile = polib.MOFile()
+            mofile.metadata = {
+                'Content-Type': 'text/plain; charset=utf-8',
+                'X-Nereid-Translations-Changed': changed,
+            }
+            catalogue = cls.get_nereid_catalogue(module, ttype, lang)
+            for source, value in sorted(catalogue.items()):
+                mofile.append(polib.MOEntry(msgid=source, msgstr=value))
+
+            filename = get_catalogue_filename(path, lang, ttype, module)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            # Replace the file at once for the running workers
+            mofile.save(filename + '.tmp')
+            os.replace(filename + '.tmp', filename)
+            filenames.append(filename)
+
+        # Have every process load the catalogues again
+        cls._nereid_compiled_version.clear()
+        return filenames
+
+    @classmethod
+    def clear_nereid_catalogues(cls):
+        """
+        Invalidate the catalogues of nereid translations in every process
+        """
+        dbname = Transaction().database.name
+        cls._nereid_catalogue_version.clear()
+        # Catalogues loaded by other threads before the commit would have
+        # the old translations with the new version
+        Transaction().atexit(cls._drop_nereid_catalogues, dbname)
+
+    @classmethod
+    def _drop_nereid_catalogues(cls, dbname):
+        with cls._nereid_catalogues_lock:
+            for key in list(cls._nereid_catalogues):
+                if key[0] == dbname:
+                    del cls._nereid_catalogues[key]
 
     @classmethod
     def delete(cls, translations):
-        cls._nereid_translation_cache.clear()
+        cls.clear_nereid_catalogues()
         return super(Translation, cls).delete(translations)
 
     @classmethod
     def create(cls, vlist):
-        cls._nereid_translation_cache.clear()
+        cls.clear_nereid_catalogues()
         return super(Translation, cls).create(vlist)
 
     @classmethod
     def write(cls, translations, values, *args):
-        cls._nereid_translation_cache.clear()
+        cls.clear_nereid_catalogues()
         return super(Translation, cls).write(translations, values, *args)
 
 
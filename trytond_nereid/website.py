@@ -16,6 +16,7 @@ from nereid.globals import request
 from nereid.exceptions import WebsiteNotFound
 from nereid.helpers import login_required, key_from_list, get_flashed_messages
 from nereid.signals import failed_login
+from nereid.cache_utils import CacheTagMixin, cached_call
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.transaction import Transaction
 from trytond.pool import Pool
@@ -34,7 +35,7 @@ class LoginForm(Form):
     remember = BooleanField(_('Remember me'), default=False)
 
 
-class WebSite(ModelSQL, ModelView):
+class WebSite(CacheTagMixin, ModelSQL, ModelView):
     """
     One of the most powerful features of Nereid is the ability to
     manage multiple websites from one back-end. A web site in nereid
@@ -281,18 +282,20 @@ class WebSite(ModelSQL, ModelView):
             Transaction().database.name,
             Transaction().user,
             'nereid.website.get_currencies',
+            self.id,
         ])
-        # The website is automatically appended to the cache prefix
-        rv = cache.get(cache_key)
-        if rv is None:
-            rv = [{
+        # The website is automatically appended to the cache prefix. The
+        # list is invalidated when the website or a currency is changed.
+        return cached_call(
+            cache, cache_key,
+            lambda: [{
                 'id': c.id,
                 'name': c.name,
                 'symbol': c.symbol,
-            } for c in self.currencies
-            ]
-            cache.set(cache_key, rv, 60 * 60)
-        return rv
+            } for c in self.currencies],
+            60 * 60,
+            tags=['nereid.website:%d' % self.id, 'currency.currency'],
+        )
 
     @staticmethod
     def _user_status():
@@ -322,11 +325,48 @@ class WebSite(ModelSQL, ModelView):
         """
         return jsonify(status=cls._user_status())
 
+    _host_cache = Cache('nereid.website.host', context=False)
+
+    @classmethod
+    def clear_host_cache(cls, *args):
+        """
+        A method which conveniently clears the cache of hosts and website
+        snapshots
+        """
+        cls._host_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls.clear_host_cache()
+        return super(WebSite, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.clear_host_cache()
+        super(WebSite, cls).write(*args)
+
+    @classmethod
+    def delete(cls, websites):
+        cls.clear_host_cache()
+        super(WebSite, cls).delete(websites)
+
     @classmethod
     def get_from_host(cls, host, silent=False):
         """
         Returns the website with name as given host
 
+        If not silent a website not found error is raised.
+        """
+        snapshot = cls.get_snapshot_from_host(host, silent=silent)
+        if snapshot is not None:
+            return cls(snapshot['id'])
+
+    @classmethod
+    def search_from_host(cls, host, silent=False):
+        """
+        Searches the database for the website with name as given host. Unlike
+        :meth:`get_from_host` the result is not cached.
+
         If not silent a website not found error is raised.
         """
         if cls.search([], count=True) == 1:
@@ -339,6 +379,74 @@ class WebSite(ModelSQL, ModelView):
         else:
             return website
 
+    @classmethod
+    def get_snapshot_from_host(cls, host, silent=False):
+        """
+        Returns the snapshot (see :meth:`get_snapshot`) of the website with
+        name as given host.
+
+        The host to website mapping is cached in the worker and invalidated
+        when a website, a locale or the locales of a website change, so
+        resolving a host does not need the database once the cache is warm.
+
+        If not silent a website not found error is raised.
+        """
+        website_id = cls._host_cache.get(('host', host))
+        if website_id is None:
+            website = cls.search_from_host(host, silent=silent)
+            if website is None:
+                return None
+            website_id = website.id
+            cls._host_cache.set(('host', host), website_id)
+        return cls(website_id).get_snapshot()
+
+    @staticmethod
+    def _get_locale_snapshot(locale):
+        """
+        Returns the values of the locale stored in the website snapshot
+        """
+        return {
+            'id': locale.id,
+            'code': locale.code,
+            'language': locale.language.code,
+        }
+
+    def get_snapshot(self):
+        """
+        Returns a dictionary of the values of the website used on every
+        request by the dispatcher, the URL adapter and the `current_website`
+        and `current_locale` proxies:
+
+            * id
+            * name
+            * application_user: id of the application user
+            * company: id of the company
+            * default_locale: values of the default locale
+            * locales: values of the locales of the website by code
+
+        The values of a locale are its id, code and language code.
+
+        The snapshot is built once and cached in the worker until a website
+        or locale is modified.
+        """
+        rv = self._host_cache.get(('website', self.id))
+        if rv is None:
+            rv = {
+                'id': self.id,
+                'name': self.name,
+                'application_user': self.application_user.id,
+                'company': self.company.id,
+                'default_locale': self._get_locale_snapshot(
+                    self.default_locale
+                ),
+                'locales': dict(
+                    (locale.code, self._get_locale_snapshot(locale))
+                    for locale in self.locales
+                ),
+            }
+            self._host_cache.set(('website', self.id), rv)
+        return rv
+
     def get_context(self):
         """
         Returns transaction context to be used by nereid dispatcher for this
@@ -346,25 +454,53 @@ class WebSite(ModelSQL, ModelView):
         """
         return {}
 
-    _url_adapter_cache = Cache('nereid.website.url_adapter', context=False)
-
     @classmethod
     def clear_url_adapter_cache(cls, *args):
         """
         A method which conveniently clears the cache
+
+        The URL maps are versioned by the routes and the locales of the
+        website, and the locales are read from the website snapshot. So
+        clearing the snapshots is enough to rebuild the maps of websites
+        whose locales changed.
+        """
+        cls.clear_host_cache()
+
+    def get_url_map_version(self, app):
         """
-        cls._url_adapter_cache.clear()
+        Returns the version of the URL map of the website. The URL map is
+        rebuilt only when the version changes.
+
+        The version changes when the route registry of the application
+        changes (see :attr:`~nereid.routing.RouteRegistry.version`) or the
+        locales of the website change.
+        """
+        snapshot = self.get_snapshot()
+        return (
+            app.route_registry.version,
+            snapshot['default_locale']['code'],
+            tuple(sorted(snapshot['locales'])),
+        )
 
     def get_url_adapter(self, app):
         """
         Returns the URL adapter for the website
-        """
-        cache_rv = self._url_adapter_cache.get(self.id)
 
-        if cache_rv is not None:
-            return cache_rv
+        The compiled URL map is kept in the :attr:`~nereid.Nereid.url_map_store`
+        of the application and rebuilt only when the version returned by
+        :meth:`get_url_map_version` changes.
+        """
+        return app.url_map_store.get(
+            self.id, self.get_url_map_version(app),
+            lambda: self.build_url_map(app)
+        )
 
-        url_rules = app.get_urls()[:]
+    def build_url_map(self, app):
+        """
+        Builds a new URL map for the website from the rules of the route
+        registry of the application.
+        """
+        url_rules = app.get_urls()
 
         # Add the static url
         url_rules.append(
@@ -374,12 +510,13 @@ class WebSite(ModelSQL, ModelView):
             )
         )
 
+        snapshot = self.get_snapshot()
         url_map = Map()
-        if self.locales:
+        if snapshot['locales']:
             # Create the URL map with locale prefix
             url_map.add(
                 app.url_rule_class(
-                    '/', redirect_to='/%s' % self.default_locale.code,
+                    '/', redirect_to='/%s' % snapshot['default_locale']['code'],
                 ),
             )
             url_map.add(Submount('/<locale>', url_rules))
@@ -392,8 +529,6 @@ class WebSite(ModelSQL, ModelView):
         for rule in app.url_map._rules:
             url_map.add(rule.empty())
 
-        self._url_adapter_cache.set(self.id, url_map)
-
         return url_map
 
     def get_current_locale(self, req):
@@ -402,13 +537,30 @@ class WebSite(ModelSQL, ModelView):
         The locale could either be from the URL if the locale was specified
         in the URL, or the default locale from the website.
         """
+        Locale = Pool().get('nereid.website.locale')
+
+        snapshot = self.get_snapshot()
         if req.view_args and 'locale' in req.view_args:
-            for locale in self.locales:
-                if locale.code == req.view_args['locale']:
-                    return locale
+            locale = snapshot['locales'].get(req.view_args['locale'])
+            if locale is not None:
+                return Locale(locale['id'])
 
         # Return the default locale
-        return self.default_locale
+        return Locale(snapshot['default_locale']['id'])
+
+    def get_locale_language(self, locale):
+        """
+        Returns the code of the language of the given locale of the website
+        from the website snapshot.
+        """
+        snapshot = self.get_snapshot()
+        locale_id = int(locale)
+        if snapshot['default_locale']['id'] == locale_id:
+            return snapshot['default_locale']['language']
+        for values in snapshot['locales'].values():
+            if values['id'] == locale_id:
+                return values['language']
+        return Pool().get('nereid.website.locale')(locale_id).language.code
 
 
 class WebSiteLocale(ModelSQL, ModelView):
@@ -433,6 +585,21 @@ class WebSiteLocale(ModelSQL, ModelView):
                 'Code must be unique'),
         ]
 
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('nereid.website').clear_host_cache()
+        return super(WebSiteLocale, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('nereid.website').clear_host_cache()
+        super(WebSiteLocale, cls).write(*args)
+
+    @classmethod
+    def delete(cls, locales):
+        Pool().get('nereid.website').clear_host_cache()
+        super(WebSiteLocale, cls).delete(locales)
+
 
 class WebsiteCountry(ModelSQL):
     "Website Country Relations"
@@ -466,3 +633,18 @@ class WebsiteWebsiteLocale(ModelSQL):
     locale = fields.Many2One(
         'nereid.website.locale', 'Locale',
         ondelete='CASCADE', select=1, required=True)
+
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('nereid.website').clear_host_cache()
+        return super(WebsiteWebsiteLocale, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('nereid.website').clear_host_cache()
+        super(WebsiteWebsiteLocale, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        Pool().get('nereid.website').clear_host_cache()
+        super(WebsiteWebsiteLocale, cls).delete(records)